@@ -1,10 +1,12 @@
 // For background on the hashtable design first implemented in AutoMap, see the following:
 // https://github.com/brandtbucher/automap/blob/b787199d38d6bfa1b55484e5ea1e89b31cc1fa72/automap.c#L12
 # include <math.h>
+# include <float.h>
 # include "stdbool.h"
 
 # define PY_SSIZE_T_CLEAN
 # include "Python.h"
+# include "pythread.h"
 
 # define PY_ARRAY_UNIQUE_SYMBOL AM_ARRAY_API
 # define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
@@ -35,10 +37,64 @@ typedef struct TableElement{
     Py_hash_t hash;
 } TableElement;
 
+// For fewer than 2**31 keys, a table of TableElementCompact stores 32-bit positions and a 32-bit
+// tag of the hash.
+typedef struct TableElementCompact{
+    npy_int32 keys_pos;
+    npy_uint32 hash; // see hash_tag()
+} TableElementCompact;
+
+// The value of a numeric or datetime64 key as stored in a TableElementInline.
+typedef union InlineKey{
+    npy_int64 i; // signed integers and datetime64
+    npy_uint64 u;
+    npy_double d;
+} InlineKey;
+
+// A table of TableElementInline stores the value of each key, so that probes do not need to access
+// the keys array.
+typedef struct TableElementInline{
+    Py_ssize_t keys_pos;
+    InlineKey key;
+} TableElementInline;
+
+// The layout of table elements. For all layouts, an empty table element has a keys_pos of -1; as
+// all other fields are also initialized to -1, a table can be initialized by setting all bytes to
+// 0xFF.
+typedef enum TableLayout{
+    TL_WIDE = 0, // TableElement; required for list keys and for 2**31 or more keys
+    TL_COMPACT, // TableElementCompact
+    TL_POS, // npy_int32 keys_pos only; used for KATs where stored keys can be compared without a hash
+    TL_INLINE, // TableElementInline; optionally used for numeric and datetime64 KATs
+} TableLayout;
+
 // Table configuration; experimentation shows that these values work well:
 # define LOAD 0.9
 # define SCAN 16
 
+// Count of keys processed together in each stage of a batched lookup or insertion.
+# define LOOKUP_BLOCK 16
+
+// Count of old table elements migrated by each insertion or lookup during an incremental resize. As
+// a table is grown to twice the size at a load of LOAD, any count greater than 1 / LOAD completes a
+// migration before the next growth.
+# define MIGRATE_STEP 16
+
+// Version of the table elements stored in pickles of protocol 5 or greater. Must be incremented
+// with any change to hashing, probing, or table layouts, such that tables pickled before the change
+// are rebuilt from their keys.
+# define TABLE_FORMAT 1
+
+// Hint that memory at p will soon be read; a no-op where not supported.
+# if defined(__GNUC__) || defined(__clang__)
+# define AM_PREFETCH(p) __builtin_prefetch((p), 0, 1)
+# elif defined(_MSC_VER) && (defined(_M_X64) || defined(_M_IX86))
+# include <xmmintrin.h>
+# define AM_PREFETCH(p) _mm_prefetch((const char *)(p), _MM_HINT_T0)
+# else
+# define AM_PREFETCH(p)
+# endif
+
 const static size_t UCS4_SIZE = sizeof(Py_UCS4);
 
 // Partial, two-argument version of PyUnicode_FromKindAndData for consistent templating with bytes version.
@@ -170,25 +226,26 @@ at_to_kat(int array_t, PyArrayObject* a) {
     }
 }
 
-// To determine when we can use direct array lookups, this function return 1 if we match, 0 if we do not match. Given a keys array type and the kind of lookup key, return true only for the largest KAT types.
+// Given a keys array type and the kind of lookup key, return 1 if the kind matches the KAT, 0
+// otherwise.
 int
 kat_is_kind(KeysArrayType kat, char kind) {
     switch (kat) {
         case KAT_INT64:
-        // case KAT_INT32:
-        // case KAT_INT16:
-        // case KAT_INT8:
+        case KAT_INT32:
+        case KAT_INT16:
+        case KAT_INT8:
             return kind == 'i';
 
         case KAT_UINT64:
-        // case KAT_UINT32:
-        // case KAT_UINT16:
-        // case KAT_UINT8:
+        case KAT_UINT32:
+        case KAT_UINT16:
+        case KAT_UINT8:
             return kind == 'u';
 
         case KAT_FLOAT64:
-        // case KAT_FLOAT32:
-        // case KAT_FLOAT16:
+        case KAT_FLOAT32:
+        case KAT_FLOAT16:
             return kind == 'f';
 
         case KAT_UNICODE:
@@ -265,14 +322,85 @@ kat_is_datetime_unit(KeysArrayType kat, NPY_DATETIMEUNIT unit) {
     return false;
 }
 
+// Return true if all keys of `key_array` can be looked up with lookup_array(): numeric arrays in
+// numeric KATs, datetime64 arrays in datetime64 KATs, unicode and byte string arrays in KATs of the
+// same kind, and object arrays in any KAT. Arrays not in native byte order are looked up by scalar.
+bool
+kat_is_lookup_array(KeysArrayType kat, PyArrayObject *key_array) {
+    if (!PyArray_ISNOTSWAPPED(key_array)) {
+        return false;
+    }
+    switch (PyArray_TYPE(key_array)) {
+        case NPY_INT64:
+        case NPY_INT32:
+        case NPY_INT16:
+        case NPY_INT8:
+        case NPY_UINT64:
+        case NPY_UINT32:
+        case NPY_UINT16:
+        case NPY_UINT8:
+        case NPY_FLOAT64:
+        case NPY_FLOAT32:
+        case NPY_FLOAT16:
+            return kat_is_kind(kat, 'i') || kat_is_kind(kat, 'u') || kat_is_kind(kat, 'f');
+        case NPY_UNICODE:
+            return kat == KAT_UNICODE;
+        case NPY_STRING:
+            return kat == KAT_STRING;
+        case NPY_DATETIME:
+            return kat_is_kind(kat, 'M');
+        case NPY_OBJECT:
+            return true;
+        default:
+            return false;
+    }
+}
+
+// How keys are found: most FAMs use a hash table, though array keys of some forms can be found
+// without one.
+typedef enum KeysMode{
+    KM_TABLE = 0,
+    KM_RANGE, // signed integer or datetime64 keys of constant step; keys_pos is derived arithmetically
+    KM_SORTED, // strictly increasing numeric or datetime64 keys; keys_pos is found by binary search
+} KeysMode;
+
+// During an incremental resize, the previous table, of which elements before `pos` have been placed
+// in the table of the FAM.
+typedef struct TableOld {
+    void *table;
+    Py_ssize_t size;
+    TableLayout layout;
+    Py_ssize_t pos;
+} TableOld;
+
+// For an AutoMap from which keys have been discarded, a flag for each of the first `size` keys,
+// true if discarded. Keys at greater positions have not been discarded.
+typedef struct Discarded {
+    Py_ssize_t count; // count of true flags
+    Py_ssize_t size;
+    npy_bool flags[];
+} Discarded;
+
 typedef struct FAMObject{
     PyObject_HEAD
     Py_ssize_t table_size;
-    TableElement *table;    // an array of TableElement structs
+    void *table; // an array of table elements of table_layout; NULL if not KM_TABLE
+    TableLayout table_layout;
+    KeysMode keys_mode;
+    TableOld *table_old; // NULL if not in an incremental resize
+    npy_int64 range_start; // for KM_RANGE, the key at keys_pos 0
+    npy_int64 range_step; // for KM_RANGE, the difference between adjacent keys
     PyObject *keys;
     KeysArrayType keys_array_type;
+    int keys_lengths_width;
     Py_ssize_t keys_size;
     Py_UCS4* key_buffer;
+    char *keys_packed; // for KAT_UNICODE keys of only latin-1 characters, a copy of the keys with one byte per character; NULL otherwise
+    void *keys_lengths; // for KAT_UNICODE and KAT_STRING, the count of characters in each key, each stored in keys_lengths_width bytes; NULL otherwise
+    Discarded *discarded; // NULL if no keys have been discarded
+    bool incremental; // for an AutoMap, grow the table by incremental resize
+    bool mapped; // the table, keys_packed, and keys_lengths are memory of the buffer of the keys array, and are not freed
+    Py_hash_t hash; // -1 until computed by fam_hash()
 } FAMObject;
 
 typedef enum ViewKind{
@@ -284,22 +412,49 @@ typedef enum ViewKind{
 // Return the end pointer, or the pointer to the location after the last valid character. The end pointer minus the start pointer is the number of characters. For an empty string, all characters are NULL, and the start pointer and end pointer should be equal. NOTE: would like to use strchr(str, '\0') instead of this routine, but some buffers might not have a null terminator and stread by full to the the dt_size.
 static inline Py_UCS4*
 ucs4_get_end_p(Py_UCS4* p_start, Py_ssize_t dt_size) {
-    for (Py_UCS4* p = p_start + dt_size - 1; p >= p_start; p--) {
-        if (*p != '\0') {
-            return p + 1; // 1 after first non-null
+    Py_UCS4* p = p_start + dt_size;
+    npy_uint64 w;
+    while (p - p_start >= 2) { // skip trailing NULL characters a word at a time
+        memcpy(&w, p - 2, sizeof(w));
+        if (w) {
+            break;
         }
+        p -= 2;
+    }
+    while (p > p_start && p[-1] == '\0') {
+        p--;
     }
-    return p_start;
+    return p;
 }
 
 static inline char*
 char_get_end_p(char* p_start, Py_ssize_t dt_size) {
-    for (char* p = p_start + dt_size - 1; p >= p_start; p--) {
-        if (*p != '\0') {
-            return p + 1; // 1 after first non-null
+    char* p = p_start + dt_size;
+    npy_uint64 w;
+    while (p - p_start >= 8) { // skip trailing NULL characters a word at a time
+        memcpy(&w, p - 8, sizeof(w));
+        if (w) {
+            break;
         }
+        p -= 8;
+    }
+    while (p > p_start && p[-1] == '\0') {
+        p--;
     }
-    return p_start;
+    return p;
+}
+
+// Copy `len` UCS4 characters from `src` to `dst` as latin-1 bytes. Returns false, with the contents
+// of `dst` undefined, if any character is not latin-1. The loop has no early exit so that it can be
+// vectorized.
+static inline bool
+ucs4_to_latin1(const Py_UCS4* src, Py_ssize_t len, char* dst) {
+    Py_UCS4 bits = 0;
+    for (Py_ssize_t i = 0; i < len; i++) {
+        bits |= src[i];
+        dst[i] = (char)src[i];
+    }
+    return bits <= 0xFF;
 }
 
 // This masks the input with INT64_MAX, which removes the MSB; we then cast to an int64; the range is now between 0 and INT64_MAX. We then use the MSB of the original value; if set, we negate the number, producing negative values for the upper half of the uint64 range. Note that we only need to check for hash -1 in this branch.
@@ -324,76 +479,552 @@ int_to_hash(npy_int64 v) {
     return hash;
 }
 
-// This is a adapted from https://github.com/python/cpython/blob/ba65a065cf07a7a9f53be61057a090f7311a5ad7/Python/pyhash.c#L92
-#define HASH_MODULUS (((size_t)1 << 61) - 1)
-#define HASH_BITS 61
+// Constants and rounds adapted from xxHash64 (https://github.com/Cyan4973/xxHash). Keys are
+// consumed eight bytes at a time, and a final avalanche mixes every input bit into the low bits
+// used by `hash & mask`, avoiding the clustering of keys with shared prefixes.
+#define HASH_PRIME_1 0x9E3779B185EBCA87ULL
+#define HASH_PRIME_2 0xC2B2AE3D27D4EB4FULL
+#define HASH_PRIME_3 0x165667B19E3779F9ULL
+#define HASH_PRIME_4 0x85EBCA77C2B2AE63ULL
+#define HASH_PRIME_5 0x27D4EB2F165667C5ULL
+
+static inline npy_uint64
+hash_rotl(npy_uint64 v, int r) {
+    return (v << r) | (v >> (64 - r));
+}
+
+static inline Py_hash_t
+hash_avalanche(npy_uint64 h) {
+    h ^= h >> 33;
+    h *= HASH_PRIME_2;
+    h ^= h >> 29;
+    h *= HASH_PRIME_3;
+    h ^= h >> 32;
+
+    Py_hash_t hash = (Py_hash_t)h;
+    if (hash == -1) {
+        return -2;
+    }
+    return hash;
+}
+
+// As float keys are only hashed for arrays, there is no need for parity with Python's hash();
+// instead, the IEEE 754 bits are mixed. -0.0 is normalized to 0.0, and all NaNs have the same hash.
 static inline Py_hash_t
 double_to_hash(double v)
 {
-    int e, sign;
-    double m;
-    Py_uhash_t x, y;
-
-    if (isinf(v)) {
-        return v > 0 ? 314159 : -314159;
+    npy_uint64 bits;
+    if (v == 0.0) {
+        v = 0.0;
     }
-    if (isnan(v)) {
+    else if (isnan(v)) {
         return 0;
     }
-    m = frexp(v, &e);
-    sign = 1;
-    if (m < 0) {
-        sign = -1;
-        m = -m;
-    }
-    x = 0;
-    while (m) {
-        x = ((x << 28) & HASH_MODULUS) | x >> (HASH_BITS - 28);
-        m *= 268435456.0;  /* 2**28 */
-        e -= 28;
-        y = (Py_uhash_t)m;  /* pull out integer part */
-        m -= y;
-        x += y;
-        if (x >= HASH_MODULUS)
-            x -= HASH_MODULUS;
-    }
-    e = e >= 0 ? e % HASH_BITS : HASH_BITS-1-((-1-e) % HASH_BITS);
-    x = ((x << e) & HASH_MODULUS) | x >> (HASH_BITS - e);
-    x = x * sign;
-    if (x == (Py_uhash_t)-1)
-        x = (Py_uhash_t)-2;
-    return (Py_hash_t)x;
-}
-
-// The `str` arg is a pointer to a C-array of Py_UCS4; we will only read `len` characters from this. This is a "djb2" hash algorithm.
+    memcpy(&bits, &v, sizeof(bits));
+    return hash_avalanche(bits ^ HASH_PRIME_5);
+}
+
+// Hash `len` bytes starting at `p`. Full words are read with memcpy, so `p` need not be aligned;
+// remaining bytes are assembled, zero-padded, into a final word.
 static inline Py_hash_t
-unicode_to_hash(Py_UCS4 *str, Py_ssize_t len) {
-    Py_UCS4* p = str;
-    Py_UCS4* p_end = str + len;
-    Py_hash_t hash = 5381;
-    while (p < p_end) {
-        hash = ((hash << 5) + hash) + *p++;
-    }
-    if (hash == -1) {
-        return -2;
+bytes_to_hash(const char *p, Py_ssize_t len) {
+    const char* p_end = p + len;
+    npy_uint64 h = HASH_PRIME_5 + (npy_uint64)len;
+    npy_uint64 w;
+    while (p + 8 <= p_end) {
+        memcpy(&w, p, 8);
+        w = hash_rotl(w * HASH_PRIME_2, 31) * HASH_PRIME_1;
+        h = hash_rotl(h ^ w, 27) * HASH_PRIME_1 + HASH_PRIME_4;
+        p += 8;
+    }
+    if (p < p_end) { // zero-padded tail
+        w = 0;
+        for (int s = 0; p < p_end; s += 8) {
+            w |= (npy_uint64)(unsigned char)*p++ << s;
+        }
+        w = hash_rotl(w * HASH_PRIME_2, 31) * HASH_PRIME_1;
+        h = hash_rotl(h ^ w, 27) * HASH_PRIME_1 + HASH_PRIME_4;
     }
-    return hash;
+    return hash_avalanche(h);
+}
+
+// The `str` arg is a pointer to a C-array of Py_UCS4; we will only read `len` characters from this.
+static inline Py_hash_t
+unicode_to_hash(Py_UCS4 *str, Py_ssize_t len) {
+    return bytes_to_hash((const char*)str, len * UCS4_SIZE);
 }
 
 static inline Py_hash_t
 string_to_hash(char *str, Py_ssize_t len) {
-    char* p = str;
-    char* p_end = str + len;
-    Py_hash_t hash = 5381;
-    while (p < p_end) {
-        hash = ((hash << 5) + hash) + *p++;
+    return bytes_to_hash(str, len);
+}
+
+//------------------------------------------------------------------------------
+// table elements
+
+// Given a KAT and the count of keys, return the smallest table layout that can be used, or, if
+// `inline_keys` is true and the KAT is numeric or datetime64, TL_INLINE.
+static TableLayout
+table_layout_for(KeysArrayType kat, Py_ssize_t keys_size, bool inline_keys)
+{
+    if (inline_keys && kat != KAT_LIST && kat != KAT_UNICODE && kat != KAT_STRING) {
+        return TL_INLINE;
     }
-    if (hash == -1) {
-        return -2;
+    if (kat == KAT_LIST || keys_size > NPY_MAX_INT32) {
+        return TL_WIDE;
+    }
+    switch (kat) {
+        case KAT_FLOAT64:
+        case KAT_FLOAT32:
+        case KAT_FLOAT16:
+        case KAT_UNICODE:
+        case KAT_STRING:
+            return TL_COMPACT;
+        default: // integer and datetime64 KATs
+            return TL_POS;
+    }
+}
+
+static inline size_t
+table_element_size(TableLayout tl)
+{
+    switch (tl) {
+        case TL_WIDE:
+            return sizeof(TableElement);
+        case TL_COMPACT:
+            return sizeof(TableElementCompact);
+        case TL_POS:
+            return sizeof(npy_int32);
+        case TL_INLINE:
+            return sizeof(TableElementInline);
+    }
+    Py_UNREACHABLE();
+}
+
+// Fold a hash into the 32-bit tag stored in a TableElementCompact. As the low bits of the hash
+// determine the table position, high bits are folded in to better discriminate colliding keys.
+static inline npy_uint32
+hash_tag(Py_hash_t hash)
+{
+    npy_uint64 h = (npy_uint64)hash;
+    return (npy_uint32)(h ^ (h >> 32));
+}
+
+// Return the keys_pos stored at table_pos of `table` of layout `tl`, or -1 if the table element is
+// empty.
+static inline Py_ssize_t
+table_element_keys_pos(void *table, TableLayout tl, Py_ssize_t table_pos)
+{
+    switch (tl) {
+        case TL_WIDE:
+            return ((TableElement *)table)[table_pos].keys_pos;
+        case TL_COMPACT:
+            return ((TableElementCompact *)table)[table_pos].keys_pos;
+        case TL_POS:
+            return ((npy_int32 *)table)[table_pos];
+        case TL_INLINE:
+            return ((TableElementInline *)table)[table_pos].keys_pos;
+    }
+    Py_UNREACHABLE();
+}
+
+// Return the keys_pos stored at table_pos, or -1 if the table element is empty.
+static inline Py_ssize_t
+table_keys_pos(FAMObject *self, Py_ssize_t table_pos)
+{
+    return table_element_keys_pos(self->table, self->table_layout, table_pos);
+}
+
+// Return true if the key at keys_pos has been discarded. A discarded key remains in the keys and in
+// the table until compacted; lookups that find it treat it as not found.
+static inline bool
+key_discarded(FAMObject *self, Py_ssize_t keys_pos)
+{
+    Discarded *d = self->discarded;
+    return d && keys_pos < d->size && d->flags[keys_pos];
+}
+
+// During an incremental resize, exchange the table and the old table, such that the old table can
+// be probed with the functions used for the table. Called in pairs.
+static inline void
+table_swap_old(FAMObject *self)
+{
+    TableOld *to = self->table_old;
+    void *table = self->table;
+    Py_ssize_t size = self->table_size;
+    TableLayout layout = self->table_layout;
+    self->table = to->table;
+    self->table_size = to->size;
+    self->table_layout = to->layout;
+    to->table = table;
+    to->size = size;
+    to->layout = layout;
+}
+
+// Given a table_pos returned by a lookup_hash function, return the keys_pos stored there, or -1 if
+// the table_pos is an error or the table element is empty.
+static inline Py_ssize_t
+found_keys_pos(FAMObject *self, Py_ssize_t table_pos)
+{
+    if (table_pos < 0) {
+        return -1;
+    }
+    return table_keys_pos(self, table_pos);
+}
+
+// Return the value of the array key at keys_pos as stored in a TableElementInline.
+static inline InlineKey
+inline_key_at(FAMObject *self, Py_ssize_t keys_pos)
+{
+    void *p = PyArray_GETPTR1((PyArrayObject *)self->keys, keys_pos);
+    InlineKey k;
+    switch (self->keys_array_type) {
+        case KAT_INT32:
+            k.i = *(npy_int32*)p;
+            break;
+        case KAT_INT16:
+            k.i = *(npy_int16*)p;
+            break;
+        case KAT_INT8:
+            k.i = *(npy_int8*)p;
+            break;
+        case KAT_UINT64:
+            k.u = *(npy_uint64*)p;
+            break;
+        case KAT_UINT32:
+            k.u = *(npy_uint32*)p;
+            break;
+        case KAT_UINT16:
+            k.u = *(npy_uint16*)p;
+            break;
+        case KAT_UINT8:
+            k.u = *(npy_uint8*)p;
+            break;
+        case KAT_FLOAT64:
+            k.d = *(npy_double*)p;
+            break;
+        case KAT_FLOAT32:
+            k.d = *(npy_float*)p;
+            break;
+        case KAT_FLOAT16:
+            k.d = npy_half_to_double(*(npy_half*)p);
+            break;
+        default: // KAT_INT64 and all datetime64 KATs
+            k.i = *(npy_int64*)p;
+            break;
+    }
+    return k;
+}
+
+static inline void
+table_set(FAMObject *self, Py_ssize_t table_pos, Py_ssize_t keys_pos, Py_hash_t hash)
+{
+    switch (self->table_layout) {
+        case TL_WIDE: {
+            TableElement *te = (TableElement *)self->table + table_pos;
+            te->keys_pos = keys_pos;
+            te->hash = hash;
+            break;
+        }
+        case TL_COMPACT: {
+            TableElementCompact *te = (TableElementCompact *)self->table + table_pos;
+            te->keys_pos = (npy_int32)keys_pos;
+            te->hash = hash_tag(hash);
+            break;
+        }
+        case TL_POS:
+            ((npy_int32 *)self->table)[table_pos] = (npy_int32)keys_pos;
+            break;
+        case TL_INLINE: {
+            TableElementInline *te = (TableElementInline *)self->table + table_pos;
+            te->keys_pos = keys_pos;
+            te->key = inline_key_at(self, keys_pos);
+            break;
+        }
+    }
+}
+
+//------------------------------------------------------------------------------
+// range keys
+
+// For a FAM in KM_RANGE mode, return the keys_pos of `key`, or -1 if not found. Differences are
+// taken as unsigned so that ranges spanning the full int64 domain do not overflow.
+static inline Py_ssize_t
+range_keys_pos(FAMObject *self, npy_int64 key)
+{
+    npy_uint64 offset;
+    npy_uint64 step;
+    if (self->range_step > 0) {
+        if (key < self->range_start) {
+            return -1;
+        }
+        offset = (npy_uint64)key - (npy_uint64)self->range_start;
+        step = (npy_uint64)self->range_step;
+    }
+    else {
+        if (key > self->range_start) {
+            return -1;
+        }
+        offset = (npy_uint64)self->range_start - (npy_uint64)key;
+        step = (npy_uint64)0 - (npy_uint64)self->range_step;
+    }
+    if (step != 1) {
+        if (offset % step) {
+            return -1;
+        }
+        offset /= step;
+    }
+    return offset < (npy_uint64)self->keys_size ? (Py_ssize_t)offset : -1;
+}
+
+// If all KAT_UNICODE keys are latin-1, set keys_packed to a copy of the keys with one byte per
+// character, NULL padded as in the array. Keys are then hashed and compared as packed, reducing the
+// bytes read per key by four. As the array is kept for keys() and iteration, this is only done if
+// requested with `packed`. Returns 0 on success (whether or not keys are packed), -1 on error.
+static int
+packed_init(FAMObject *self)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    Py_ssize_t dt_size = PyArray_ITEMSIZE(a) / UCS4_SIZE;
+    char *packed = (char*)PyMem_Malloc(Py_MAX(self->keys_size * dt_size, 1));
+    if (!packed) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    char *p = packed;
+    for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+        if (!ucs4_to_latin1((Py_UCS4*)PyArray_GETPTR1(a, i), dt_size, p)) {
+            PyMem_Free(packed);
+            return 0;
+        }
+        p += dt_size;
+    }
+    self->keys_packed = packed;
+    return 0;
+}
+
+// For KAT_UNICODE and KAT_STRING keys, store the count of characters in each key in keys_lengths,
+// with 1, 2, or 4 bytes per length, such that keys are not scanned for their end. Must be called
+// after packed_init(). Returns 0 on success, -1 on error.
+static int
+lengths_init(FAMObject *self)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    bool unicode = self->keys_array_type == KAT_UNICODE;
+    Py_ssize_t dt_size = PyArray_ITEMSIZE(a);
+    if (unicode) {
+        dt_size /= UCS4_SIZE;
+    }
+    int width = dt_size <= UINT8_MAX ? 1 : dt_size <= UINT16_MAX ? 2 : 4;
+    void *lengths = PyMem_Malloc(Py_MAX(self->keys_size * width, 1));
+    if (!lengths) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    Py_ssize_t len;
+    for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+        if (self->keys_packed) {
+            char *k = self->keys_packed + i * dt_size;
+            len = char_get_end_p(k, dt_size) - k;
+        }
+        else if (unicode) {
+            Py_UCS4 *k = (Py_UCS4*)PyArray_GETPTR1(a, i);
+            len = ucs4_get_end_p(k, dt_size) - k;
+        }
+        else {
+            char *k = (char*)PyArray_GETPTR1(a, i);
+            len = char_get_end_p(k, dt_size) - k;
+        }
+        switch (width) {
+            case 1:
+                ((npy_uint8*)lengths)[i] = (npy_uint8)len;
+                break;
+            case 2:
+                ((npy_uint16*)lengths)[i] = (npy_uint16)len;
+                break;
+            default:
+                ((npy_uint32*)lengths)[i] = (npy_uint32)len;
+                break;
+        }
+    }
+    self->keys_lengths = lengths;
+    self->keys_lengths_width = width;
+    return 0;
+}
+
+// Return the count of characters in the KAT_UNICODE or KAT_STRING key at keys_pos.
+static inline Py_ssize_t
+key_length_at(FAMObject *self, Py_ssize_t keys_pos)
+{
+    switch (self->keys_lengths_width) {
+        case 1:
+            return ((npy_uint8*)self->keys_lengths)[keys_pos];
+        case 2:
+            return ((npy_uint16*)self->keys_lengths)[keys_pos];
+        default:
+            return ((npy_uint32*)self->keys_lengths)[keys_pos];
     }
-    return hash;
 }
 
+// Scan keys of `npy_type`, returning false from the enclosing function at the first key that does
+// not continue a strictly monotonic, constant-step range. The step must be representable as an
+// int64. Depends on a, keys_size, start, and step.
+# define RANGE_SCAN(npy_type)                                                  \
+{                                                                              \
+    npy_int64 prev = *(npy_type*)PyArray_GETPTR1(a, 1);                        \
+    start = *(npy_type*)PyArray_GETPTR1(a, 0);                                 \
+    step = (npy_int64)((npy_uint64)prev - (npy_uint64)start);                  \
+    bool ascending = prev > start;                                             \
+    if (prev == start || ascending != (step > 0)) {                            \
+        return false;                                                          \
+    }                                                                          \
+    npy_int64 k;                                                               \
+    for (Py_ssize_t i = 2; i < keys_size; i++) {                               \
+        k = *(npy_type*)PyArray_GETPTR1(a, i);                                 \
+        if ((k > prev) != ascending || (npy_int64)((npy_uint64)k - (npy_uint64)prev) != step) { \
+            return false;                                                      \
+        }                                                                      \
+        prev = k;                                                              \
+    }                                                                          \
+}                                                                              \
+
+// If the array keys of a FAM with a signed integer or datetime64 KAT form a range of constant step,
+// set KM_RANGE mode and return true. This is a single scan of the keys, stopping at the first key
+// that does not fit.
+static bool
+range_init(FAMObject *self)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    Py_ssize_t keys_size = self->keys_size;
+    if (keys_size < 2) {
+        return false;
+    }
+    npy_int64 start, step;
+    switch (self->keys_array_type) {
+        case KAT_LIST:
+        case KAT_UINT64:
+        case KAT_UINT32:
+        case KAT_UINT16:
+        case KAT_UINT8:
+        case KAT_FLOAT64:
+        case KAT_FLOAT32:
+        case KAT_FLOAT16:
+        case KAT_UNICODE:
+        case KAT_STRING:
+            return false;
+        case KAT_INT32:
+            RANGE_SCAN(npy_int32);
+            break;
+        case KAT_INT16:
+            RANGE_SCAN(npy_int16);
+            break;
+        case KAT_INT8:
+            RANGE_SCAN(npy_int8);
+            break;
+        default: // KAT_INT64 and all datetime64 KATs
+            RANGE_SCAN(npy_int64);
+            break;
+    }
+    self->keys_mode = KM_RANGE;
+    self->range_start = start;
+    self->range_step = step;
+    return true;
+}
+
+# undef RANGE_SCAN
+
+// For a FAM in KM_RANGE mode with a positive step, return the position of the first key not less
+// than `v`.
+static Py_ssize_t
+range_lower(FAMObject *self, npy_int64 v)
+{
+    if (v <= self->range_start) {
+        return 0;
+    }
+    npy_uint64 offset = (npy_uint64)v - (npy_uint64)self->range_start;
+    npy_uint64 step = (npy_uint64)self->range_step;
+    npy_uint64 pos = offset / step + (offset % step != 0);
+    return pos < (npy_uint64)self->keys_size ? (Py_ssize_t)pos : self->keys_size;
+}
+
+//------------------------------------------------------------------------------
+// sorted keys
+
+// Binary search the keys of `npy_type` for the first key not less than `v`. If `exact`, return that
+// position only if the key is equal to `v`, otherwise -1. Depends on self, a, v, and exact.
+# define SORTED_SEARCH(npy_type, post_deref)                                   \
+{                                                                              \
+    char *data = PyArray_BYTES(a);                                             \
+    npy_intp stride = PyArray_STRIDE(a, 0);                                    \
+    Py_ssize_t first = 0;                                                      \
+    Py_ssize_t len = self->keys_size;                                          \
+    Py_ssize_t half;                                                           \
+    while (len > 0) {                                                          \
+        half = len >> 1;                                                       \
+        if (post_deref(*(npy_type*)(data + (first + half) * stride)) < v) {    \
+            first += half + 1;                                                 \
+            len -= half + 1;                                                   \
+        }                                                                      \
+        else {                                                                 \
+            len = half;                                                        \
+        }                                                                      \
+    }                                                                          \
+    if (exact && (first == self->keys_size ||                                  \
+            post_deref(*(npy_type*)(data + first * stride)) != v)) {           \
+        return -1;                                                             \
+    }                                                                          \
+    return first;                                                              \
+}                                                                              \
+
+// Used for both integer and datetime types.
+static Py_ssize_t
+sorted_search_int(FAMObject *self, npy_int64 v, bool exact)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    switch (self->keys_array_type) {
+        case KAT_INT32:
+            SORTED_SEARCH(npy_int32,);
+        case KAT_INT16:
+            SORTED_SEARCH(npy_int16,);
+        case KAT_INT8:
+            SORTED_SEARCH(npy_int8,);
+        default: // KAT_INT64 and all datetime64 KATs
+            SORTED_SEARCH(npy_int64,);
+    }
+}
+
+static Py_ssize_t
+sorted_search_uint(FAMObject *self, npy_uint64 v, bool exact)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    switch (self->keys_array_type) {
+        case KAT_UINT32:
+            SORTED_SEARCH(npy_uint32,);
+        case KAT_UINT16:
+            SORTED_SEARCH(npy_uint16,);
+        case KAT_UINT8:
+            SORTED_SEARCH(npy_uint8,);
+        default:
+            SORTED_SEARCH(npy_uint64,);
+    }
+}
+
+static Py_ssize_t
+sorted_search_double(FAMObject *self, npy_double v, bool exact)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    switch (self->keys_array_type) {
+        case KAT_FLOAT32:
+            SORTED_SEARCH(npy_float,);
+        case KAT_FLOAT16:
+            SORTED_SEARCH(npy_half, npy_half_to_double);
+        default:
+            SORTED_SEARCH(npy_double,);
+    }
+}
+
+# undef SORTED_SEARCH
+
 //------------------------------------------------------------------------------
 // the global int_cache is shared among all instances
 
@@ -434,19 +1065,188 @@ int_cache_remove(Py_ssize_t key_count)
     if (!key_count) {
         Py_CLEAR(int_cache);
     }
-    else if (key_count < PyList_GET_SIZE(int_cache)) {
+    else if (int_cache && key_count < PyList_GET_SIZE(int_cache)) {
         // del int_cache[key_count:]
         PyList_SetSlice(int_cache, key_count, PyList_GET_SIZE(int_cache), NULL);
     }
 }
 
+// Return a new reference to the Python integer for `keys_pos`, taken from the int_cache when it has
+// been filled that far. An attached FAM does not fill the int_cache, as doing so is O(n) in time
+// and memory per process.
+static inline PyObject *
+int_cache_get(Py_ssize_t keys_pos)
+{
+    if (int_cache && keys_pos < PyList_GET_SIZE(int_cache)) {
+        PyObject *item = PyList_GET_ITEM(int_cache, keys_pos);
+        Py_INCREF(item);
+        return item;
+    }
+    return PyLong_FromSsize_t(keys_pos);
+}
+
+//------------------------------------------------------------------------------
+// atomic operations used for concurrent table construction
+
+// Concurrent insertion is only supported where we have compiler atomics; elsewhere, construction is
+// always serial.
+# if defined(__GNUC__) || defined(__clang__)
+# define AM_ATOMICS 1
+static inline Py_ssize_t
+atomic_load_ssize(Py_ssize_t *p) {
+    return __atomic_load_n(p, __ATOMIC_ACQUIRE);
+}
+static inline void
+atomic_store_ssize(Py_ssize_t *p, Py_ssize_t v) {
+    __atomic_store_n(p, v, __ATOMIC_RELEASE);
+}
+static inline bool
+atomic_cas_ssize(Py_ssize_t *p, Py_ssize_t expected, Py_ssize_t desired) {
+    return __atomic_compare_exchange_n(
+            p, &expected, desired, false, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE);
+}
+static inline npy_int32
+atomic_load_int32(npy_int32 *p) {
+    return __atomic_load_n(p, __ATOMIC_ACQUIRE);
+}
+static inline void
+atomic_store_int32(npy_int32 *p, npy_int32 v) {
+    __atomic_store_n(p, v, __ATOMIC_RELEASE);
+}
+static inline bool
+atomic_cas_int32(npy_int32 *p, npy_int32 expected, npy_int32 desired) {
+    return __atomic_compare_exchange_n(
+            p, &expected, desired, false, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE);
+}
+# elif defined(_MSC_VER)
+# define AM_ATOMICS 1
+# include <intrin.h>
+# if SIZEOF_SIZE_T == 8
+# define AM_INTERLOCKED_CAS(p, d, e) _InterlockedCompareExchange64((volatile __int64 *)(p), (d), (e))
+# define AM_INTERLOCKED_EXCHANGE(p, v) _InterlockedExchange64((volatile __int64 *)(p), (v))
+# else
+# define AM_INTERLOCKED_CAS(p, d, e) _InterlockedCompareExchange((volatile long *)(p), (d), (e))
+# define AM_INTERLOCKED_EXCHANGE(p, v) _InterlockedExchange((volatile long *)(p), (v))
+# endif
+static inline Py_ssize_t
+atomic_load_ssize(Py_ssize_t *p) {
+    // a CAS that never changes the value provides a full barrier on all MSVC targets
+    return (Py_ssize_t)AM_INTERLOCKED_CAS(p, 0, 0);
+}
+static inline void
+atomic_store_ssize(Py_ssize_t *p, Py_ssize_t v) {
+    AM_INTERLOCKED_EXCHANGE(p, v);
+}
+static inline bool
+atomic_cas_ssize(Py_ssize_t *p, Py_ssize_t expected, Py_ssize_t desired) {
+    return AM_INTERLOCKED_CAS(p, desired, expected) == expected;
+}
+static inline npy_int32
+atomic_load_int32(npy_int32 *p) {
+    return (npy_int32)_InterlockedCompareExchange((volatile long *)p, 0, 0);
+}
+static inline void
+atomic_store_int32(npy_int32 *p, npy_int32 v) {
+    _InterlockedExchange((volatile long *)p, v);
+}
+static inline bool
+atomic_cas_int32(npy_int32 *p, npy_int32 expected, npy_int32 desired) {
+    return _InterlockedCompareExchange((volatile long *)p, desired, expected) == expected;
+}
+# else
+# define AM_ATOMICS 0
+# endif
+
+//------------------------------------------------------------------------------
+// threaded execution
+
+// Minimum count of keys given to each thread when building or searching a table with threads.
+# define THREAD_MIN_KEYS 4096
+// Minimum count of keys for which a batched lookup will release the GIL.
+# define THREAD_RELEASE_MIN_KEYS 512
+
+typedef void (*WorkerFunc)(void *);
+
+typedef struct WorkerState {
+    WorkerFunc func;
+    void *arg;
+    PyThread_type_lock done; // held until func returns
+} WorkerState;
+
+static void
+worker_run(void *state)
+{
+    WorkerState *ws = (WorkerState *)state;
+    ws->func(ws->arg);
+    PyThread_release_lock(ws->done);
+}
+
+// Call `func` once for each of `count` arguments, `arg_size` bytes apart in `args`, the first on
+// the calling thread and the others on new threads. The GIL is released while `func` runs, so
+// `func` must not use the Python C-API. Returns 0 on success, -1 on error.
+static int
+run_threaded(WorkerFunc func, char *args, Py_ssize_t arg_size, Py_ssize_t count)
+{
+    WorkerState *states = PyMem_New(WorkerState, count);
+    if (!states) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    Py_ssize_t i;
+    for (i = 0; i < count; i++) {
+        states[i].func = func;
+        states[i].arg = args + i * arg_size;
+        states[i].done = NULL;
+    }
+    // start workers for all but the first argument
+    for (i = 1; i < count; i++) {
+        PyThread_type_lock done = PyThread_allocate_lock();
+        if (!done) {
+            continue; // will run on this thread
+        }
+        PyThread_acquire_lock(done, NOWAIT_LOCK);
+        states[i].done = done;
+        if (PyThread_start_new_thread(worker_run, &states[i]) == PYTHREAD_INVALID_THREAD_ID) {
+            PyThread_free_lock(done);
+            states[i].done = NULL;
+        }
+    }
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < count; i++) {
+        if (!states[i].done) {
+            func(states[i].arg);
+        }
+    }
+    for (i = 1; i < count; i++) {
+        if (states[i].done) {
+            PyThread_acquire_lock(states[i].done, WAIT_LOCK);
+            PyThread_release_lock(states[i].done);
+            PyThread_free_lock(states[i].done);
+        }
+    }
+    Py_END_ALLOW_THREADS
+    PyMem_Del(states);
+    return 0;
+}
+
+// Given a requested number of threads and the count of items to process, return the number of
+// threads to use such that each thread gets at least `min_per_thread` items.
+static Py_ssize_t
+threads_for_size(Py_ssize_t threads, Py_ssize_t size, Py_ssize_t min_per_thread)
+{
+    Py_ssize_t limit = size / min_per_thread;
+    if (threads > limit) {
+        threads = limit;
+    }
+    return threads < 1 ? 1 : threads;
+}
+
 //------------------------------------------------------------------------------
 // FrozenAutoMapIterator functions
 
 typedef struct FAMIObject {
     PyObject_HEAD
     FAMObject *fam;
-    PyArrayObject* keys_array;
     ViewKind kind;
     bool reversed;
     Py_ssize_t index; // current index state, mutated in-place
@@ -466,43 +1266,54 @@ fami_iter(FAMIObject *self)
     return self;
 }
 
-// For a FAMI, Return appropriate PyObject for items, keys, and values. When values are needed they are retrieved from the int_cache. For consistency with NumPy array iteration, arrays use PyArray_ToScalar instead of PyArray_GETITEM.
+// For a FAMI, Return appropriate PyObject for items, keys, and values. When values are needed they
+// are retrieved from the int_cache. For consistency with NumPy array iteration, arrays use
+// PyArray_ToScalar instead of PyArray_GETITEM. Discarded keys are skipped.
 static PyObject *
 fami_iternext(FAMIObject *self)
 {
     Py_ssize_t index;
-    if (self->reversed) {
-        index = self->fam->keys_size - ++self->index;
-        if (index < 0) {
+    do {
+        if (self->reversed) {
+            index = self->fam->keys_size - ++self->index;
+            if (index < 0) {
+                return NULL;
+            }
+        }
+        else {
+            index = self->index++;
+        }
+        if (self->fam->keys_size <= index) {
             return NULL;
         }
-    }
-    else {
-        index = self->index++;
-    }
-    if (self->fam->keys_size <= index) {
-        return NULL;
-    }
+    } while (key_discarded(self->fam, index));
+    // an AutoMap might replace its keys while iterating
+    PyArrayObject *keys_array = (PyArrayObject *)self->fam->keys;
     switch (self->kind) {
         case ITEMS: {
             if (self->fam->keys_array_type) {
-                return PyTuple_Pack(
-                    2,
-                    PyArray_ToScalar(PyArray_GETPTR1(self->keys_array, index), self->keys_array),
-                    PyList_GET_ITEM(int_cache, index)
-                );
+                PyObject *key = PyArray_ToScalar(PyArray_GETPTR1(keys_array, index), keys_array);
+                if (!key) {
+                    return NULL;
+                }
+                PyObject *value = int_cache_get(index);
+                if (!value) {
+                    Py_DECREF(key);
+                    return NULL;
+                }
+                return Py_BuildValue("NN", key, value);
             }
             else {
-                return PyTuple_Pack(
-                    2,
-                    PyList_GET_ITEM(self->fam->keys, index),
-                    PyList_GET_ITEM(int_cache, index)
-                );
+                PyObject *value = int_cache_get(index);
+                if (!value) {
+                    return NULL;
+                }
+                return Py_BuildValue("ON", PyList_GET_ITEM(self->fam->keys, index), value);
             }
         }
         case KEYS: {
             if (self->fam->keys_array_type) {
-                return PyArray_ToScalar(PyArray_GETPTR1(self->keys_array, index), self->keys_array);
+                return PyArray_ToScalar(PyArray_GETPTR1(keys_array, index), keys_array);
             }
             else {
                 PyObject* yield = PyList_GET_ITEM(self->fam->keys, index);
@@ -511,9 +1322,7 @@ fami_iternext(FAMIObject *self)
             }
         }
         case VALUES: {
-            PyObject *yield = PyList_GET_ITEM(int_cache, index);
-            Py_INCREF(yield);
-            return yield;
+            return int_cache_get(index);
         }
     }
     Py_UNREACHABLE();
@@ -559,12 +1368,6 @@ fami_new(FAMObject *fam, ViewKind kind, bool reversed)
     }
     Py_INCREF(fam);
     fami->fam = fam;
-    if (fam->keys_array_type) {
-        fami->keys_array = (PyArrayObject *)fam->keys;
-    }
-    else {
-        fami->keys_array = NULL;
-    }
     fami->kind = kind;
     fami->reversed = reversed;
     fami->index = 0;
@@ -649,10 +1452,12 @@ famv_fami_new(FAMVObject *self)
     return fami_new(self->fam, self->kind, false);
 }
 
+static Py_ssize_t fam_length(FAMObject *);
+
 static PyObject *
 famv_length_hint(FAMVObject *self)
 {
-    return PyLong_FromSsize_t(self->fam->keys_size);
+    return PyLong_FromSsize_t(fam_length(self->fam));
 }
 
 static PyObject *
@@ -768,51 +1573,110 @@ lookup_hash_obj(FAMObject *self, PyObject *key, Py_hash_t hash)
 }
 
 
-// Used for both integer and datetime types; for this reason kat is passed in separately.
+// Probe the table for `hash`, returning the first table_pos that is empty or holds a key for which
+// `match` is true, where `kp` is the keys_pos of the stored key. Any stored hash is compared first.
+// Depends on self, hash, and kp.
+# define PROBE_TABLE(match)                                                   \
+{                                                                             \
+    Py_ssize_t mask = self->table_size - 1;                                   \
+    Py_hash_t mixin = Py_ABS(hash);                                           \
+    Py_ssize_t table_pos = hash & mask; /* taking the modulo */               \
+    Py_ssize_t i;                                                             \
+    switch (self->table_layout) {                                             \
+        case TL_WIDE: {                                                       \
+            TableElement *table = (TableElement *)self->table;                \
+            while (1) {                                                       \
+                for (i = 0; i < SCAN; i++) {                                  \
+                    kp = table[table_pos].keys_pos;                           \
+                    if (kp == -1) { /* Miss. Position that can be used for insertion. */ \
+                        return table_pos;                                     \
+                    }                                                         \
+                    if (table[table_pos].hash == hash && (match)) {           \
+                        return table_pos;                                     \
+                    }                                                         \
+                    table_pos++;                                              \
+                }                                                             \
+                table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask; \
+            }                                                                 \
+        }                                                                     \
+        case TL_COMPACT: {                                                    \
+            TableElementCompact *table = (TableElementCompact *)self->table;  \
+            npy_uint32 tag = hash_tag(hash);                                  \
+            while (1) {                                                       \
+                for (i = 0; i < SCAN; i++) {                                  \
+                    kp = table[table_pos].keys_pos;                           \
+                    if (kp == -1) {                                           \
+                        return table_pos;                                     \
+                    }                                                         \
+                    if (table[table_pos].hash == tag && (match)) {            \
+                        return table_pos;                                     \
+                    }                                                         \
+                    table_pos++;                                              \
+                }                                                             \
+                table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask; \
+            }                                                                 \
+        }                                                                     \
+        case TL_POS: {                                                        \
+            npy_int32 *table = (npy_int32 *)self->table;                      \
+            while (1) {                                                       \
+                for (i = 0; i < SCAN; i++) {                                  \
+                    kp = table[table_pos];                                    \
+                    if (kp == -1) {                                           \
+                        return table_pos;                                     \
+                    }                                                         \
+                    if (match) {                                              \
+                        return table_pos;                                     \
+                    }                                                         \
+                    table_pos++;                                              \
+                }                                                             \
+                table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask; \
+            }                                                                 \
+        }                                                                     \
+        default: /* TL_INLINE is probed with PROBE_INLINE */                  \
+            break;                                                            \
+    }                                                                         \
+    return -1;                                                                \
+}                                                                             \
+
+// Probe a TL_INLINE table for `key`, comparing it to the stored key `field` of the InlineKey union.
+// Depends on self, key, and hash.
+# define PROBE_INLINE(field)                                                  \
+{                                                                             \
+    Py_ssize_t mask = self->table_size - 1;                                   \
+    Py_hash_t mixin = Py_ABS(hash);                                           \
+    Py_ssize_t table_pos = hash & mask;                                       \
+    TableElementInline *table = (TableElementInline *)self->table;            \
+    while (1) {                                                               \
+        for (Py_ssize_t i = 0; i < SCAN; i++) {                               \
+            if (table[table_pos].keys_pos == -1 || table[table_pos].key.field == key) { \
+                return table_pos;                                             \
+            }                                                                 \
+            table_pos++;                                                      \
+        }                                                                     \
+        table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask;      \
+    }                                                                         \
+}                                                                             \
+
+
+// Used for both integer and datetime types; for this reason kat is passed in separately. The type
+// of stored keys is selected once, outside of the probe loop.
 static Py_ssize_t
 lookup_hash_int(FAMObject *self, npy_int64 key, Py_hash_t hash, KeysArrayType kat)
 {
-    TableElement *table = self->table;
-    Py_ssize_t mask = self->table_size - 1;
-    Py_hash_t mixin = Py_ABS(hash);
-    Py_ssize_t table_pos = hash & mask; // taking the modulo
-
+    if (self->table_layout == TL_INLINE) {
+        PROBE_INLINE(i);
+    }
     PyArrayObject *a = (PyArrayObject *)self->keys;
-    npy_int64 k = 0;
-    Py_hash_t h = 0;
-
-    while (1) {
-        for (Py_ssize_t i = 0; i < SCAN; i++) {
-            h = table[table_pos].hash;
-            if (h == -1) { // Miss. Position that can be used for insertion.
-                return table_pos;
-            }
-            if (h != hash) {
-                table_pos++;
-                continue;
-            }
-            switch (kat) {
-                case KAT_INT64:
-                    k = *(npy_int64*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                case KAT_INT32:
-                    k = *(npy_int32*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                case KAT_INT16:
-                    k = *(npy_int16*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                case KAT_INT8:
-                    k = *(npy_int8*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                default:
-                    return -1;
-            }
-            if (key == k) {
-                return table_pos;
-            }
-            table_pos++;
-        }
-        table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask;
+    Py_ssize_t kp;
+    switch (kat) {
+        case KAT_INT32:
+            PROBE_TABLE(*(npy_int32*)PyArray_GETPTR1(a, kp) == key);
+        case KAT_INT16:
+            PROBE_TABLE(*(npy_int16*)PyArray_GETPTR1(a, kp) == key);
+        case KAT_INT8:
+            PROBE_TABLE(*(npy_int8*)PyArray_GETPTR1(a, kp) == key);
+        default: // KAT_INT64 and all datetime64 KATs
+            PROBE_TABLE(*(npy_int64*)PyArray_GETPTR1(a, kp) == key);
     }
 }
 
@@ -821,47 +1685,20 @@ lookup_hash_int(FAMObject *self, npy_int64 key, Py_hash_t hash, KeysArrayType ka
 static Py_ssize_t
 lookup_hash_uint(FAMObject *self, npy_uint64 key, Py_hash_t hash, KeysArrayType kat)
 {
-    TableElement *table = self->table;
-    Py_ssize_t mask = self->table_size - 1;
-    Py_hash_t mixin = Py_ABS(hash);
-    Py_ssize_t table_pos = hash & mask;
-
+    if (self->table_layout == TL_INLINE) {
+        PROBE_INLINE(u);
+    }
     PyArrayObject *a = (PyArrayObject *)self->keys;
-    npy_uint64 k = 0;
-    Py_hash_t h = 0;
-
-    while (1) {
-        for (Py_ssize_t i = 0; i < SCAN; i++) {
-            h = table[table_pos].hash;
-            if (h == -1) {
-                return table_pos;
-            }
-            if (h != hash) {
-                table_pos++;
-                continue;
-            }
-            switch (kat) {
-                case KAT_UINT64:
-                    k = *(npy_uint64*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                case KAT_UINT32:
-                    k = *(npy_uint32*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                case KAT_UINT16:
-                    k = *(npy_uint16*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                case KAT_UINT8:
-                    k = *(npy_uint8*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                default:
-                    return -1;
-            }
-            if (key == k) {
-                return table_pos;
-            }
-            table_pos++;
-        }
-        table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask;
+    Py_ssize_t kp;
+    switch (kat) {
+        case KAT_UINT32:
+            PROBE_TABLE(*(npy_uint32*)PyArray_GETPTR1(a, kp) == key);
+        case KAT_UINT16:
+            PROBE_TABLE(*(npy_uint16*)PyArray_GETPTR1(a, kp) == key);
+        case KAT_UINT8:
+            PROBE_TABLE(*(npy_uint8*)PyArray_GETPTR1(a, kp) == key);
+        default:
+            PROBE_TABLE(*(npy_uint64*)PyArray_GETPTR1(a, kp) == key);
     }
 }
 
@@ -870,44 +1707,18 @@ lookup_hash_uint(FAMObject *self, npy_uint64 key, Py_hash_t hash, KeysArrayType
 static Py_ssize_t
 lookup_hash_double(FAMObject *self, npy_double key, Py_hash_t hash, KeysArrayType kat)
 {
-    TableElement *table = self->table;
-    Py_ssize_t mask = self->table_size - 1;
-    Py_hash_t mixin = Py_ABS(hash);
-    Py_ssize_t table_pos = hash & mask;
-
+    if (self->table_layout == TL_INLINE) {
+        PROBE_INLINE(d);
+    }
     PyArrayObject *a = (PyArrayObject *)self->keys;
-    npy_double k = 0;
-    Py_hash_t h = 0;
-
-    while (1) {
-        for (Py_ssize_t i = 0; i < SCAN; i++) {
-            h = table[table_pos].hash;
-            if (h == -1) {
-                return table_pos;
-            }
-            if (h != hash) {
-                table_pos++;
-                continue;
-            }
-            switch (kat) {
-                case KAT_FLOAT64:
-                    k = *(npy_double*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                case KAT_FLOAT32:
-                    k = *(npy_float*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-                    break;
-                case KAT_FLOAT16:
-                    k = npy_half_to_double(*(npy_half*)PyArray_GETPTR1(a, table[table_pos].keys_pos));
-                    break;
-                default:
-                    return -1;
-            }
-            if (key == k) {
-                return table_pos;
-            }
-            table_pos++;
-        }
-        table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask;
+    Py_ssize_t kp;
+    switch (kat) {
+        case KAT_FLOAT32:
+            PROBE_TABLE(*(npy_float*)PyArray_GETPTR1(a, kp) == key);
+        case KAT_FLOAT16:
+            PROBE_TABLE(npy_half_to_double(*(npy_half*)PyArray_GETPTR1(a, kp)) == key);
+        default:
+            PROBE_TABLE(*(npy_double*)PyArray_GETPTR1(a, kp) == key);
     }
 }
 
@@ -920,37 +1731,11 @@ lookup_hash_unicode(
         Py_ssize_t key_size,
         Py_hash_t hash)
 {
-    TableElement *table = self->table;
-    Py_ssize_t mask = self->table_size - 1;
-    Py_hash_t mixin = Py_ABS(hash);
-    Py_ssize_t table_pos = hash & mask;
-
     PyArrayObject *a = (PyArrayObject *)self->keys;
-    Py_ssize_t dt_size = PyArray_ITEMSIZE(a) / UCS4_SIZE;
-    Py_ssize_t cmp_bytes = Py_MIN(key_size, dt_size) * UCS4_SIZE;
-
-    Py_hash_t h = 0;
-    Py_UCS4* p_start = NULL;
-
-    while (1) {
-        for (Py_ssize_t i = 0; i < SCAN; i++) {
-            h = table[table_pos].hash;
-            if (h == -1) {
-                return table_pos;
-            }
-            if (h != hash) {
-                table_pos++;
-                continue;
-            }
-            p_start = (Py_UCS4*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-            // memcmp returns 0 on match
-            if (!memcmp(p_start, key, cmp_bytes)) {
-                return table_pos;
-            }
-            table_pos++;
-        }
-        table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask;
-    }
+    Py_ssize_t cmp_bytes = key_size * UCS4_SIZE;
+    Py_ssize_t kp;
+    // memcmp returns 0 on match
+    PROBE_TABLE(key_length_at(self, kp) == key_size && !memcmp(PyArray_GETPTR1(a, kp), key, cmp_bytes));
 }
 
 
@@ -962,63 +1747,175 @@ lookup_hash_string(
         Py_ssize_t key_size,
         Py_hash_t hash)
 {
-    TableElement *table = self->table;
-    Py_ssize_t mask = self->table_size - 1;
-    Py_hash_t mixin = Py_ABS(hash);
-    Py_ssize_t table_pos = hash & mask;
-
     PyArrayObject *a = (PyArrayObject *)self->keys;
-    Py_ssize_t dt_size = PyArray_ITEMSIZE(a);
-    Py_ssize_t cmp_bytes = Py_MIN(key_size, dt_size);
+    Py_ssize_t kp;
+    PROBE_TABLE(key_length_at(self, kp) == key_size && !memcmp(PyArray_GETPTR1(a, kp), key, key_size));
+}
 
-    Py_hash_t h = 0;
-    char* p_start = NULL;
 
-    while (1) {
-        for (Py_ssize_t i = 0; i < SCAN; i++) {
-            h = table[table_pos].hash;
-            if (h == -1) {
-                return table_pos;
-            }
-            if (h != hash) {
-                table_pos++;
-                continue;
-            }
-            p_start = (char*)PyArray_GETPTR1(a, table[table_pos].keys_pos);
-            // memcmp returns 0 on match
-            if (!memcmp(p_start, key, cmp_bytes)) {
-                return table_pos;
-            }
-            table_pos++;
-        }
-        table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask;
-    }
+// Compare a passed latin-1 char array to the packed copy of KAT_UNICODE keys. This does not use any
+// dynamic memory. Returns -1 on error.
+static Py_ssize_t
+lookup_hash_packed(
+        FAMObject *self,
+        char* key,
+        Py_ssize_t key_size,
+        Py_hash_t hash)
+{
+    Py_ssize_t dt_size = PyArray_ITEMSIZE((PyArrayObject *)self->keys) / UCS4_SIZE;
+    char *packed = self->keys_packed;
+    Py_ssize_t kp;
+    PROBE_TABLE(key_length_at(self, kp) == key_size && !memcmp(packed + kp * dt_size, key, key_size));
 }
 
+# undef PROBE_TABLE
+# undef PROBE_INLINE
 
-static Py_ssize_t
-lookup_int(FAMObject *self, PyObject* key) {
-    npy_int64 v = 0;
-    // NOTE: we handle PyArray Scalar Byte, Short, UByte, UShort with PyNumber_Check, below, saving four branches here
-    if (PyArray_IsScalar(key, LongLong)) {
-        v = (npy_int64)PyArrayScalar_VAL(key, LongLong);
+
+// Each of the following converts a key to the type of the stored keys, returning false if the key
+// cannot match any stored key. They are used for both scalar and array lookups, so that both match
+// the same keys.
+static inline bool
+key_to_int(npy_int64 src, npy_int64 *dst) {
+    *dst = src;
+    return true;
+}
+
+static inline bool
+key_uint_to_int(npy_uint64 src, npy_int64 *dst) {
+    *dst = (npy_int64)src;
+    return src <= NPY_MAX_INT64;
+}
+
+// NaN, which is not equal to its floor, and values out of range of int64 do not match.
+static inline bool
+key_double_to_int(npy_double src, npy_int64 *dst) {
+    if (floor(src) != src || src < -0x1p63 || src >= 0x1p63) {
+        *dst = 0;
+        return false;
     }
-    else if (PyArray_IsScalar(key, Long)) {
-        v = (npy_int64)PyArrayScalar_VAL(key, Long);
+    *dst = (npy_int64)src;
+    return true;
+}
+
+static inline bool
+key_half_to_int(npy_half src, npy_int64 *dst) {
+    return key_double_to_int(npy_half_to_double(src), dst);
+}
+
+// For datetime64 keys of a unit other than that of the stored keys; as in lookup_datetime(), only
+// NaT can match.
+static inline bool
+key_nat_to_int(npy_int64 src, npy_int64 *dst) {
+    *dst = src;
+    return src == NPY_DATETIME_NAT;
+}
+
+static inline bool
+key_to_uint(npy_uint64 src, npy_uint64 *dst) {
+    *dst = src;
+    return true;
+}
+
+static inline bool
+key_int_to_uint(npy_int64 src, npy_uint64 *dst) {
+    *dst = (npy_uint64)src;
+    return src >= 0;
+}
+
+static inline bool
+key_double_to_uint(npy_double src, npy_uint64 *dst) {
+    if (floor(src) != src || src < 0 || src >= 0x1p64) {
+        *dst = 0;
+        return false;
     }
-    else if (PyLong_Check(key)) {
-        v = PyLong_AsLongLong(key);
-        if (v == -1 && PyErr_Occurred()) {
-            PyErr_Clear();
+    *dst = (npy_uint64)src;
+    return true;
+}
+
+static inline bool
+key_half_to_uint(npy_half src, npy_uint64 *dst) {
+    return key_double_to_uint(npy_half_to_double(src), dst);
+}
+
+// Signed and unsigned integers are converted to double, as in lookup_double().
+static inline bool
+key_to_double(npy_double src, npy_double *dst) {
+    *dst = src;
+    return true;
+}
+
+static inline bool
+key_half_to_double(npy_half src, npy_double *dst) {
+    *dst = npy_half_to_double(src);
+    return true;
+}
+
+static Py_ssize_t
+lookup_table(FAMObject *self, PyObject *key);
+
+// For a number that numeric lookups cannot convert, such as a complex or timedelta64, look up its
+// real value, and return the key found only if it compares equal to `key`, as with list keys.
+// Returns -1 on key not found or error, without setting an exception.
+static Py_ssize_t
+lookup_number_equal(FAMObject *self, PyObject *key) {
+    PyObject *v;
+    if (PyComplex_Check(key) || PyArray_IsScalar(key, ComplexFloating)) {
+        v = PyObject_GetAttrString(key, "real");
+    }
+    else if (PyArray_IsScalar(key, Timedelta)) {
+        v = PyLong_FromLongLong(PyArrayScalar_VAL(key, Timedelta));
+    }
+    else {
+        v = PyNumber_Float(key);
+    }
+    if (!v) {
+        PyErr_Clear();
+        return -1;
+    }
+    Py_ssize_t keys_pos = lookup_table(self, v);
+    Py_DECREF(v);
+    if (keys_pos < 0) {
+        PyErr_Clear();
+        return -1;
+    }
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    PyObject *k = PyArray_ToScalar(PyArray_GETPTR1(a, keys_pos), a);
+    if (!k) {
+        PyErr_Clear();
+        return -1;
+    }
+    int eq = PyObject_RichCompareBool(k, key, Py_EQ);
+    Py_DECREF(k);
+    if (eq <= 0) {
+        PyErr_Clear();
+        return -1;
+    }
+    return keys_pos;
+}
+
+
+static Py_ssize_t
+lookup_int(FAMObject *self, PyObject* key) {
+    npy_int64 v = 0;
+    // NOTE: we handle PyArray Scalar Byte, Short, UByte, UShort with PyNumber_Check, below, saving four branches here
+    if (PyArray_IsScalar(key, LongLong)) {
+        v = (npy_int64)PyArrayScalar_VAL(key, LongLong);
+    }
+    else if (PyArray_IsScalar(key, Long)) {
+        v = (npy_int64)PyArrayScalar_VAL(key, Long);
+    }
+    else if (PyLong_Check(key)) {
+        v = PyLong_AsLongLong(key);
+        if (v == -1 && PyErr_Occurred()) {
+            PyErr_Clear();
             return -1;
         }
     }
     else if (PyArray_IsScalar(key, Double)) {
-        double dv = PyArrayScalar_VAL(key, Double);
-        if (floor(dv) != dv) {
+        if (!key_double_to_int(PyArrayScalar_VAL(key, Double), &v)) {
             return -1;
         }
-        v = (npy_int64)dv;
     }
     else if (PyFloat_Check(key)) {
         double dv = PyFloat_AsDouble(key);
@@ -1026,16 +1923,23 @@ lookup_int(FAMObject *self, PyObject* key) {
             PyErr_Clear();
             return -1;
         }
-        v = (npy_int64)dv; // truncate to integer
-        if (v != dv) {
+        if (!key_double_to_int(dv, &v)) {
             return -1;
         }
     }
     else if (PyArray_IsScalar(key, ULongLong)) {
-        v = (npy_int64)PyArrayScalar_VAL(key, ULongLong);
+        npy_ulonglong uv = PyArrayScalar_VAL(key, ULongLong);
+        if (uv > NPY_MAX_INT64) { // as in batch lookups, not equal to any signed key
+            return -1;
+        }
+        v = (npy_int64)uv;
     }
     else if (PyArray_IsScalar(key, ULong)) {
-        v = (npy_int64)PyArrayScalar_VAL(key, ULong);
+        npy_ulong uv = PyArrayScalar_VAL(key, ULong);
+        if (uv > NPY_MAX_INT64) {
+            return -1;
+        }
+        v = (npy_int64)uv;
     }
     else if (PyArray_IsScalar(key, Int)) {
         v = (npy_int64)PyArrayScalar_VAL(key, Int);
@@ -1044,18 +1948,14 @@ lookup_int(FAMObject *self, PyObject* key) {
         v = (npy_int64)PyArrayScalar_VAL(key, UInt);
     }
     else if (PyArray_IsScalar(key, Float)) {
-        double dv = (double)PyArrayScalar_VAL(key, Float);
-        if (floor(dv) != dv) {
+        if (!key_double_to_int((double)PyArrayScalar_VAL(key, Float), &v)) {
             return -1;
         }
-        v = (npy_int64)dv;
     }
     else if (PyArray_IsScalar(key, Half)) {
-        double dv = npy_half_to_double(PyArrayScalar_VAL(key, Half));
-        if (floor(dv) != dv) {
+        if (!key_half_to_int(PyArrayScalar_VAL(key, Half), &v)) {
             return -1;
         }
-        v = (npy_int64)dv;
     }
     else if (PyBool_Check(key)) {
         v = PyObject_IsTrue(key);
@@ -1064,14 +1964,21 @@ lookup_int(FAMObject *self, PyObject* key) {
         // NOTE: this returns a Py_ssize_t, which might be 32 bit. This can be used for PyArray_Scalars <= ssize_t.
         v = (npy_int64)PyNumber_AsSsize_t(key, PyExc_OverflowError);
         if (v == -1 && PyErr_Occurred()) {
-            return -1;
+            PyErr_Clear();
+            return lookup_number_equal(self, key);
         }
     }
     else {
         return -1;
     }
+    if (self->keys_mode == KM_RANGE) {
+        return range_keys_pos(self, v);
+    }
+    if (self->keys_mode == KM_SORTED) {
+        return sorted_search_int(self, v, true);
+    }
     Py_hash_t hash = int_to_hash(v);
-    return lookup_hash_int(self, v, hash, self->keys_array_type);
+    return found_keys_pos(self, lookup_hash_int(self, v, hash, self->keys_array_type));
 }
 
 
@@ -1094,8 +2001,14 @@ lookup_datetime(FAMObject *self, PyObject* key) {
     else {
         return -1;
     }
+    if (self->keys_mode == KM_RANGE) {
+        return range_keys_pos(self, v);
+    }
+    if (self->keys_mode == KM_SORTED) {
+        return sorted_search_int(self, v, true);
+    }
     Py_hash_t hash = int_to_hash(v);
-    return lookup_hash_int(self, v, hash, KAT_INT64);
+    return found_keys_pos(self, lookup_hash_int(self, v, hash, KAT_INT64));
 }
 
 
@@ -1132,11 +2045,9 @@ lookup_uint(FAMObject *self, PyObject* key) {
         }
     }
     else if (PyArray_IsScalar(key, Double)) {
-        double dv = PyArrayScalar_VAL(key, Double);
-        if (dv < 0 || floor(dv) != dv) {
+        if (!key_double_to_uint(PyArrayScalar_VAL(key, Double), &v)) {
             return -1;
         }
-        v = (npy_uint64)dv;
     }
     else if (PyFloat_Check(key)) {
         double dv = PyFloat_AsDouble(key);
@@ -1144,11 +2055,7 @@ lookup_uint(FAMObject *self, PyObject* key) {
             PyErr_Clear();
             return -1;
         }
-        if (dv < 0) {
-            return -1;
-        }
-        v = (npy_uint64)dv; // truncate to integer
-        if (v != dv) {
+        if (!key_double_to_uint(dv, &v)) {
             return -1;
         }
     }
@@ -1163,18 +2070,14 @@ lookup_uint(FAMObject *self, PyObject* key) {
         v = (npy_uint64)PyArrayScalar_VAL(key, UInt);
     }
     else if (PyArray_IsScalar(key, Float)) {
-        double dv = (double)PyArrayScalar_VAL(key, Float);
-        if (dv < 0 || floor(dv) != dv) {
+        if (!key_double_to_uint((double)PyArrayScalar_VAL(key, Float), &v)) {
             return -1;
         }
-        v = (npy_uint64)dv;
     }
     else if (PyArray_IsScalar(key, Half)) {
-        double dv = npy_half_to_double(PyArrayScalar_VAL(key, Half));
-        if (dv < 0 || floor(dv) != dv) {
+        if (!key_half_to_uint(PyArrayScalar_VAL(key, Half), &v)) {
             return -1;
         }
-        v = (npy_uint64)dv;
     }
     else if (PyBool_Check(key)) {
         v = PyObject_IsTrue(key);
@@ -1184,7 +2087,7 @@ lookup_uint(FAMObject *self, PyObject* key) {
         npy_int64 si = PyNumber_AsSsize_t(key, PyExc_OverflowError);
         if (si == -1 && PyErr_Occurred()) {
             PyErr_Clear();
-            return -1;
+            return lookup_number_equal(self, key);
         }
         if (si < 0) {
             return -1;
@@ -1194,7 +2097,10 @@ lookup_uint(FAMObject *self, PyObject* key) {
     else {
         return -1;
     }
-    return lookup_hash_uint(self, v, uint_to_hash(v), self->keys_array_type);
+    if (self->keys_mode == KM_SORTED) {
+        return sorted_search_uint(self, v, true);
+    }
+    return found_keys_pos(self, lookup_hash_uint(self, v, uint_to_hash(v), self->keys_array_type));
 }
 
 
@@ -1251,14 +2157,17 @@ lookup_double(FAMObject *self, PyObject* key) {
             npy_int64 si = PyNumber_AsSsize_t(key, PyExc_OverflowError);
             if (si == -1 && PyErr_Occurred()) {
                 PyErr_Clear();
-                return -1;
+                return lookup_number_equal(self, key);
             }
             v = (double)si;
         }
         else {
             return -1;
         }
-        return lookup_hash_double(self, v, double_to_hash(v), self->keys_array_type);
+        if (self->keys_mode == KM_SORTED) {
+            return sorted_search_double(self, v, true);
+        }
+        return found_keys_pos(self, lookup_hash_double(self, v, double_to_hash(v), self->keys_array_type));
 }
 
 
@@ -1275,12 +2184,22 @@ lookup_unicode(FAMObject *self, PyObject* key) {
     if (k_size > dt_size) {
         return -1;
     }
+    if (self->keys_packed) {
+        // Python stores a str of only latin-1 characters with one byte per character; no other str
+        // can match
+        if (PyUnicode_KIND(key) != PyUnicode_1BYTE_KIND) {
+            return -1;
+        }
+        char* k = (char*)PyUnicode_1BYTE_DATA(key);
+        Py_hash_t hash = string_to_hash(k, k_size);
+        return found_keys_pos(self, lookup_hash_packed(self, k, k_size, hash));
+    }
     // The buffer will have dt_size + 1 storage. We copy a NULL character so do not have to clear the buffer, but instead can reuse it and still discover the lookup
     if (!PyUnicode_AsUCS4(key, self->key_buffer, dt_size+1, 1)) {
         return -1; // exception will be set
     }
     Py_hash_t hash = unicode_to_hash(self->key_buffer, k_size);
-    return lookup_hash_unicode(self, self->key_buffer, k_size, hash);
+    return found_keys_pos(self, lookup_hash_unicode(self, self->key_buffer, k_size, hash));
 }
 
 
@@ -1297,38 +2216,40 @@ lookup_string(FAMObject *self, PyObject* key) {
     }
     char* k = PyBytes_AS_STRING(key);
     Py_hash_t hash = string_to_hash(k, k_size);
-    return lookup_hash_string(self, k, k_size, hash);
+    return found_keys_pos(self, lookup_hash_string(self, k, k_size, hash));
 }
 
 
-// Given a key as a PyObject, return the Py_ssize_t keys_pos value stored in the TableElement. Return -1 on key not found (without setting an exception) and -1 on error (with setting an exception).
+// Given a key as a PyObject, return the Py_ssize_t keys_pos of that key in the table (or, for
+// KM_RANGE and KM_SORTED, in the keys). Return -1 on key not found (without setting an exception)
+// and -1 on error (with setting an exception).
 static Py_ssize_t
-lookup(FAMObject *self, PyObject *key) {
-    Py_ssize_t table_pos = -1;
+lookup_table(FAMObject *self, PyObject *key) {
+    Py_ssize_t keys_pos = -1;
 
     switch (self->keys_array_type) {
         case KAT_INT64:
         case KAT_INT32:
         case KAT_INT16:
         case KAT_INT8:
-            table_pos = lookup_int(self, key);
+            keys_pos = lookup_int(self, key);
             break;
         case KAT_UINT64:
         case KAT_UINT32:
         case KAT_UINT16:
         case KAT_UINT8:
-            table_pos = lookup_uint(self, key);
+            keys_pos = lookup_uint(self, key);
             break;
         case KAT_FLOAT64:
         case KAT_FLOAT32:
         case KAT_FLOAT16:
-            table_pos = lookup_double(self, key);
+            keys_pos = lookup_double(self, key);
             break;
         case KAT_UNICODE:
-            table_pos = lookup_unicode(self, key);
+            keys_pos = lookup_unicode(self, key);
             break;
         case KAT_STRING:
-            table_pos = lookup_string(self, key);
+            keys_pos = lookup_string(self, key);
             break;
         case KAT_DTY:
         case KAT_DTM:
@@ -1343,25 +2264,50 @@ lookup(FAMObject *self, PyObject *key) {
         case KAT_DTps:
         case KAT_DTfs:
         case KAT_DTas:
-            table_pos = lookup_datetime(self, key);
+            keys_pos = lookup_datetime(self, key);
             break;
         case KAT_LIST: {
             Py_hash_t hash = PyObject_Hash(key);
             if (hash == -1) {
                 return -1;
             }
-            table_pos = lookup_hash_obj(self, key, hash);
+            keys_pos = found_keys_pos(self, lookup_hash_obj(self, key, hash));
             break;
         }
     }
-    // A -1 hash is an unused storage location
-    if ((table_pos < 0) || (self->table[table_pos].hash == -1)) {
+    return keys_pos;
+}
+
+static void
+table_migrate(FAMObject *self, Py_ssize_t count);
+
+// Given a key as a PyObject, return the Py_ssize_t keys_pos of that key. Return -1 on key not found
+// (without setting an exception) and -1 on error (with setting an exception). During an incremental
+// resize, the old table is also searched. A discarded key is not found.
+static Py_ssize_t
+lookup(FAMObject *self, PyObject *key) {
+    Py_ssize_t keys_pos;
+    if (!self->table_old) {
+        keys_pos = lookup_table(self, key);
+    }
+    else {
+        table_migrate(self, MIGRATE_STEP);
+        keys_pos = lookup_table(self, key);
+        if (keys_pos == -1 && self->table_old && !PyErr_Occurred()) {
+            table_swap_old(self);
+            keys_pos = lookup_table(self, key);
+            table_swap_old(self);
+        }
+    }
+    if (keys_pos >= 0 && key_discarded(self, keys_pos)) {
         return -1;
     }
-    return self->table[table_pos].keys_pos;
+    return keys_pos;
 }
 
-// Insert a key_pos, hash pair into the table. Assumes table already has appropriate size. When inserting a new itme, `hash` is -1, forcing a fresh hash to be computed here. Return 0 on success, -1 on error.
+// Insert a key_pos, hash pair into the table. Assumes table already has appropriate size. When
+// inserting a new itme, `hash` is -1, forcing a fresh hash to be computed here. During an
+// incremental resize, the old table is also searched. Return 0 on success, -1 on error.
 static int
 insert_obj(
         FAMObject *self,
@@ -1375,19 +2321,37 @@ insert_obj(
             return -1;
         }
     }
+    if (self->table_old) {
+        table_migrate(self, MIGRATE_STEP);
+    }
+    if (self->table_old) {
+        table_swap_old(self);
+        Py_ssize_t table_pos = lookup_hash_obj(self, key, hash);
+        Py_ssize_t kp = found_keys_pos(self, table_pos);
+        table_swap_old(self);
+        if (table_pos < 0) {
+            return -1;
+        }
+        if (kp != -1 && !key_discarded(self, kp)) {
+            PyErr_SetObject(NonUniqueError, key);
+            return -1;
+        }
+    }
     // table position is not dependent on keys_pos
     Py_ssize_t table_pos = lookup_hash_obj(self, key, hash);
 
     if (table_pos < 0) {
         return -1;
     }
-    // We expect, on insertion, to get back a table_pos that points to an unassigned hash value (-1); if we get anything else, we have found a match to an already-existing key, and thus raise a NonUniqueError error.
-    if (self->table[table_pos].hash != -1) {
+    // We expect, on insertion, to get back a table_pos that points to an unassigned keys_pos (-1),
+    // or to a discarded key, which is replaced; if we get anything else, we have found a match to
+    // an already-existing key, and thus raise a NonUniqueError error.
+    Py_ssize_t kp = table_keys_pos(self, table_pos);
+    if (kp != -1 && !key_discarded(self, kp)) {
         PyErr_SetObject(NonUniqueError, key);
         return -1;
     }
-    self->table[table_pos].keys_pos = keys_pos;
-    self->table[table_pos].hash = hash;
+    table_set(self, table_pos, keys_pos, hash);
     return 0;
 }
 
@@ -1408,7 +2372,7 @@ insert_int(
     if (table_pos < 0) {
         return -1;
     }
-    if (self->table[table_pos].hash != -1) {
+    if (table_keys_pos(self, table_pos) != -1) {
         PyObject* er = PyLong_FromLongLong(key); // for error reporting
         if (er == NULL) {
             return -1;
@@ -1417,8 +2381,7 @@ insert_int(
         Py_DECREF(er);
         return -1;
     }
-    self->table[table_pos].keys_pos = keys_pos;
-    self->table[table_pos].hash = hash; // key is the hash
+    table_set(self, table_pos, keys_pos, hash);
     return 0;
 }
 
@@ -1439,7 +2402,7 @@ insert_uint(
     if (table_pos < 0) {
         return -1;
     }
-    if (self->table[table_pos].hash != -1) {
+    if (table_keys_pos(self, table_pos) != -1) {
         PyObject* er = PyLong_FromUnsignedLongLong(key);
         if (er == NULL) {
             return -1;
@@ -1448,8 +2411,7 @@ insert_uint(
         Py_DECREF(er);
         return -1;
     }
-    self->table[table_pos].keys_pos = keys_pos;
-    self->table[table_pos].hash = hash;
+    table_set(self, table_pos, keys_pos, hash);
     return 0;
 }
 
@@ -1471,7 +2433,7 @@ insert_double(
     if (table_pos < 0) {
         return -1;
     }
-    if (self->table[table_pos].hash != -1) {
+    if (table_keys_pos(self, table_pos) != -1) {
         PyObject* er = PyFloat_FromDouble(key);
         if (er == NULL) {
             return -1;
@@ -1480,8 +2442,7 @@ insert_double(
         Py_DECREF(er);
         return -1;
     }
-    self->table[table_pos].keys_pos = keys_pos;
-    self->table[table_pos].hash = hash;
+    table_set(self, table_pos, keys_pos, hash);
     return 0;
 }
 
@@ -1502,7 +2463,7 @@ insert_unicode(
     if (table_pos < 0) {
         return -1;
     }
-    if (self->table[table_pos].hash != -1) {
+    if (table_keys_pos(self, table_pos) != -1) {
         PyObject* er = PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, key, key_size);
         if (er == NULL) {
             return -1;
@@ -1511,8 +2472,7 @@ insert_unicode(
         Py_DECREF(er);
         return -1;
     }
-    self->table[table_pos].keys_pos = keys_pos;
-    self->table[table_pos].hash = hash;
+    table_set(self, table_pos, keys_pos, hash);
     return 0;
 }
 
@@ -1533,7 +2493,7 @@ insert_string(
     if (table_pos < 0) {
         return -1;
     }
-    if (self->table[table_pos].hash != -1) {
+    if (table_keys_pos(self, table_pos) != -1) {
         PyObject* er = PyBytes_FromStringAndSize(key, key_size);
         if (er == NULL) {
             return -1;
@@ -1542,1075 +2502,5169 @@ insert_string(
         Py_DECREF(er);
         return -1;
     }
-    self->table[table_pos].keys_pos = keys_pos;
-    self->table[table_pos].hash = hash;
+    table_set(self, table_pos, keys_pos, hash);
     return 0;
 }
 
 
-//------------------------------------------------------------------------------
-
-// Called in fam_new(), extend(), append(), with the size of observed keys. This table is updated only when append or extending. Only if there is an old table will keys be accessed Returns 0 on success, -1 on failure.
+// Insert a KAT_UNICODE key given as a latin-1 char array, as stored in keys_packed.
 static int
-grow_table(FAMObject *self, Py_ssize_t keys_size)
+insert_packed(
+        FAMObject *self,
+        char* key,
+        Py_ssize_t key_size,
+        Py_ssize_t keys_pos,
+        Py_hash_t hash)
 {
-    // NOTE: this is the only place int_cache_fill is called; it is not called with key_count_global, but with the max value needed
-    if (int_cache_fill(keys_size)) {
-        return -1;
-    }
-    Py_ssize_t keys_load = keys_size / LOAD;
-    Py_ssize_t size_old = self->table_size;
-    if (keys_load < size_old) {
-        return 0;
-    }
-
-    // get the next power of 2 greater than current keys_load
-    Py_ssize_t size_new = 1;
-    while (size_new <= keys_load) {
-        size_new <<= 1;
+    if (hash == -1) {
+        hash = string_to_hash(key, key_size);
     }
-    // size_new > keys_load; we know that keys_load >= size_old, so size_new must be > size_old
-    TableElement *table_old = self->table;
-    TableElement *table_new = PyMem_New(TableElement, size_new + SCAN - 1);
-    if (!table_new) {
+    // table position is not dependent on keys_pos
+    Py_ssize_t table_pos = lookup_hash_packed(self, key, key_size, hash);
+    if (table_pos < 0) {
         return -1;
     }
-
-    // initialize all hash and keys_pos values to -1
-    Py_ssize_t table_pos;
-    for (table_pos = 0; table_pos < size_new + SCAN - 1; table_pos++) {
-        table_new[table_pos].hash = -1;
-        table_new[table_pos].keys_pos = -1;
-    }
-    self->table = table_new;
-    self->table_size = size_new;
-
-    // if we have an old table, move them into the new table
-    if (size_old) {
-        if (self->keys_array_type) {
-            PyErr_SetString(PyExc_NotImplementedError, "Cannot grow table for array keys");
-            goto restore;
-        }
-        Py_ssize_t i;
-        Py_hash_t h;
-        for (table_pos = 0; table_pos < size_old + SCAN - 1; table_pos++) {
-            i = table_old[table_pos].keys_pos;
-            h = table_old[table_pos].hash;
-            if ((h != -1) && insert_obj(self, PyList_GET_ITEM(self->keys, i), i, h))
-            {
-                goto restore;
-            }
-        }
-    }
-    PyMem_Del(table_old);
-    return 0;
-restore:
-    PyMem_Del(self->table);
-    self->table = table_old;
-    self->table_size = size_old;
-    return -1;
-}
-
-
-// Given a new, possibly un-initialized FAMObject, copy attrs from self to new. Return 0 on success, -1 on error.
-int
-copy_to_new(PyTypeObject *cls, FAMObject *self, FAMObject *new)
-{
-    if (self->keys_array_type) {
-        new->keys = self->keys;
-        Py_INCREF(new->keys);
-    }
-    else {
-        new->keys = PySequence_List(self->keys);
-        if (!new->keys) {
+    if (table_keys_pos(self, table_pos) != -1) {
+        PyObject* er = PyUnicode_DecodeLatin1(key, key_size, NULL);
+        if (er == NULL) {
             return -1;
         }
-    }
-    key_count_global += self->keys_size;
-
-    new->table_size = self->table_size;
-    new->keys_array_type = self->keys_array_type;
-    new->keys_size = self->keys_size;
-
-    new->key_buffer = NULL;
-    if (new->keys_array_type == KAT_UNICODE) {
-        PyArrayObject *a = (PyArrayObject *)new->keys;
-        Py_ssize_t dt_size = PyArray_ITEMSIZE(a) / UCS4_SIZE;
-        new->key_buffer = (Py_UCS4*)PyMem_Malloc((dt_size+1) * UCS4_SIZE);
-    }
-
-    Py_ssize_t table_size_alloc = new->table_size + SCAN - 1;
-    new->table = PyMem_New(TableElement, table_size_alloc);
-    if (!new->table) {
-        // Py_DECREF(new->keys); // assume this will get cleaned up
+        PyErr_SetObject(NonUniqueError, er);
+        Py_DECREF(er);
         return -1;
     }
-    memcpy(new->table, self->table, table_size_alloc * sizeof(TableElement));
+    table_set(self, table_pos, keys_pos, hash);
     return 0;
 }
 
 
-static PyObject *
-fam_new(PyTypeObject *cls, PyObject *args, PyObject *kwargs);
+//------------------------------------------------------------------------------
+// concurrent insertion
 
 
-// Create a copy of self. Used in `fam_or()`. Returns a new FAMObject on success, NULL on error.
-static FAMObject *
-copy(PyTypeObject *cls, FAMObject *self)
+// Arguments for a worker that inserts a contiguous range of a FAM's array keys into its (shared)
+// table.
+typedef struct InsertRange {
+    FAMObject *fam;
+    Py_ssize_t start;
+    Py_ssize_t stop;
+    Py_ssize_t *dup_pos; // shared between workers: the keys_pos of a non-unique key, or -1
+} InsertRange;
+
+# if AM_ATOMICS
+
+// For concurrent insertion, a table element's keys_pos is -1 when empty, -2 while being claimed,
+// and the key position once claimed. Claim the element at table_pos for `keys_pos` and `hash` and
+// return -1 if empty; otherwise, return the keys_pos of the occupying key, waiting for any
+// concurrent claim.
+static inline Py_ssize_t
+table_claim(FAMObject *fam, Py_ssize_t table_pos, Py_ssize_t keys_pos, Py_hash_t hash)
 {
-    if (!PyType_IsSubtype(cls, &AMType) && !PyObject_TypeCheck(self, &AMType)) {
-        Py_INCREF(self);
-        return self;
-    }
-    // fam_new to allocate and full struct attrs
-    FAMObject *new = (FAMObject*)fam_new(cls, NULL, NULL);
-    if (!new) {
-        return NULL;
-    }
-    if (copy_to_new(cls, self, new)) {
-        Py_DECREF(new); // assume this will decref any partially set attrs of new
+    switch (fam->table_layout) {
+        case TL_WIDE: {
+            TableElement *te = (TableElement *)fam->table + table_pos;
+            Py_ssize_t kp = atomic_load_ssize(&te->keys_pos);
+            if (kp == -1) {
+                if (atomic_cas_ssize(&te->keys_pos, -1, -2)) {
+                    te->hash = hash;
+                    atomic_store_ssize(&te->keys_pos, keys_pos);
+                    return -1;
+                }
+                kp = atomic_load_ssize(&te->keys_pos);
+            }
+            while (kp == -2) {
+                kp = atomic_load_ssize(&te->keys_pos);
+            }
+            return kp;
+        }
+        case TL_COMPACT: {
+            TableElementCompact *te = (TableElementCompact *)fam->table + table_pos;
+            npy_int32 kp = atomic_load_int32(&te->keys_pos);
+            if (kp == -1) {
+                if (atomic_cas_int32(&te->keys_pos, -1, -2)) {
+                    te->hash = hash_tag(hash);
+                    atomic_store_int32(&te->keys_pos, (npy_int32)keys_pos);
+                    return -1;
+                }
+                kp = atomic_load_int32(&te->keys_pos);
+            }
+            while (kp == -2) {
+                kp = atomic_load_int32(&te->keys_pos);
+            }
+            return kp;
+        }
+        case TL_INLINE: {
+            TableElementInline *te = (TableElementInline *)fam->table + table_pos;
+            Py_ssize_t kp = atomic_load_ssize(&te->keys_pos);
+            if (kp == -1) {
+                if (atomic_cas_ssize(&te->keys_pos, -1, -2)) {
+                    te->key = inline_key_at(fam, keys_pos);
+                    atomic_store_ssize(&te->keys_pos, keys_pos);
+                    return -1;
+                }
+                kp = atomic_load_ssize(&te->keys_pos);
+            }
+            while (kp == -2) {
+                kp = atomic_load_ssize(&te->keys_pos);
+            }
+            return kp;
+        }
+        case TL_POS: {
+            npy_int32 *te = (npy_int32 *)fam->table + table_pos;
+            npy_int32 kp = atomic_load_int32(te);
+            if (kp == -1) {
+                if (atomic_cas_int32(te, -1, (npy_int32)keys_pos)) {
+                    return -1;
+                }
+                kp = atomic_load_int32(te);
+            }
+            return kp;
+        }
     }
-    return new;
+    Py_UNREACHABLE();
 }
 
-
-
-// Returns -1 on error, 0 on success.
-static int
-extend(FAMObject *self, PyObject *keys)
+// Given a claimed table element, return true if the stored hash (if any) matches `hash`.
+static inline bool
+table_hash_matches(FAMObject *fam, Py_ssize_t table_pos, Py_hash_t hash)
 {
-    if (self->keys_array_type) {
-        PyErr_SetString(PyExc_NotImplementedError, "Not supported for array keys");
-        return -1;
-    }
-    // this should fail for self->keys types that are not a list
-    keys = PySequence_Fast(keys, "expected an iterable of keys");
-    if (!keys) {
-        return -1;
-    }
-    Py_ssize_t size_extend = PySequence_Fast_GET_SIZE(keys);
-    key_count_global += size_extend;
-    self->keys_size += size_extend;
-
-    if (grow_table(self, self->keys_size)) {
-        Py_DECREF(keys);
-        return -1;
-    }
-
-    PyObject **keys_fi = PySequence_Fast_ITEMS(keys);
-
-    for (Py_ssize_t index = 0; index < size_extend; index++) {
-        // get the new keys_size after each append
-        if (insert_obj(self, keys_fi[index], PyList_GET_SIZE(self->keys), -1) ||
-            PyList_Append(self->keys, keys_fi[index]))
-        {
-            Py_DECREF(keys);
-            return -1;
-        }
+    switch (fam->table_layout) {
+        case TL_WIDE:
+            return ((TableElement *)fam->table)[table_pos].hash == hash;
+        case TL_COMPACT:
+            return ((TableElementCompact *)fam->table)[table_pos].hash == hash_tag(hash);
+        case TL_POS:
+        case TL_INLINE:
+            return true;
     }
-    Py_DECREF(keys);
-    return 0;
+    Py_UNREACHABLE();
 }
 
-
-// Returns -1 on error, 0 on success.
-static int
-append(FAMObject *self, PyObject *key)
+// Record a non-unique key found at keys_pos; only the first recorded is retained.
+static inline void
+insert_range_set_dup(InsertRange *ir, Py_ssize_t keys_pos)
 {
-    if (self->keys_array_type) {
-        PyErr_SetString(PyExc_NotImplementedError, "Not supported for array keys");
-        return -1;
-    }
-    key_count_global++;
-    self->keys_size++;
+    atomic_cas_ssize(ir->dup_pos, -1, keys_pos);
+}
 
-    if (grow_table(self, self->keys_size)) {
-        return -1;
+// Defines a WorkerFunc that inserts a range of scalar keys; mirrors insert_int(), insert_uint(),
+// and insert_double(), with table elements claimed atomically.
+# define INSERT_RANGE_SCALARS(name, npy_type_src, npy_type_dst, hash_func, post_deref) \
+static void                                                                 \
+name(void *arg)                                                             \
+{                                                                           \
+    InsertRange *ir = (InsertRange *)arg;                                   \
+    Py_ssize_t mask = ir->fam->table_size - 1;                              \
+    PyArrayObject *a = (PyArrayObject *)ir->fam->keys;                      \
+    npy_type_dst v;                                                         \
+    Py_hash_t hash, mixin;                                                  \
+    Py_ssize_t table_pos, kp, i;                                            \
+    for (Py_ssize_t keys_pos = ir->start; keys_pos < ir->stop; keys_pos++) { \
+        if (!(keys_pos & 0x3FF) && atomic_load_ssize(ir->dup_pos) != -1) {  \
+            return;                                                         \
+        }                                                                   \
+        v = post_deref(*(npy_type_src*)PyArray_GETPTR1(a, keys_pos));       \
+        hash = hash_func(v);                                                \
+        mixin = Py_ABS(hash);                                               \
+        table_pos = hash & mask;                                            \
+        while (1) {                                                         \
+            for (i = 0; i < SCAN; i++) {                                    \
+                kp = table_claim(ir->fam, table_pos, keys_pos, hash);       \
+                if (kp == -1) {                                             \
+                    goto next;                                              \
+                }                                                           \
+                if (table_hash_matches(ir->fam, table_pos, hash) &&         \
+                        post_deref(*(npy_type_src*)PyArray_GETPTR1(a, kp)) == v) { \
+                    insert_range_set_dup(ir, keys_pos);                     \
+                    return;                                                 \
+                }                                                           \
+                table_pos++;                                                \
+            }                                                               \
+            table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask; \
+        }                                                                   \
+        next:;                                                              \
+    }                                                                       \
+}                                                                           \
+
+// Defines a WorkerFunc that inserts a range of flexible keys; mirrors insert_unicode(),
+// insert_string(), and insert_packed(), with table elements claimed atomically. Keys are read from
+// `base`, `stride` bytes apart; these expressions can use `a` and `ir`.
+# define INSERT_RANGE_FLEXIBLE(name, char_type, hash_func, base, stride)    \
+static void                                                                 \
+name(void *arg)                                                             \
+{                                                                           \
+    InsertRange *ir = (InsertRange *)arg;                                   \
+    Py_ssize_t mask = ir->fam->table_size - 1;                              \
+    PyArrayObject *a = (PyArrayObject *)ir->fam->keys;                      \
+    char* k_base = (char*)(base);                                           \
+    Py_ssize_t k_stride = stride;                                           \
+    char_type* v;                                                           \
+    Py_ssize_t k_size, cmp_bytes;                                           \
+    Py_hash_t hash, mixin;                                                  \
+    Py_ssize_t table_pos, kp, i;                                            \
+    for (Py_ssize_t keys_pos = ir->start; keys_pos < ir->stop; keys_pos++) { \
+        if (!(keys_pos & 0x3FF) && atomic_load_ssize(ir->dup_pos) != -1) {  \
+            return;                                                         \
+        }                                                                   \
+        v = (char_type*)(k_base + keys_pos * k_stride);                     \
+        k_size = key_length_at(ir->fam, keys_pos);                          \
+        cmp_bytes = k_size * sizeof(char_type);                             \
+        hash = hash_func(v, k_size);                                        \
+        mixin = Py_ABS(hash);                                               \
+        table_pos = hash & mask;                                            \
+        while (1) {                                                         \
+            for (i = 0; i < SCAN; i++) {                                    \
+                kp = table_claim(ir->fam, table_pos, keys_pos, hash);       \
+                if (kp == -1) {                                             \
+                    goto next;                                              \
+                }                                                           \
+                if (table_hash_matches(ir->fam, table_pos, hash) &&         \
+                        key_length_at(ir->fam, kp) == k_size &&             \
+                        !memcmp(k_base + kp * k_stride, v, cmp_bytes)) {    \
+                    insert_range_set_dup(ir, keys_pos);                     \
+                    return;                                                 \
+                }                                                           \
+                table_pos++;                                                \
+            }                                                               \
+            table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask; \
+        }                                                                   \
+        next:;                                                              \
+    }                                                                       \
+}                                                                           \
+
+INSERT_RANGE_SCALARS(insert_range_int64, npy_int64, npy_int64, int_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_int32, npy_int32, npy_int64, int_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_int16, npy_int16, npy_int64, int_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_int8, npy_int8, npy_int64, int_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_uint64, npy_uint64, npy_uint64, uint_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_uint32, npy_uint32, npy_uint64, uint_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_uint16, npy_uint16, npy_uint64, uint_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_uint8, npy_uint8, npy_uint64, uint_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_float64, npy_double, npy_double, double_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_float32, npy_float, npy_double, double_to_hash,)
+INSERT_RANGE_SCALARS(insert_range_float16, npy_half, npy_double, double_to_hash, npy_half_to_double)
+INSERT_RANGE_FLEXIBLE(insert_range_unicode, Py_UCS4, unicode_to_hash, PyArray_BYTES(a), PyArray_STRIDE(a, 0))
+INSERT_RANGE_FLEXIBLE(insert_range_string, char, string_to_hash, PyArray_BYTES(a), PyArray_STRIDE(a, 0))
+INSERT_RANGE_FLEXIBLE(insert_range_packed, char, string_to_hash, ir->fam->keys_packed, PyArray_ITEMSIZE(a) / UCS4_SIZE)
+
+# undef INSERT_RANGE_SCALARS
+# undef INSERT_RANGE_FLEXIBLE
+
+# endif
+
+// Set a NonUniqueError for the array key at keys_pos, using the same Python objects as the serial
+// insert functions.
+static void
+set_non_unique_error(FAMObject *fam, Py_ssize_t keys_pos)
+{
+    PyArrayObject *a = (PyArrayObject *)fam->keys;
+    void *p = PyArray_GETPTR1(a, keys_pos);
+    PyObject *er = NULL;
+    switch (fam->keys_array_type) {
+        case KAT_INT64:
+            er = PyLong_FromLongLong(*(npy_int64*)p);
+            break;
+        case KAT_INT32:
+            er = PyLong_FromLongLong(*(npy_int32*)p);
+            break;
+        case KAT_INT16:
+            er = PyLong_FromLongLong(*(npy_int16*)p);
+            break;
+        case KAT_INT8:
+            er = PyLong_FromLongLong(*(npy_int8*)p);
+            break;
+        case KAT_UINT64:
+            er = PyLong_FromUnsignedLongLong(*(npy_uint64*)p);
+            break;
+        case KAT_UINT32:
+            er = PyLong_FromUnsignedLongLong(*(npy_uint32*)p);
+            break;
+        case KAT_UINT16:
+            er = PyLong_FromUnsignedLongLong(*(npy_uint16*)p);
+            break;
+        case KAT_UINT8:
+            er = PyLong_FromUnsignedLongLong(*(npy_uint8*)p);
+            break;
+        case KAT_FLOAT64:
+            er = PyFloat_FromDouble(*(npy_double*)p);
+            break;
+        case KAT_FLOAT32:
+            er = PyFloat_FromDouble(*(npy_float*)p);
+            break;
+        case KAT_FLOAT16:
+            er = PyFloat_FromDouble(npy_half_to_double(*(npy_half*)p));
+            break;
+        case KAT_UNICODE: {
+            Py_ssize_t dt_size = PyArray_ITEMSIZE(a) / UCS4_SIZE;
+            er = PyUnicode_FromUCS4AndData(p, ucs4_get_end_p((Py_UCS4*)p, dt_size) - (Py_UCS4*)p);
+            break;
+        }
+        case KAT_STRING: {
+            Py_ssize_t dt_size = PyArray_ITEMSIZE(a);
+            er = PyBytes_FromStringAndSize(p, char_get_end_p((char*)p, dt_size) - (char*)p);
+            break;
+        }
+        case KAT_LIST:
+            er = PyList_GET_ITEM(fam->keys, keys_pos);
+            Py_INCREF(er);
+            break;
+        default: // all datetime64 KATs
+            er = PyLong_FromLongLong(*(npy_int64*)p);
+            break;
     }
-    // keys_size is already incremented; provide last index
-    if (insert_obj(self, key, self->keys_size - 1, -1) ||
-        PyList_Append(self->keys, key))
-    {
-        return -1;
+    if (er == NULL) {
+        return;
     }
-    return 0;
+    PyErr_SetObject(NonUniqueError, er);
+    Py_DECREF(er);
 }
 
-
-static Py_ssize_t
-fam_length(FAMObject *self)
+// Scan keys of `npy_type`, returning -1 from the enclosing function with an exception set at the
+// first key that is not greater than the previous key. Depends on self, a, and keys_size.
+# define SORTED_SCAN(npy_type, post_deref)                                     \
+{                                                                              \
+    npy_type prev = *(npy_type*)PyArray_GETPTR1(a, 0);                         \
+    npy_type k;                                                                \
+    for (Py_ssize_t i = 1; i < keys_size; i++) {                               \
+        k = *(npy_type*)PyArray_GETPTR1(a, i);                                 \
+        if (!(post_deref(k) > post_deref(prev))) {                             \
+            if (post_deref(k) == post_deref(prev)) {                           \
+                set_non_unique_error(self, i);                                 \
+            }                                                                  \
+            else {                                                             \
+                PyErr_Format(PyExc_ValueError,                                 \
+                        "%s keys must be in increasing order when sorted",     \
+                        Py_TYPE(self)->tp_name);                               \
+            }                                                                  \
+            return -1;                                                         \
+        }                                                                      \
+        prev = k;                                                              \
+    }                                                                          \
+}                                                                              \
+
+// Set KM_SORTED mode for a FAM of numeric or datetime64 array keys, validating that keys are
+// strictly increasing. Returns 0 on success, -1 on error.
+static int
+sorted_init(FAMObject *self)
 {
-    return self->keys_size;
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    Py_ssize_t keys_size = self->keys_size;
+    switch (self->keys_array_type) {
+        case KAT_LIST:
+        case KAT_UNICODE:
+        case KAT_STRING:
+            PyErr_Format(PyExc_ValueError,
+                    "%s sorted keys must be an array of numbers or datetime64",
+                    Py_TYPE(self)->tp_name);
+            return -1;
+        default:
+            break;
+    }
+    if (keys_size > 1) {
+        switch (self->keys_array_type) {
+            case KAT_INT32:
+                SORTED_SCAN(npy_int32,);
+                break;
+            case KAT_INT16:
+                SORTED_SCAN(npy_int16,);
+                break;
+            case KAT_INT8:
+                SORTED_SCAN(npy_int8,);
+                break;
+            case KAT_UINT64:
+                SORTED_SCAN(npy_uint64,);
+                break;
+            case KAT_UINT32:
+                SORTED_SCAN(npy_uint32,);
+                break;
+            case KAT_UINT16:
+                SORTED_SCAN(npy_uint16,);
+                break;
+            case KAT_UINT8:
+                SORTED_SCAN(npy_uint8,);
+                break;
+            case KAT_FLOAT64:
+                SORTED_SCAN(npy_double,);
+                break;
+            case KAT_FLOAT32:
+                SORTED_SCAN(npy_float,);
+                break;
+            case KAT_FLOAT16:
+                SORTED_SCAN(npy_half, npy_half_to_double);
+                break;
+            default: // KAT_INT64 and all datetime64 KATs
+                SORTED_SCAN(npy_int64,);
+                break;
+        }
+    }
+    self->keys_mode = KM_SORTED;
+    return 0;
+}
+
+# undef SORTED_SCAN
+
+// Insert all array keys into an empty, allocated table using `threads` threads. Returns 1 if the
+// keys_array_type is not supported for concurrent insertion (and nothing has been done), 0 on
+// success, and -1 on error.
+static int
+insert_threaded(FAMObject *fam, Py_ssize_t threads)
+{
+# if AM_ATOMICS
+    WorkerFunc func;
+    switch (fam->keys_array_type) {
+        case KAT_INT64:
+            func = insert_range_int64;
+            break;
+        case KAT_INT32:
+            func = insert_range_int32;
+            break;
+        case KAT_INT16:
+            func = insert_range_int16;
+            break;
+        case KAT_INT8:
+            func = insert_range_int8;
+            break;
+        case KAT_UINT64:
+            func = insert_range_uint64;
+            break;
+        case KAT_UINT32:
+            func = insert_range_uint32;
+            break;
+        case KAT_UINT16:
+            func = insert_range_uint16;
+            break;
+        case KAT_UINT8:
+            func = insert_range_uint8;
+            break;
+        case KAT_FLOAT64:
+            func = insert_range_float64;
+            break;
+        case KAT_FLOAT32:
+            func = insert_range_float32;
+            break;
+        case KAT_FLOAT16:
+            func = insert_range_float16;
+            break;
+        case KAT_UNICODE:
+            func = fam->keys_packed ? insert_range_packed : insert_range_unicode;
+            break;
+        case KAT_STRING:
+            func = insert_range_string;
+            break;
+        case KAT_LIST:
+            return 1;
+        default: // all datetime64 KATs
+            func = insert_range_int64;
+            break;
+    }
+    Py_ssize_t keys_size = fam->keys_size;
+    InsertRange *ranges = PyMem_New(InsertRange, threads);
+    if (!ranges) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    Py_ssize_t dup_pos = -1;
+    Py_ssize_t step = keys_size / threads;
+    for (Py_ssize_t t = 0; t < threads; t++) {
+        ranges[t].fam = fam;
+        ranges[t].start = t * step;
+        ranges[t].stop = t == threads - 1 ? keys_size : (t + 1) * step;
+        ranges[t].dup_pos = &dup_pos;
+    }
+    int err = run_threaded(func, (char*)ranges, sizeof(InsertRange), threads);
+    PyMem_Del(ranges);
+    if (err) {
+        return -1;
+    }
+    if (dup_pos != -1) {
+        set_non_unique_error(fam, dup_pos);
+        return -1;
+    }
+    return 0;
+# else
+    return 1;
+# endif
+}
+
+
+//------------------------------------------------------------------------------
+
+// Return the hash of the key at keys_pos, as used for insertion in the table. Returns -1 on error.
+static Py_hash_t
+key_hash_at(FAMObject *self, Py_ssize_t keys_pos)
+{
+    if (!self->keys_array_type) {
+        return PyObject_Hash(PyList_GET_ITEM(self->keys, keys_pos));
+    }
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    void *p = PyArray_GETPTR1(a, keys_pos);
+    switch (self->keys_array_type) {
+        case KAT_INT64:
+            return int_to_hash(*(npy_int64*)p);
+        case KAT_INT32:
+            return int_to_hash(*(npy_int32*)p);
+        case KAT_INT16:
+            return int_to_hash(*(npy_int16*)p);
+        case KAT_INT8:
+            return int_to_hash(*(npy_int8*)p);
+        case KAT_UINT64:
+            return uint_to_hash(*(npy_uint64*)p);
+        case KAT_UINT32:
+            return uint_to_hash(*(npy_uint32*)p);
+        case KAT_UINT16:
+            return uint_to_hash(*(npy_uint16*)p);
+        case KAT_UINT8:
+            return uint_to_hash(*(npy_uint8*)p);
+        case KAT_FLOAT64:
+            return double_to_hash(*(npy_double*)p);
+        case KAT_FLOAT32:
+            return double_to_hash(*(npy_float*)p);
+        case KAT_FLOAT16:
+            return double_to_hash(npy_half_to_double(*(npy_half*)p));
+        case KAT_UNICODE:
+            if (self->keys_packed) {
+                Py_ssize_t dt_size = PyArray_ITEMSIZE(a) / UCS4_SIZE;
+                return string_to_hash(self->keys_packed + keys_pos * dt_size, key_length_at(self, keys_pos));
+            }
+            return unicode_to_hash((Py_UCS4*)p, key_length_at(self, keys_pos));
+        case KAT_STRING:
+            return string_to_hash((char*)p, key_length_at(self, keys_pos));
+        default: // all datetime64 KATs
+            return int_to_hash(*(npy_int64*)p);
+    }
+}
+
+
+// Place keys_pos in the first empty element of the probe sequence of `hash`. As keys placed this
+// way are known to be unique, stored keys are not compared. Assumes the table has room.
+static void
+table_place(FAMObject *self, Py_ssize_t keys_pos, Py_hash_t hash)
+{
+    Py_ssize_t mask = self->table_size - 1;
+    Py_hash_t mixin = Py_ABS(hash);
+    Py_ssize_t table_pos = hash & mask;
+    while (1) {
+        for (Py_ssize_t i = 0; i < SCAN; i++) {
+            if (table_keys_pos(self, table_pos) == -1) {
+                table_set(self, table_pos, keys_pos, hash);
+                return;
+            }
+            table_pos++;
+        }
+        table_pos = (5 * (table_pos - SCAN) + (mixin >>= 1) + 1) & mask;
+    }
+}
+
+// During an incremental resize, place the keys of up to `count` old table elements in the table,
+// and free the old table once all are migrated. Discarded keys are not migrated. Until the old
+// table is freed, each key can be found in one table or the other.
+static void
+table_migrate(FAMObject *self, Py_ssize_t count)
+{
+    TableOld *to = self->table_old;
+    if (!to) {
+        return;
+    }
+    Py_ssize_t size_old = to->size + SCAN - 1;
+    Py_ssize_t stop = to->pos + Py_MIN(count, size_old - to->pos);
+    Py_ssize_t keys_pos;
+    for (Py_ssize_t table_pos = to->pos; table_pos < stop; table_pos++) {
+        keys_pos = table_element_keys_pos(to->table, to->layout, table_pos);
+        if (keys_pos == -1 || key_discarded(self, keys_pos)) {
+            continue;
+        }
+        if (to->layout == TL_WIDE) {
+            table_place(self, keys_pos, ((TableElement *)to->table)[table_pos].hash);
+        }
+        else {
+            table_place(self, keys_pos, key_hash_at(self, keys_pos));
+        }
+    }
+    to->pos = stop;
+    if (stop == size_old) {
+        PyMem_Free(to->table);
+        PyMem_Free(to);
+        self->table_old = NULL;
+    }
+}
+
+// Place all keys, other than discarded keys, in an empty table, computing the hash of each. Returns
+// 0 on success, -1 on error.
+static int
+table_place_keys(FAMObject *self)
+{
+    Py_hash_t h;
+    for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+        if (key_discarded(self, i)) {
+            continue;
+        }
+        h = key_hash_at(self, i);
+        if (h == -1) {
+            return -1;
+        }
+        table_place(self, i, h);
+    }
+    return 0;
+}
+
+// Replace the table with an empty table of `size_new` elements, in a layout suitable for
+// `keys_size` keys, and place the current keys, other than discarded keys, in it. Hashes stored in
+// a TL_WIDE table are reused unless `rehash`. Returns 0 on success, -1 on error, leaving the old
+// table unchanged.
+static int
+table_resize(FAMObject *self, Py_ssize_t size_new, Py_ssize_t keys_size, bool rehash)
+{
+    table_migrate(self, PY_SSIZE_T_MAX);
+    void *table_old = self->table;
+    Py_ssize_t size_old = self->table_size;
+    TableLayout layout_old = self->table_layout;
+    TableLayout layout_new = layout_old == TL_INLINE
+            ? TL_INLINE : table_layout_for(self->keys_array_type, keys_size, false);
+
+    size_t table_bytes = (size_new + SCAN - 1) * table_element_size(layout_new);
+    void *table_new = PyMem_Malloc(table_bytes);
+    if (!table_new) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    // initialize all fields, including keys_pos, to -1
+    memset(table_new, 0xFF, table_bytes);
+    self->table = table_new;
+    self->table_size = size_new;
+    self->table_layout = layout_new;
+
+    if (table_old) {
+        if (layout_old == TL_WIDE && !rehash) {
+            TableElement *te = (TableElement *)table_old;
+            for (Py_ssize_t table_pos = 0; table_pos < size_old + SCAN - 1; table_pos++) {
+                if (te[table_pos].keys_pos != -1 && !key_discarded(self, te[table_pos].keys_pos)) {
+                    table_place(self, te[table_pos].keys_pos, te[table_pos].hash);
+                }
+            }
+        }
+        else if (table_place_keys(self)) {
+            PyMem_Free(table_new);
+            self->table = table_old;
+            self->table_size = size_old;
+            self->table_layout = layout_old;
+            return -1;
+        }
+        PyMem_Free(table_old);
+    }
+    return 0;
+}
+
+// Return the size of a table for `keys_size` keys: the next power of 2 greater than keys_size /
+// LOAD.
+static Py_ssize_t
+table_size_for(Py_ssize_t keys_size)
+{
+    Py_ssize_t keys_load = keys_size / LOAD;
+    Py_ssize_t size = 1;
+    while (size <= keys_load) {
+        size <<= 1;
+    }
+    return size;
+}
+
+// Replace the table with an empty table of `size_new` elements, keeping the current table as the
+// old table, from which later insertions and lookups migrate MIGRATE_STEP elements with
+// table_migrate(). Returns 0 on success, -1 on error, leaving the table unchanged.
+static int
+table_resize_incremental(FAMObject *self, Py_ssize_t size_new, Py_ssize_t keys_size)
+{
+    TableLayout layout_new = self->table_layout == TL_INLINE
+            ? TL_INLINE : table_layout_for(self->keys_array_type, keys_size, false);
+    size_t table_bytes = (size_new + SCAN - 1) * table_element_size(layout_new);
+    void *table_new = PyMem_Malloc(table_bytes);
+    TableOld *to = PyMem_New(TableOld, 1);
+    if (!table_new || !to) {
+        PyMem_Free(table_new);
+        PyMem_Free(to);
+        PyErr_NoMemory();
+        return -1;
+    }
+    // initialize all fields, including keys_pos, to -1
+    memset(table_new, 0xFF, table_bytes);
+    table_migrate(self, PY_SSIZE_T_MAX);
+    to->table = self->table;
+    to->size = self->table_size;
+    to->layout = self->table_layout;
+    to->pos = 0;
+    self->table_old = to;
+    self->table = table_new;
+    self->table_size = size_new;
+    self->table_layout = layout_new;
+    return 0;
+}
+
+// Called in fam_init(), extend(), and append(), with the size of observed keys. If the table is too
+// small for `keys_size` keys, it is replaced with a larger table, at once or, for an incremental
+// AutoMap, by later migration. Returns 0 on success, -1 on failure.
+static int
+grow_table(FAMObject *self, Py_ssize_t keys_size)
+{
+    // NOTE: this is the only place int_cache_fill is called; it is not called with key_count_global, but with the max value needed
+    if (int_cache_fill(keys_size)) {
+        return -1;
+    }
+    Py_ssize_t size_new = self->table_size;
+    if ((Py_ssize_t)(keys_size / LOAD) >= size_new) {
+        size_new = table_size_for(keys_size);
+    }
+    else if (keys_size <= NPY_MAX_INT32
+            || self->table_layout == TL_WIDE
+            || self->table_layout == TL_INLINE) {
+        return 0;
+    }
+    // the table is too small, or its layout cannot store keys_pos beyond the range of int32
+    if (self->incremental && self->table && self->keys_size) {
+        return table_resize_incremental(self, size_new, keys_size);
+    }
+    return table_resize(self, size_new, keys_size, false);
+}
+
+
+// Return a new reference to the keys. An AutoMap of array keys might have a keys array with room to
+// append; in that case, return an immutable view of the first keys_size elements. Returns NULL on
+// error.
+static PyObject *
+keys_view(FAMObject *self)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    if (!self->keys_array_type || PyArray_SIZE(a) == self->keys_size) {
+        Py_INCREF(self->keys);
+        return self->keys;
+    }
+    PyArray_Descr *descr = PyArray_DESCR(a);
+    Py_INCREF(descr);
+    npy_intp size = self->keys_size;
+    PyObject *view = PyArray_NewFromDescr(
+            &PyArray_Type, descr, 1, &size, NULL, PyArray_DATA(a), 0, NULL);
+    if (!view) {
+        return NULL;
+    }
+    Py_INCREF(a);
+    if (PyArray_SetBaseObject((PyArrayObject *)view, (PyObject *)a)) {
+        Py_DECREF(view);
+        return NULL;
+    }
+    return view;
+}
+
+
+// Return a new reference to the keys other than discarded keys, in order. If no keys have been
+// discarded, this is keys_view(); otherwise, a new list or immutable array is returned. Returns
+// NULL on error.
+static PyObject *
+keys_live(FAMObject *self)
+{
+    if (!self->discarded) {
+        return keys_view(self);
+    }
+    Py_ssize_t size = self->keys_size - self->discarded->count;
+    Py_ssize_t j = 0;
+    if (!self->keys_array_type) {
+        PyObject *keys = PyList_New(size);
+        if (!keys) {
+            return NULL;
+        }
+        PyObject *key;
+        for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+            if (!key_discarded(self, i)) {
+                key = PyList_GET_ITEM(self->keys, i);
+                Py_INCREF(key);
+                PyList_SET_ITEM(keys, j++, key);
+            }
+        }
+        return keys;
+    }
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    Py_ssize_t item_size = PyArray_ITEMSIZE(a);
+    PyArray_Descr *descr = PyArray_DESCR(a);
+    Py_INCREF(descr);
+    npy_intp n = size;
+    PyArrayObject *keys = (PyArrayObject *)PyArray_Empty(1, &n, descr, 0);
+    if (!keys) {
+        return NULL;
+    }
+    char *dst = PyArray_BYTES(keys);
+    for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+        if (!key_discarded(self, i)) {
+            memcpy(dst + j++ * item_size, PyArray_GETPTR1(a, i), item_size);
+        }
+    }
+    PyArray_CLEARFLAGS(keys, NPY_ARRAY_WRITEABLE);
+    return (PyObject *)keys;
+}
+
+
+// Given a new, possibly un-initialized FAMObject, copy attrs from self to new. Return 0 on success, -1 on error.
+int
+copy_to_new(PyTypeObject *cls, FAMObject *self, FAMObject *new)
+{
+    // as only the table is copied, any incremental resize is first completed
+    table_migrate(self, PY_SSIZE_T_MAX);
+    if (self->keys_array_type) {
+        // only the first keys_size elements are shared, such that appending to either does not
+        // change the other
+        new->keys = keys_view(self);
+        if (!new->keys) {
+            return -1;
+        }
+    }
+    else {
+        new->keys = PySequence_List(self->keys);
+        if (!new->keys) {
+            return -1;
+        }
+    }
+    key_count_global += self->keys_size;
+
+    new->table_size = self->table_size;
+    new->table_layout = self->table_layout;
+    new->table_old = NULL;
+    new->discarded = NULL;
+    if (self->discarded) {
+        size_t discarded_bytes = sizeof(Discarded) + self->discarded->size;
+        new->discarded = (Discarded *)PyMem_Malloc(discarded_bytes);
+        if (!new->discarded) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        memcpy(new->discarded, self->discarded, discarded_bytes);
+    }
+    new->incremental = self->incremental && PyType_IsSubtype(cls, &AMType);
+    new->mapped = false;
+    new->keys_mode = self->keys_mode;
+    new->range_start = self->range_start;
+    new->range_step = self->range_step;
+    new->keys_array_type = self->keys_array_type;
+    new->keys_size = self->keys_size;
+
+    new->key_buffer = NULL;
+    new->keys_packed = NULL;
+    if (self->keys_packed) {
+        size_t packed_bytes = Py_MAX(self->keys_size * (PyArray_ITEMSIZE((PyArrayObject *)self->keys) / UCS4_SIZE), 1);
+        new->keys_packed = (char*)PyMem_Malloc(packed_bytes);
+        if (!new->keys_packed) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        memcpy(new->keys_packed, self->keys_packed, packed_bytes);
+    }
+    else if (new->keys_array_type == KAT_UNICODE) {
+        PyArrayObject *a = (PyArrayObject *)new->keys;
+        Py_ssize_t dt_size = PyArray_ITEMSIZE(a) / UCS4_SIZE;
+        new->key_buffer = (Py_UCS4*)PyMem_Malloc((dt_size+1) * UCS4_SIZE);
+    }
+    new->keys_lengths = NULL;
+    new->keys_lengths_width = self->keys_lengths_width;
+    if (self->keys_lengths) {
+        size_t lengths_bytes = Py_MAX(self->keys_size * self->keys_lengths_width, 1);
+        new->keys_lengths = PyMem_Malloc(lengths_bytes);
+        if (!new->keys_lengths) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        memcpy(new->keys_lengths, self->keys_lengths, lengths_bytes);
+    }
+
+    new->table = NULL;
+    if (self->keys_mode != KM_TABLE) {
+        return 0;
+    }
+    size_t table_bytes = (new->table_size + SCAN - 1) * table_element_size(new->table_layout);
+    new->table = PyMem_Malloc(table_bytes);
+    if (!new->table) {
+        // Py_DECREF(new->keys); // assume this will get cleaned up
+        PyErr_NoMemory();
+        return -1;
+    }
+    memcpy(new->table, self->table, table_bytes);
+    return 0;
+}
+
+
+static PyObject *
+fam_new(PyTypeObject *cls, PyObject *args, PyObject *kwargs);
+
+
+// Create a copy of self. Used in `fam_or()`, which extends the copy; as such, a new FAMObject is
+// always created, even if self is immutable. Returns a new FAMObject on success, NULL on error.
+static FAMObject *
+copy(PyTypeObject *cls, FAMObject *self)
+{
+    // fam_new to allocate and full struct attrs
+    FAMObject *new = (FAMObject*)fam_new(cls, NULL, NULL);
+    if (!new) {
+        return NULL;
+    }
+    if (copy_to_new(cls, self, new)) {
+        Py_DECREF(new); // assume this will decref any partially set attrs of new
+        return NULL;
+    }
+    return new;
+}
+
+
+
+//------------------------------------------------------------------------------
+// appending to array keys
+
+// Set the count of characters in the KAT_UNICODE or KAT_STRING key at keys_pos.
+static inline void
+key_length_set(FAMObject *self, Py_ssize_t keys_pos, Py_ssize_t len)
+{
+    switch (self->keys_lengths_width) {
+        case 1:
+            ((npy_uint8*)self->keys_lengths)[keys_pos] = (npy_uint8)len;
+            break;
+        case 2:
+            ((npy_uint16*)self->keys_lengths)[keys_pos] = (npy_uint16)len;
+            break;
+        default:
+            ((npy_uint32*)self->keys_lengths)[keys_pos] = (npy_uint32)len;
+            break;
+    }
+}
+
+// Replace the keys array of an AutoMap of array keys with an array of `capacity` elements, copying
+// the current keys; keys_packed and keys_lengths are resized to match. Returns 0 on success, -1 on
+// error.
+static int
+keys_reserve(FAMObject *self, Py_ssize_t capacity)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    Py_ssize_t item_size = PyArray_ITEMSIZE(a);
+    PyArray_Descr *descr = PyArray_DESCR(a);
+    Py_INCREF(descr);
+    npy_intp size = capacity;
+    PyArrayObject *a_new = (PyArrayObject *)PyArray_Zeros(1, &size, descr, 0);
+    if (!a_new) {
+        return -1;
+    }
+    char *dst = PyArray_BYTES(a_new);
+    if (PyArray_IS_C_CONTIGUOUS(a)) {
+        memcpy(dst, PyArray_BYTES(a), self->keys_size * item_size);
+    }
+    else {
+        for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+            memcpy(dst + i * item_size, PyArray_GETPTR1(a, i), item_size);
+        }
+    }
+    if (self->keys_packed) {
+        char *packed = PyMem_Realloc(self->keys_packed, Py_MAX(capacity * (item_size / UCS4_SIZE), 1));
+        if (!packed) {
+            Py_DECREF(a_new);
+            PyErr_NoMemory();
+            return -1;
+        }
+        self->keys_packed = packed;
+    }
+    if (self->keys_lengths) {
+        void *lengths = PyMem_Realloc(self->keys_lengths, Py_MAX(capacity * self->keys_lengths_width, 1));
+        if (!lengths) {
+            Py_DECREF(a_new);
+            PyErr_NoMemory();
+            return -1;
+        }
+        self->keys_lengths = lengths;
+    }
+    PyArray_CLEARFLAGS(a_new, NPY_ARRAY_WRITEABLE);
+    Py_DECREF(self->keys);
+    self->keys = (PyObject *)a_new;
+    return 0;
+}
+
+// Ensure that the keys array of an AutoMap of array keys has room for `size` keys. When grown,
+// capacity is at least doubled, such that repeated appends and extends are amortized. Returns 0 on
+// success, -1 on error.
+static int
+keys_grow(FAMObject *self, Py_ssize_t size)
+{
+    Py_ssize_t capacity = PyArray_SIZE((PyArrayObject *)self->keys);
+    if (size <= capacity) {
+        return 0;
+    }
+    return keys_reserve(self, Py_MAX(size, Py_MAX(8, capacity * 2)));
+}
+
+// For KAT_UNICODE or KAT_STRING keys, replace the keys array with an array of the same capacity
+// whose dtype holds `dt_size` characters, copying the current keys; keys_packed, keys_lengths, and
+// key_buffer are resized to match. Returns 0 on success, -1 on error.
+static int
+keys_widen(FAMObject *self, Py_ssize_t dt_size)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    bool unicode = self->keys_array_type == KAT_UNICODE;
+    Py_ssize_t char_size = unicode ? UCS4_SIZE : 1;
+    Py_ssize_t dt_size_old = PyArray_ITEMSIZE(a) / char_size;
+    Py_ssize_t capacity = PyArray_SIZE(a);
+
+    PyObject *dtype = PyUnicode_FromFormat(
+            "%c%c%zd", PyArray_DESCR(a)->byteorder, unicode ? 'U' : 'S', dt_size);
+    if (!dtype) {
+        return -1;
+    }
+    PyArray_Descr *descr = NULL;
+    int ok = PyArray_DescrConverter(dtype, &descr);
+    Py_DECREF(dtype);
+    if (!ok) {
+        return -1;
+    }
+    npy_intp size = capacity;
+    PyArrayObject *a_new = (PyArrayObject *)PyArray_Zeros(1, &size, descr, 0);
+    if (!a_new) {
+        return -1;
+    }
+    char *packed = NULL;
+    void *lengths = NULL;
+    Py_UCS4 *key_buffer = NULL;
+    int width = dt_size <= UINT8_MAX ? 1 : dt_size <= UINT16_MAX ? 2 : 4;
+
+    if (self->keys_packed) {
+        packed = PyMem_Calloc(Py_MAX(capacity * dt_size, 1), 1);
+        if (!packed) {
+            goto error;
+        }
+    }
+    else if (unicode) {
+        key_buffer = PyMem_Malloc((dt_size + 1) * UCS4_SIZE);
+        if (!key_buffer) {
+            goto error;
+        }
+    }
+    if (width != self->keys_lengths_width) {
+        lengths = PyMem_Malloc(Py_MAX(capacity * width, 1));
+        if (!lengths) {
+            goto error;
+        }
+    }
+    char *dst = PyArray_BYTES(a_new);
+    for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+        memcpy(dst + i * dt_size * char_size, PyArray_GETPTR1(a, i), dt_size_old * char_size);
+        if (packed) {
+            memcpy(packed + i * dt_size, self->keys_packed + i * dt_size_old, dt_size_old);
+        }
+        if (lengths) {
+            Py_ssize_t len = key_length_at(self, i);
+            switch (width) {
+                case 1:
+                    ((npy_uint8*)lengths)[i] = (npy_uint8)len;
+                    break;
+                case 2:
+                    ((npy_uint16*)lengths)[i] = (npy_uint16)len;
+                    break;
+                default:
+                    ((npy_uint32*)lengths)[i] = (npy_uint32)len;
+                    break;
+            }
+        }
+    }
+    if (packed) {
+        PyMem_Free(self->keys_packed);
+        self->keys_packed = packed;
+    }
+    if (key_buffer) {
+        PyMem_Free(self->key_buffer);
+        self->key_buffer = key_buffer;
+    }
+    if (lengths) {
+        PyMem_Free(self->keys_lengths);
+        self->keys_lengths = lengths;
+        self->keys_lengths_width = width;
+    }
+    PyArray_CLEARFLAGS(a_new, NPY_ARRAY_WRITEABLE);
+    Py_DECREF(self->keys);
+    self->keys = (PyObject *)a_new;
+    return 0;
+error:
+    PyMem_Free(packed);
+    PyMem_Free(key_buffer);
+    Py_DECREF(a_new);
+    PyErr_NoMemory();
+    return -1;
+}
+
+// For KAT_UNICODE keys stored in keys_packed, discard keys_packed and rebuild the table with keys
+// hashed as UCS4. Called before appending a key that is not latin-1. Returns 0 on success, -1 on
+// error.
+static int
+keys_unpack(FAMObject *self)
+{
+    Py_ssize_t dt_size = PyArray_ITEMSIZE((PyArrayObject *)self->keys) / UCS4_SIZE;
+    Py_UCS4 *key_buffer = (Py_UCS4*)PyMem_Malloc((dt_size + 1) * UCS4_SIZE);
+    if (!key_buffer) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    char *packed = self->keys_packed;
+    self->keys_packed = NULL;
+    if (self->table && table_resize(self, self->table_size, self->keys_size, true)) {
+        self->keys_packed = packed;
+        PyMem_Free(key_buffer);
+        return -1;
+    }
+    PyMem_Free(packed);
+    self->key_buffer = key_buffer;
+    return 0;
+}
+
+// Replace the array keys of an AutoMap with a list of the same keys, as is done on initialization
+// for arrays that are not supported, and rebuild the table. Called before appending a key that
+// cannot be stored in the keys array. Returns 0 on success, -1 on error.
+static int
+keys_to_list(FAMObject *self)
+{
+    PyObject *view = keys_view(self);
+    if (!view) {
+        return -1;
+    }
+    PyObject *keys;
+    if (kat_is_kind(self->keys_array_type, 'M')) {
+        keys = PySequence_List(view); // force scalars
+    }
+    else {
+        keys = PyArray_ToList((PyArrayObject *)view); // converts to objs
+    }
+    Py_DECREF(view);
+    if (!keys) {
+        return -1;
+    }
+    table_migrate(self, PY_SSIZE_T_MAX);
+    PyObject *keys_old = self->keys;
+    KeysArrayType kat_old = self->keys_array_type;
+    KeysMode mode_old = self->keys_mode;
+    void *table_old = self->table;
+    Py_ssize_t size_old = self->table_size;
+    TableLayout layout_old = self->table_layout;
+
+    self->keys = keys;
+    self->keys_array_type = KAT_LIST;
+    self->keys_mode = KM_TABLE;
+    self->table = NULL;
+    self->table_size = 0;
+    self->table_layout = TL_WIDE;
+    if (grow_table(self, self->keys_size) || table_place_keys(self)) {
+        PyMem_Free(self->table);
+        self->keys = keys_old;
+        self->keys_array_type = kat_old;
+        self->keys_mode = mode_old;
+        self->table = table_old;
+        self->table_size = size_old;
+        self->table_layout = layout_old;
+        Py_DECREF(keys);
+        return -1;
+    }
+    PyMem_Free(table_old);
+    Py_DECREF(keys_old);
+    PyMem_Free(self->key_buffer);
+    PyMem_Free(self->keys_packed);
+    PyMem_Free(self->keys_lengths);
+    self->key_buffer = NULL;
+    self->keys_packed = NULL;
+    self->keys_lengths = NULL;
+    return 0;
+}
+
+// Given a Python or NumPy integer, set `v` to its value. Returns 1 on success, 0 if `key` is not an
+// integer or its value is out of range, -1 on error.
+static int
+key_as_int(PyObject *key, npy_int64 *v)
+{
+    if (!PyLong_Check(key) && !PyArray_IsScalar(key, Integer)) {
+        return 0;
+    }
+    PyObject *index = PyNumber_Index(key);
+    if (!index) {
+        return -1;
+    }
+    int overflow;
+    *v = PyLong_AsLongLongAndOverflow(index, &overflow);
+    Py_DECREF(index);
+    if (*v == -1 && PyErr_Occurred()) {
+        return -1;
+    }
+    return !overflow;
+}
+
+static int
+key_as_uint(PyObject *key, npy_uint64 *v)
+{
+    if (!PyLong_Check(key) && !PyArray_IsScalar(key, Integer)) {
+        return 0;
+    }
+    PyObject *index = PyNumber_Index(key);
+    if (!index) {
+        return -1;
+    }
+    *v = PyLong_AsUnsignedLongLong(index);
+    Py_DECREF(index);
+    if (*v == (npy_uint64)-1 && PyErr_Occurred()) {
+        if (PyErr_ExceptionMatches(PyExc_OverflowError)) { // negative or too large
+            PyErr_Clear();
+            return 0;
+        }
+        return -1;
+    }
+    return 1;
+}
+
+// Store a signed or unsigned integer `v` at `p` if within the range of `npy_type`. Depends on v and
+// p.
+# define STORE_INT(npy_type, min, max)                                        \
+{                                                                             \
+    if (v < (min) || v > (max)) {                                             \
+        return 0;                                                             \
+    }                                                                         \
+    *(npy_type*)p = (npy_type)v;                                              \
+    return 1;                                                                 \
+}                                                                             \
+
+# define STORE_UINT(npy_type, max)                                            \
+{                                                                             \
+    if (v > (max)) {                                                          \
+        return 0;                                                             \
+    }                                                                         \
+    *(npy_type*)p = (npy_type)v;                                              \
+    return 1;                                                                 \
+}                                                                             \
+
+// Store `key` in the keys array at keys_pos, if `key` can be represented exactly in its dtype;
+// flexible dtypes are widened, and packed keys unpacked, as needed. Returns 1 if stored, 0 if `key`
+// cannot be represented, -1 on error.
+static int
+key_store(FAMObject *self, PyObject *key, Py_ssize_t keys_pos)
+{
+    KeysArrayType kat = self->keys_array_type;
+    void *p = PyArray_GETPTR1((PyArrayObject *)self->keys, keys_pos);
+    int ok;
+    if (kat_is_kind(kat, 'i')) {
+        npy_int64 v;
+        if ((ok = key_as_int(key, &v)) <= 0) {
+            return ok;
+        }
+        switch (kat) {
+            case KAT_INT32:
+                STORE_INT(npy_int32, NPY_MIN_INT32, NPY_MAX_INT32);
+            case KAT_INT16:
+                STORE_INT(npy_int16, NPY_MIN_INT16, NPY_MAX_INT16);
+            case KAT_INT8:
+                STORE_INT(npy_int8, NPY_MIN_INT8, NPY_MAX_INT8);
+            default:
+                STORE_INT(npy_int64, NPY_MIN_INT64, NPY_MAX_INT64);
+        }
+    }
+    if (kat_is_kind(kat, 'u')) {
+        npy_uint64 v;
+        if ((ok = key_as_uint(key, &v)) <= 0) {
+            return ok;
+        }
+        switch (kat) {
+            case KAT_UINT32:
+                STORE_UINT(npy_uint32, NPY_MAX_UINT32);
+            case KAT_UINT16:
+                STORE_UINT(npy_uint16, NPY_MAX_UINT16);
+            case KAT_UINT8:
+                STORE_UINT(npy_uint8, NPY_MAX_UINT8);
+            default:
+                STORE_UINT(npy_uint64, NPY_MAX_UINT64);
+        }
+    }
+    if (kat_is_kind(kat, 'f')) {
+        npy_double d;
+        if (PyFloat_Check(key) ||
+                (PyArray_IsScalar(key, Floating) && !PyArray_IsScalar(key, LongDouble))) {
+            d = PyFloat_AsDouble(key);
+            if (d == -1.0 && PyErr_Occurred()) {
+                return -1;
+            }
+        }
+        else {
+            npy_int64 v;
+            if ((ok = key_as_int(key, &v)) <= 0) {
+                return ok;
+            }
+            if (v > ((npy_int64)1 << 53) || v < -((npy_int64)1 << 53)) { // not exact as a double
+                return 0;
+            }
+            d = (npy_double)v;
+        }
+        switch (kat) {
+            case KAT_FLOAT32: {
+                if (npy_isfinite(d) && (d > FLT_MAX || d < -FLT_MAX)) {
+                    return 0;
+                }
+                npy_float f = (npy_float)d;
+                if (f != d && !npy_isnan(d)) {
+                    return 0;
+                }
+                *(npy_float*)p = f;
+                return 1;
+            }
+            case KAT_FLOAT16: {
+                npy_half h = npy_double_to_half(d);
+                if (npy_half_to_double(h) != d && !npy_isnan(d)) {
+                    return 0;
+                }
+                *(npy_half*)p = h;
+                return 1;
+            }
+            default:
+                *(npy_double*)p = d;
+                return 1;
+        }
+    }
+    if (kat == KAT_UNICODE) {
+        if (!PyUnicode_Check(key)) {
+            return 0;
+        }
+        Py_ssize_t len = PyUnicode_GET_LENGTH(key);
+        if (len && PyUnicode_READ_CHAR(key, len - 1) == 0) { // would be dropped by the array
+            return 0;
+        }
+        Py_ssize_t dt_size = PyArray_ITEMSIZE((PyArrayObject *)self->keys) / UCS4_SIZE;
+        if (len > dt_size) {
+            if (keys_widen(self, len)) {
+                return -1;
+            }
+            dt_size = len;
+        }
+        if (self->keys_packed && PyUnicode_KIND(key) != PyUnicode_1BYTE_KIND && keys_unpack(self)) {
+            return -1;
+        }
+        Py_UCS4 *k = (Py_UCS4*)PyArray_GETPTR1((PyArrayObject *)self->keys, keys_pos);
+        if (len && !PyUnicode_AsUCS4(key, k, dt_size, 0)) {
+            return -1;
+        }
+        memset(k + len, 0, (dt_size - len) * UCS4_SIZE);
+        if (self->keys_packed) {
+            char *kp = self->keys_packed + keys_pos * dt_size;
+            memcpy(kp, PyUnicode_1BYTE_DATA(key), len);
+            memset(kp + len, 0, dt_size - len);
+        }
+        key_length_set(self, keys_pos, len);
+        return 1;
+    }
+    if (kat == KAT_STRING) {
+        if (!PyBytes_Check(key)) {
+            return 0;
+        }
+        Py_ssize_t len = PyBytes_GET_SIZE(key);
+        const char *v = PyBytes_AS_STRING(key);
+        if (len && v[len - 1] == 0) { // would be dropped by the array
+            return 0;
+        }
+        Py_ssize_t dt_size = PyArray_ITEMSIZE((PyArrayObject *)self->keys);
+        if (len > dt_size) {
+            if (keys_widen(self, len)) {
+                return -1;
+            }
+            dt_size = len;
+        }
+        char *k = (char*)PyArray_GETPTR1((PyArrayObject *)self->keys, keys_pos);
+        memcpy(k, v, len);
+        memset(k + len, 0, dt_size - len);
+        key_length_set(self, keys_pos, len);
+        return 1;
+    }
+    // all datetime64 KATs
+    if (!PyArray_IsScalar(key, Datetime)) {
+        return 0;
+    }
+    npy_int64 v = (npy_int64)PyArrayScalar_VAL(key, Datetime);
+    if (v != NPY_DATETIME_NAT && !kat_is_datetime_unit(
+            kat, dt_unit_from_scalar((PyDatetimeScalarObject *)key))) {
+        return 0;
+    }
+    *(npy_int64*)p = v;
+    return 1;
+}
+
+# undef STORE_INT
+# undef STORE_UINT
+
+// Given the array key stored at keys_pos and its hash, return the table_pos of an equal key, or if
+// not found, the first table position that has not been assigned.
+static Py_ssize_t
+lookup_hash_key_at(FAMObject *self, Py_ssize_t keys_pos, Py_hash_t hash)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    void *p = PyArray_GETPTR1(a, keys_pos);
+    KeysArrayType kat = self->keys_array_type;
+    switch (kat) {
+        case KAT_INT64:
+            return lookup_hash_int(self, *(npy_int64*)p, hash, kat);
+        case KAT_INT32:
+            return lookup_hash_int(self, *(npy_int32*)p, hash, kat);
+        case KAT_INT16:
+            return lookup_hash_int(self, *(npy_int16*)p, hash, kat);
+        case KAT_INT8:
+            return lookup_hash_int(self, *(npy_int8*)p, hash, kat);
+        case KAT_UINT64:
+            return lookup_hash_uint(self, *(npy_uint64*)p, hash, kat);
+        case KAT_UINT32:
+            return lookup_hash_uint(self, *(npy_uint32*)p, hash, kat);
+        case KAT_UINT16:
+            return lookup_hash_uint(self, *(npy_uint16*)p, hash, kat);
+        case KAT_UINT8:
+            return lookup_hash_uint(self, *(npy_uint8*)p, hash, kat);
+        case KAT_FLOAT64:
+            return lookup_hash_double(self, *(npy_double*)p, hash, kat);
+        case KAT_FLOAT32:
+            return lookup_hash_double(self, *(npy_float*)p, hash, kat);
+        case KAT_FLOAT16:
+            return lookup_hash_double(self, npy_half_to_double(*(npy_half*)p), hash, kat);
+        case KAT_UNICODE:
+            if (self->keys_packed) {
+                Py_ssize_t dt_size = PyArray_ITEMSIZE(a) / UCS4_SIZE;
+                return lookup_hash_packed(self, self->keys_packed + keys_pos * dt_size,
+                        key_length_at(self, keys_pos), hash);
+            }
+            return lookup_hash_unicode(self, (Py_UCS4*)p, key_length_at(self, keys_pos), hash);
+        case KAT_STRING:
+            return lookup_hash_string(self, (char*)p, key_length_at(self, keys_pos), hash);
+        case KAT_LIST:
+            return -1;
+        default: // all datetime64 KATs
+            return lookup_hash_int(self, *(npy_int64*)p, hash, KAT_INT64);
+    }
+}
+
+// Insert the array key stored at keys_pos into the table, replacing an equal discarded key. Returns
+// 0 on success, -1 on error, including a NonUniqueError if the key is already in the table.
+static int
+insert_key_at(FAMObject *self, Py_ssize_t keys_pos)
+{
+    Py_hash_t hash = key_hash_at(self, keys_pos);
+    if (self->table_old) {
+        table_migrate(self, MIGRATE_STEP);
+    }
+    if (self->table_old) {
+        table_swap_old(self);
+        Py_ssize_t kp = found_keys_pos(self, lookup_hash_key_at(self, keys_pos, hash));
+        table_swap_old(self);
+        if (kp != -1 && !key_discarded(self, kp)) {
+            set_non_unique_error(self, keys_pos);
+            return -1;
+        }
+    }
+    Py_ssize_t table_pos = lookup_hash_key_at(self, keys_pos, hash);
+    if (table_pos < 0) {
+        return -1;
+    }
+    // a discarded key is replaced
+    Py_ssize_t kp = table_keys_pos(self, table_pos);
+    if (kp != -1 && !key_discarded(self, kp)) {
+        set_non_unique_error(self, keys_pos);
+        return -1;
+    }
+    table_set(self, table_pos, keys_pos, hash);
+    return 0;
+}
+
+// For KM_RANGE keys, return true if the key stored at keys_pos continues the range, as checked in
+// range_init().
+static bool
+range_continues(FAMObject *self, Py_ssize_t keys_pos)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    npy_int64 prev, k;
+    switch (self->keys_array_type) {
+        case KAT_INT32:
+            prev = *(npy_int32*)PyArray_GETPTR1(a, keys_pos - 1);
+            k = *(npy_int32*)PyArray_GETPTR1(a, keys_pos);
+            break;
+        case KAT_INT16:
+            prev = *(npy_int16*)PyArray_GETPTR1(a, keys_pos - 1);
+            k = *(npy_int16*)PyArray_GETPTR1(a, keys_pos);
+            break;
+        case KAT_INT8:
+            prev = *(npy_int8*)PyArray_GETPTR1(a, keys_pos - 1);
+            k = *(npy_int8*)PyArray_GETPTR1(a, keys_pos);
+            break;
+        default: // KAT_INT64 and all datetime64 KATs
+            prev = *(npy_int64*)PyArray_GETPTR1(a, keys_pos - 1);
+            k = *(npy_int64*)PyArray_GETPTR1(a, keys_pos);
+            break;
+    }
+    return (k > prev) == (self->range_step > 0)
+            && (npy_int64)((npy_uint64)k - (npy_uint64)prev) == self->range_step;
+}
+
+// Compare the KM_SORTED key of `npy_type` at keys_pos to the key before it, returning 1 if greater,
+// 0 if equal, and -1 if less or unordered. Depends on a and keys_pos.
+# define SORTED_COMPARE(npy_type, post_deref)                                  \
+{                                                                              \
+    npy_double prev = post_deref(*(npy_type*)PyArray_GETPTR1(a, keys_pos - 1)); \
+    npy_double k = post_deref(*(npy_type*)PyArray_GETPTR1(a, keys_pos));       \
+    return k > prev ? 1 : k == prev ? 0 : -1;                                  \
+}                                                                              \
+
+# define SORTED_COMPARE_INT(npy_type)                                          \
+{                                                                              \
+    npy_type prev = *(npy_type*)PyArray_GETPTR1(a, keys_pos - 1);              \
+    npy_type k = *(npy_type*)PyArray_GETPTR1(a, keys_pos);                     \
+    return k > prev ? 1 : k == prev ? 0 : -1;                                  \
+}                                                                              \
+
+static int
+sorted_compare(FAMObject *self, Py_ssize_t keys_pos)
+{
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    switch (self->keys_array_type) {
+        case KAT_INT32:
+            SORTED_COMPARE_INT(npy_int32);
+        case KAT_INT16:
+            SORTED_COMPARE_INT(npy_int16);
+        case KAT_INT8:
+            SORTED_COMPARE_INT(npy_int8);
+        case KAT_UINT64:
+            SORTED_COMPARE_INT(npy_uint64);
+        case KAT_UINT32:
+            SORTED_COMPARE_INT(npy_uint32);
+        case KAT_UINT16:
+            SORTED_COMPARE_INT(npy_uint16);
+        case KAT_UINT8:
+            SORTED_COMPARE_INT(npy_uint8);
+        case KAT_FLOAT64:
+            SORTED_COMPARE(npy_double,);
+        case KAT_FLOAT32:
+            SORTED_COMPARE(npy_float,);
+        case KAT_FLOAT16:
+            SORTED_COMPARE(npy_half, npy_half_to_double);
+        default: // KAT_INT64 and all datetime64 KATs
+            SORTED_COMPARE_INT(npy_int64);
+    }
+}
+
+# undef SORTED_COMPARE
+# undef SORTED_COMPARE_INT
+
+// Add the key stored in the keys array at keys_size to an AutoMap of array keys. KM_RANGE keys
+// remain a range if the key continues the range, and otherwise change to KM_TABLE; KM_SORTED keys
+// must remain strictly increasing. Returns 0 on success, -1 on error.
+static int
+append_stored_key(FAMObject *self)
+{
+    Py_ssize_t keys_pos = self->keys_size;
+    switch (self->keys_mode) {
+        case KM_RANGE:
+            if (range_continues(self, keys_pos)) {
+                if (int_cache_fill(keys_pos + 1)) {
+                    return -1;
+                }
+                break;
+            }
+            // all current keys are placed in a new table
+            self->keys_mode = KM_TABLE;
+            if (grow_table(self, keys_pos + 1) || table_place_keys(self)) {
+                PyMem_Free(self->table);
+                self->table = NULL;
+                self->table_size = 0;
+                self->keys_mode = KM_RANGE;
+                return -1;
+            }
+            // fall through
+        case KM_TABLE:
+            if (grow_table(self, keys_pos + 1) || insert_key_at(self, keys_pos)) {
+                return -1;
+            }
+            break;
+        case KM_SORTED: {
+            int cmp = keys_pos ? sorted_compare(self, keys_pos) : 1;
+            if (cmp <= 0) {
+                if (cmp == 0) {
+                    set_non_unique_error(self, keys_pos);
+                }
+                else {
+                    PyErr_Format(PyExc_ValueError,
+                            "%s keys must be in increasing order when sorted",
+                            Py_TYPE(self)->tp_name);
+                }
+                return -1;
+            }
+            if (int_cache_fill(keys_pos + 1)) {
+                return -1;
+            }
+            break;
+        }
+    }
+    self->keys_size++;
+    key_count_global++;
+    return 0;
+}
+
+// Append `key` to an AutoMap of array keys, storing it in the keys array and then adding it with
+// append_stored_key(). Returns 1 if `key` cannot be stored in the keys array (and nothing has been
+// done), 0 on success, -1 on error.
+static int
+append_array_key(FAMObject *self, PyObject *key)
+{
+    Py_ssize_t keys_pos = self->keys_size;
+    if (keys_grow(self, keys_pos + 1)) {
+        return -1;
+    }
+    int stored = key_store(self, key, keys_pos);
+    if (stored <= 0) {
+        if (stored == 0 && self->keys_mode == KM_SORTED) {
+            PyErr_Format(PyExc_ValueError,
+                    "%s sorted keys must be an array of numbers or datetime64",
+                    Py_TYPE(self)->tp_name);
+            return -1;
+        }
+        return stored ? -1 : 1;
+    }
+    return append_stored_key(self);
+}
+
+
+// Returns -1 on error, 0 on success.
+static int
+append(FAMObject *self, PyObject *key)
+{
+    if (self->keys_array_type) {
+        int err = append_array_key(self, key);
+        if (err <= 0) {
+            return err;
+        }
+        // the key cannot be stored in the keys array: continue with list keys
+        if (keys_to_list(self)) {
+            return -1;
+        }
+    }
+    if (grow_table(self, self->keys_size + 1)) {
+        return -1;
+    }
+    if (insert_obj(self, key, self->keys_size, -1) ||
+        PyList_Append(self->keys, key))
+    {
+        return -1;
+    }
+    key_count_global++;
+    self->keys_size++;
+    return 0;
+}
+
+
+// Extend with an iterable of keys, appending each as a Python object. Returns -1 on error, 0 on
+// success.
+static int
+extend_objects(FAMObject *self, PyObject *keys)
+{
+    keys = PySequence_Fast(keys, "expected an iterable of keys");
+    if (!keys) {
+        return -1;
+    }
+    Py_ssize_t size_extend = PySequence_Fast_GET_SIZE(keys);
+    Py_ssize_t size_new = self->keys_size + size_extend;
+    // grow once for all keys; as keys are appended, array keys might change to list keys
+    if ((self->keys_array_type && keys_grow(self, size_new))
+            || (self->keys_mode == KM_TABLE && grow_table(self, size_new))) {
+        Py_DECREF(keys);
+        return -1;
+    }
+    PyObject **keys_fi = PySequence_Fast_ITEMS(keys);
+    for (Py_ssize_t index = 0; index < size_extend; index++) {
+        if (append(self, keys_fi[index])) {
+            Py_DECREF(keys);
+            return -1;
+        }
+    }
+    Py_DECREF(keys);
+    return 0;
+}
+
+// Change an empty AutoMap of list keys to array keys of the dtype of `array`, if that dtype is
+// supported on initialization, such that the keys of `array` can be extended in bulk. Returns 0 on
+// success (whether or not changed), -1 on error.
+static int
+keys_to_array(FAMObject *self, PyArrayObject *array)
+{
+    int array_t = PyArray_TYPE(array);
+    if (!(PyTypeNum_ISINTEGER(array_t)
+            || PyTypeNum_ISFLOAT(array_t)
+            || PyTypeNum_ISFLEXIBLE(array_t)
+            || array_t == NPY_DATETIME)
+            || !PyArray_ISNOTSWAPPED(array)) {
+        return 0;
+    }
+    KeysArrayType kat = at_to_kat(array_t, array);
+    if (!kat) {
+        return 0;
+    }
+    PyArray_Descr *descr = PyArray_DESCR(array);
+    Py_INCREF(descr);
+    npy_intp size = 0;
+    PyArrayObject *keys = (PyArrayObject *)PyArray_Zeros(1, &size, descr, 0);
+    if (!keys) {
+        return -1;
+    }
+    PyArray_CLEARFLAGS(keys, NPY_ARRAY_WRITEABLE);
+    Py_DECREF(self->keys);
+    self->keys = (PyObject *)keys;
+    self->keys_array_type = kat;
+    table_migrate(self, PY_SSIZE_T_MAX);
+    PyMem_Free(self->table);
+    self->table = NULL;
+    self->table_size = 0;
+    self->table_layout = table_layout_for(kat, 0, false);
+    if ((kat == KAT_UNICODE || kat == KAT_STRING) && lengths_init(self)) {
+        return -1;
+    }
+    if (kat == KAT_UNICODE) {
+        self->key_buffer = (Py_UCS4*)PyMem_Malloc((PyArray_ITEMSIZE(keys) / UCS4_SIZE + 1) * UCS4_SIZE);
+        if (!self->key_buffer) {
+            PyErr_NoMemory();
+            return -1;
+        }
+    }
+    return 0;
+}
+
+// Return true if the keys of `array` can be copied to the keys array of an AutoMap without changing
+// their values: numeric arrays that cast safely (other than integers to floats), flexible arrays of
+// the same kind, and datetime64 arrays of the same unit.
+static bool
+keys_is_extend_array(FAMObject *self, PyArrayObject *array)
+{
+    KeysArrayType kat = self->keys_array_type;
+    int array_t = PyArray_TYPE(array);
+    if (kat_is_kind(kat, 'i') || kat_is_kind(kat, 'u') || kat_is_kind(kat, 'f')) {
+        if (!PyTypeNum_ISINTEGER(array_t) && !PyTypeNum_ISFLOAT(array_t)) {
+            return false;
+        }
+        if (kat_is_kind(kat, 'f') && PyTypeNum_ISINTEGER(array_t)) {
+            return false;
+        }
+        return PyArray_CanCastTypeTo(PyArray_DESCR(array),
+                PyArray_DESCR((PyArrayObject *)self->keys), NPY_SAFE_CASTING);
+    }
+    if (!PyArray_ISNOTSWAPPED(array)) {
+        return false;
+    }
+    if (kat == KAT_UNICODE) {
+        return array_t == NPY_UNICODE;
+    }
+    if (kat == KAT_STRING) {
+        return array_t == NPY_STRING;
+    }
+    return array_t == NPY_DATETIME && at_to_kat(array_t, array) == kat;
+}
+
+// Extend with the keys of a 1D array. If the array keys can be copied to the keys array of the
+// AutoMap, they are copied in bulk and each is added with append_stored_key(); otherwise, keys are
+// converted to Python objects and appended. Returns -1 on error, 0 on success.
+static int
+extend_array(FAMObject *self, PyArrayObject *array)
+{
+    if (PyArray_NDIM(array) != 1) {
+        PyErr_SetString(PyExc_TypeError, "Arrays must be 1-dimensional");
+        return -1;
+    }
+    Py_ssize_t size_extend = PyArray_SIZE(array);
+    Py_ssize_t keys_size = self->keys_size;
+    bool empty = keys_size == 0 && !self->keys_array_type;
+    if (empty && size_extend && keys_to_array(self, array)) {
+        return -1;
+    }
+    if (!self->keys_array_type || !keys_is_extend_array(self, array)) {
+        int array_t = PyArray_TYPE(array);
+        PyObject *keys;
+        if (array_t == NPY_DATETIME || array_t == NPY_TIMEDELTA) {
+            keys = PySequence_List((PyObject *)array); // force scalars
+        }
+        else {
+            keys = PyArray_ToList(array); // converts to objs
+        }
+        if (!keys) {
+            return -1;
+        }
+        int err = extend_objects(self, keys);
+        Py_DECREF(keys);
+        return err;
+    }
+    if (!size_extend) {
+        return 0;
+    }
+    KeysArrayType kat = self->keys_array_type;
+    bool flexible = kat == KAT_UNICODE || kat == KAT_STRING;
+    Py_ssize_t char_size = kat == KAT_UNICODE ? UCS4_SIZE : 1;
+    if (flexible && PyArray_ITEMSIZE(array) > PyArray_ITEMSIZE((PyArrayObject *)self->keys)
+            && keys_widen(self, PyArray_ITEMSIZE(array) / char_size)) {
+        return -1;
+    }
+    Py_ssize_t size_new = keys_size + size_extend;
+    if (keys_grow(self, size_new)) {
+        return -1;
+    }
+    PyArrayObject *a = (PyArrayObject *)self->keys;
+    PyArrayObject *src = array;
+    if (!flexible && !PyArray_EquivTypes(PyArray_DESCR(array), PyArray_DESCR(a))) {
+        PyArray_Descr *descr = PyArray_DESCR(a);
+        Py_INCREF(descr);
+        src = (PyArrayObject *)PyArray_CastToType(array, descr, 0);
+        if (!src) {
+            return -1;
+        }
+    }
+    else {
+        Py_INCREF(src);
+    }
+    Py_ssize_t item_size = PyArray_ITEMSIZE(a);
+    Py_ssize_t item_size_src = PyArray_ITEMSIZE(src);
+    Py_ssize_t dt_size = item_size / char_size;
+    char *dst = PyArray_BYTES(a) + keys_size * item_size;
+    if (item_size == item_size_src && PyArray_IS_C_CONTIGUOUS(src)) {
+        memcpy(dst, PyArray_BYTES(src), size_extend * item_size);
+    }
+    else {
+        for (Py_ssize_t i = 0; i < size_extend; i++) {
+            memcpy(dst + i * item_size, PyArray_GETPTR1(src, i), item_size_src);
+            memset(dst + i * item_size + item_size_src, 0, item_size - item_size_src);
+        }
+    }
+    Py_DECREF(src);
+
+    if (flexible) {
+        Py_ssize_t len;
+        for (Py_ssize_t i = 0; i < size_extend; i++) {
+            char *k = dst + i * item_size;
+            if (kat == KAT_UNICODE) {
+                len = ucs4_get_end_p((Py_UCS4*)k, dt_size) - (Py_UCS4*)k;
+                if (self->keys_packed && !ucs4_to_latin1(
+                        (Py_UCS4*)k, dt_size, self->keys_packed + (keys_size + i) * dt_size)
+                        && keys_unpack(self)) {
+                    return -1;
+                }
+            }
+            else {
+                len = char_get_end_p(k, dt_size) - k;
+            }
+            key_length_set(self, keys_size + i, len);
+        }
+    }
+    if (empty && size_extend > 1) { // as on initialization, keys of constant step need no table
+        self->keys_size = size_new;
+        if (range_init(self)) {
+            key_count_global += size_extend;
+            return int_cache_fill(size_new);
+        }
+        self->keys_size = keys_size;
+    }
+    if (self->keys_mode == KM_TABLE && grow_table(self, size_new)) {
+        return -1;
+    }
+    for (Py_ssize_t i = 0; i < size_extend; i++) {
+        if (append_stored_key(self)) {
+            return -1;
+        }
+    }
+    return 0;
+}
+
+// Extend with the keys of another FAM, other than discarded keys. If both have list keys, the
+// hashes stored in the table of `other` are reused; otherwise, keys are extended as array keys or
+// Python objects. Returns -1 on error, 0 on success.
+static int
+extend_map(FAMObject *self, FAMObject *other)
+{
+    if (self->keys_array_type || other->keys_array_type) {
+        PyObject *keys = keys_live(other);
+        if (!keys) {
+            return -1;
+        }
+        int err = other->keys_array_type
+                ? extend_array(self, (PyArrayObject *)keys)
+                : extend_objects(self, keys);
+        Py_DECREF(keys);
+        return err;
+    }
+    // list keys are always in a TL_WIDE table, which must have all keys
+    table_migrate(other, PY_SSIZE_T_MAX);
+    Py_ssize_t size_extend = other->keys_size;
+    Py_hash_t *hashes = PyMem_New(Py_hash_t, Py_MAX(size_extend, 1));
+    if (!hashes) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    TableElement *te = (TableElement *)other->table;
+    for (Py_ssize_t table_pos = 0; table_pos < other->table_size + SCAN - 1; table_pos++) {
+        if (te[table_pos].keys_pos != -1) {
+            hashes[te[table_pos].keys_pos] = te[table_pos].hash;
+        }
+    }
+    if (grow_table(self, self->keys_size + size_extend)) {
+        PyMem_Free(hashes);
+        return -1;
+    }
+    PyObject *key;
+    for (Py_ssize_t i = 0; i < size_extend; i++) {
+        if (key_discarded(other, i)) {
+            continue;
+        }
+        key = PyList_GET_ITEM(other->keys, i);
+        if (insert_obj(self, key, self->keys_size, hashes[i]) ||
+            PyList_Append(self->keys, key))
+        {
+            PyMem_Free(hashes);
+            return -1;
+        }
+        key_count_global++;
+        self->keys_size++;
+    }
+    PyMem_Free(hashes);
+    return 0;
+}
+
+// Extend with another FAM, an array, or an iterable of keys. Returns -1 on error, 0 on success.
+static int
+extend(FAMObject *self, PyObject *keys)
+{
+    if (PyObject_TypeCheck(keys, &FAMType)) {
+        return extend_map(self, (FAMObject *)keys);
+    }
+    if (PyArray_Check(keys)) {
+        return extend_array(self, (PyArrayObject *)keys);
+    }
+    return extend_objects(self, keys);
+}
+
+
+// Reserve room for `capacity` keys in an AutoMap, such that appending keys up to that count does
+// not grow the keys array, the table, or the int_cache. List keys grow as Python lists do. Returns
+// 0 on success, -1 on error.
+static int
+reserve(FAMObject *self, Py_ssize_t capacity)
+{
+    if (self->keys_array_type
+            && capacity > PyArray_SIZE((PyArrayObject *)self->keys)
+            && keys_reserve(self, capacity)) {
+        return -1;
+    }
+    if (self->keys_mode == KM_TABLE) {
+        return grow_table(self, capacity); // also fills the int_cache
+    }
+    return int_cache_fill(capacity);
+}
+
+
+//------------------------------------------------------------------------------
+// discarding keys
+
+// Mark the key at keys_pos as discarded. Returns 0 on success, -1 on error.
+static int
+discard_at(FAMObject *self, Py_ssize_t keys_pos)
+{
+    Discarded *d = self->discarded;
+    Py_ssize_t size = d ? d->size : 0;
+    if (keys_pos >= size) {
+        // flags are at least doubled, such that discarding recently appended keys is amortized
+        Py_ssize_t size_new = Py_MAX(self->keys_size, size * 2);
+        d = (Discarded *)PyMem_Realloc(self->discarded, sizeof(Discarded) + size_new);
+        if (!d) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        if (!size) {
+            d->count = 0;
+        }
+        memset(d->flags + size, 0, size_new - size);
+        d->size = size_new;
+        self->discarded = d;
+    }
+    d->flags[keys_pos] = 1;
+    d->count++;
+    return 0;
+}
+
+// Remove discarded keys, such that the remaining keys are at consecutive positions, and rebuild the
+// table. Returns a new int64 array of the new position of each previous position, or -1 if
+// discarded; returns NULL on error, leaving the keys unchanged.
+static PyObject *
+compact(FAMObject *self)
+{
+    npy_intp size = self->keys_size;
+    PyArrayObject *remap = (PyArrayObject *)PyArray_SimpleNew(1, &size, NPY_INT64);
+    if (!remap) {
+        return NULL;
+    }
+    npy_int64 *r = (npy_int64 *)PyArray_DATA(remap);
+    Py_ssize_t size_new = 0;
+    for (Py_ssize_t i = 0; i < size; i++) {
+        r[i] = key_discarded(self, i) ? -1 : size_new++;
+    }
+    if (!self->discarded) {
+        return (PyObject *)remap;
+    }
+    table_migrate(self, PY_SSIZE_T_MAX);
+    PyObject *keys = keys_live(self);
+    if (!keys) {
+        Py_DECREF(remap);
+        return NULL;
+    }
+    // all memory is allocated before the keys are changed; as KM_RANGE keys might no longer form a
+    // range, they are given a table
+    void *table = NULL;
+    Py_ssize_t table_size = 0;
+    TableLayout layout = self->table_layout;
+    if (self->keys_mode != KM_SORTED) {
+        table_size = table_size_for(size_new);
+        if (layout != TL_INLINE) {
+            layout = table_layout_for(self->keys_array_type, size_new, false);
+        }
+        size_t table_bytes = (table_size + SCAN - 1) * table_element_size(layout);
+        table = PyMem_Malloc(table_bytes);
+        if (!table) {
+            Py_DECREF(keys);
+            Py_DECREF(remap);
+            PyErr_NoMemory();
+            return NULL;
+        }
+        // initialize all fields, including keys_pos, to -1
+        memset(table, 0xFF, table_bytes);
+    }
+
+    if (self->keys_packed || self->keys_lengths) {
+        Py_ssize_t dt_size = PyArray_ITEMSIZE((PyArrayObject *)self->keys) / UCS4_SIZE;
+        for (Py_ssize_t i = 0; i < size; i++) {
+            if (r[i] == -1 || r[i] == i) {
+                continue;
+            }
+            if (self->keys_packed) {
+                memcpy(self->keys_packed + r[i] * dt_size, self->keys_packed + i * dt_size, dt_size);
+            }
+            key_length_set(self, r[i], key_length_at(self, i));
+        }
+    }
+    Py_DECREF(self->keys);
+    self->keys = keys;
+    self->keys_size = size_new;
+    key_count_global -= self->discarded->count;
+    PyMem_Free(self->discarded);
+    self->discarded = NULL;
+
+    if (self->keys_mode == KM_SORTED || (self->keys_mode == KM_RANGE && range_init(self))) {
+        PyMem_Free(table);
+    }
+    else {
+        void *table_old = self->table;
+        Py_ssize_t size_old = self->table_size;
+        TableLayout layout_old = self->table_layout;
+        self->table = table;
+        self->table_size = table_size;
+        self->table_layout = layout;
+        self->keys_mode = KM_TABLE;
+        if (table_old && layout_old == TL_WIDE) {
+            TableElement *te = (TableElement *)table_old;
+            for (Py_ssize_t table_pos = 0; table_pos < size_old + SCAN - 1; table_pos++) {
+                if (te[table_pos].keys_pos != -1 && r[te[table_pos].keys_pos] != -1) {
+                    table_place(self, r[te[table_pos].keys_pos], te[table_pos].hash);
+                }
+            }
+        }
+        else {
+            // as list keys are always in a TL_WIDE table, hashes of array keys are computed without
+            // error
+            table_place_keys(self);
+        }
+        PyMem_Free(table_old);
+    }
+    int_cache_remove(key_count_global);
+    return (PyObject *)remap;
+}
+
+
+static Py_ssize_t
+fam_length(FAMObject *self)
+{
+    if (self->discarded) {
+        return self->keys_size - self->discarded->count;
+    }
+    return self->keys_size;
+}
+
+
+// Given a key for a FAM, return the Python integer (via the int_cache) associated with that key. Utility function used in both fam_subscript() and fam_get()
+static PyObject *
+get(FAMObject *self, PyObject *key, PyObject *missing) {
+    Py_ssize_t keys_pos = lookup(self, key);
+    if (keys_pos < 0) {
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
+        if (missing) {
+            Py_INCREF(missing);
+            return missing;
+        }
+        PyErr_SetObject(PyExc_KeyError, key);
+        return NULL;
+    }
+    // use a C-integer to fetch the Python integer
+    return int_cache_get(keys_pos);
+}
+
+
+// Arguments for a worker that looks up a contiguous range of keys from a typed array; see
+// kat_is_lookup_array().
+typedef struct LookupRange {
+    FAMObject *fam;
+    PyArrayObject *key_array;
+    Py_ssize_t start;
+    Py_ssize_t stop;
+    void *positions; // shared output of position_t, indexed by key position; -1 if not found
+    bool stop_on_missing;
+    Py_ssize_t missing; // index of the first key not found in the range, or -1
+    char *packed; // if the FAM has keys_packed, storage for narrowing a block of UCS4 keys to latin-1
+} LookupRange;
+
+// Lookup all keys in the range and store their keys_pos, or -1 if not found. For each block of
+// keys, hashes are computed, and then table elements and stored keys are prefetched, before the
+// probes are resolved. Depends on self, lr, key_array, positions.
+# define LOOKUP_SCALARS(npy_type_src, npy_type_dst, lookup_func, hash_func, convert_func) \
+{                                                                       \
+    npy_type_dst v[LOOKUP_BLOCK];                                       \
+    bool ok[LOOKUP_BLOCK];                                              \
+    Py_hash_t h[LOOKUP_BLOCK];                                          \
+    Py_ssize_t mask = self->table_size - 1;                             \
+    char *table = (char *)self->table;                                  \
+    size_t te_size = table_element_size(self->table_layout);            \
+    bool inline_keys = self->table_layout == TL_INLINE;                 \
+    KeysArrayType kat = self->keys_array_type;                          \
+    Py_ssize_t table_pos, kp, block, i, j;                              \
+    for (Py_ssize_t i_block = lr->start; i_block < lr->stop; i_block += LOOKUP_BLOCK) { \
+        block = Py_MIN(LOOKUP_BLOCK, lr->stop - i_block);               \
+        for (j = 0; j < block; j++) {                                   \
+            ok[j] = convert_func(*(npy_type_src*)PyArray_GETPTR1(key_array, i_block + j), &v[j]); \
+            h[j] = hash_func(v[j]);                                     \
+        }                                                               \
+        for (j = 0; j < block; j++) {                                   \
+            AM_PREFETCH(table + (h[j] & mask) * te_size);               \
+        }                                                               \
+        for (j = 0; j < block && !inline_keys; j++) {                   \
+            kp = table_keys_pos(self, h[j] & mask);                     \
+            if (kp >= 0) {                                              \
+                AM_PREFETCH(PyArray_GETPTR1(keys, kp));                 \
+            }                                                           \
+        }                                                               \
+        for (j = 0; j < block; j++) {                                   \
+            i = i_block + j;                                            \
+            table_pos = ok[j] ? lookup_func(self, v[j], h[j], kat) : -1; \
+            kp = table_pos < 0 ? -1 : table_keys_pos(self, table_pos); \
+            if (kp == -1) {                                             \
+                positions[i] = -1;                                      \
+                if (lr->missing == -1) {                                \
+                    lr->missing = i;                                    \
+                    if (lr->stop_on_missing) {                          \
+                        return;                                         \
+                    }                                                   \
+                }                                                       \
+                continue;                                               \
+            }                                                           \
+            positions[i] = (position_t)kp;                               \
+        }                                                               \
+    }                                                                   \
+}                                                                       \
+
+# define LOOKUP_FLEXIBLE(char_type, get_end_func, lookup_func, hash_func)  \
+{                                                                       \
+    char_type* v[LOOKUP_BLOCK];                                         \
+    Py_ssize_t k_size[LOOKUP_BLOCK];                                    \
+    Py_hash_t h[LOOKUP_BLOCK];                                          \
+    Py_ssize_t dt_size = PyArray_ITEMSIZE(key_array) / sizeof(char_type); \
+    Py_ssize_t mask = self->table_size - 1;                             \
+    char *table = (char *)self->table;                                  \
+    size_t te_size = table_element_size(self->table_layout);            \
+    Py_ssize_t table_pos, kp, block, i, j;                              \
+    for (Py_ssize_t i_block = lr->start; i_block < lr->stop; i_block += LOOKUP_BLOCK) { \
+        block = Py_MIN(LOOKUP_BLOCK, lr->stop - i_block);               \
+        for (j = 0; j < block; j++) {                                   \
+            v[j] = (char_type*)PyArray_GETPTR1(key_array, i_block + j); \
+            k_size[j] = get_end_func(v[j], dt_size) - v[j];             \
+        }                                                               \
+        for (j = 0; j < block; j++) {                                   \
+            h[j] = hash_func(v[j], k_size[j]);                          \
+        }                                                               \
+        for (j = 0; j < block; j++) {                                   \
+            AM_PREFETCH(table + (h[j] & mask) * te_size);               \
+        }                                                               \
+        for (j = 0; j < block; j++) {                                   \
+            kp = table_keys_pos(self, h[j] & mask);                     \
+            if (kp >= 0) {                                              \
+                AM_PREFETCH(PyArray_GETPTR1(keys, kp));                 \
+            }                                                           \
+        }                                                               \
+        for (j = 0; j < block; j++) {                                   \
+            i = i_block + j;                                            \
+            table_pos = lookup_func(self, v[j], k_size[j], h[j]);       \
+            kp = table_pos < 0 ? -1 : table_keys_pos(self, table_pos); \
+            if (kp == -1) {                                             \
+                positions[i] = -1;                                      \
+                if (lr->missing == -1) {                                \
+                    lr->missing = i;                                    \
+                    if (lr->stop_on_missing) {                          \
+                        return;                                         \
+                    }                                                   \
+                }                                                       \
+                continue;                                               \
+            }                                                           \
+            positions[i] = (position_t)kp;                               \
+        }                                                               \
+    }                                                                   \
+}                                                                       \
+
+// Lookup all UCS4 keys in the range in a FAM with keys_packed. As LOOKUP_FLEXIBLE, except that each
+// key is first narrowed to latin-1 in `lr->packed`; a key that is longer than the stored keys or
+// that has a character outside latin-1 cannot be found. Depends on self, lr, key_array, positions.
+# define LOOKUP_PACKED()                                                \
+{                                                                       \
+    char* v[LOOKUP_BLOCK];                                              \
+    Py_ssize_t k_size[LOOKUP_BLOCK];                                    \
+    Py_hash_t h[LOOKUP_BLOCK];                                          \
+    Py_ssize_t dt_size = PyArray_ITEMSIZE(keys) / UCS4_SIZE;            \
+    Py_ssize_t key_dt_size = PyArray_ITEMSIZE(key_array) / UCS4_SIZE;   \
+    Py_ssize_t mask = self->table_size - 1;                             \
+    char *table = (char *)self->table;                                  \
+    size_t te_size = table_element_size(self->table_layout);            \
+    Py_UCS4 *k;                                                         \
+    Py_ssize_t table_pos, kp, block, i, j;                              \
+    for (Py_ssize_t i_block = lr->start; i_block < lr->stop; i_block += LOOKUP_BLOCK) { \
+        block = Py_MIN(LOOKUP_BLOCK, lr->stop - i_block);               \
+        for (j = 0; j < block; j++) {                                   \
+            k = (Py_UCS4*)PyArray_GETPTR1(key_array, i_block + j);      \
+            k_size[j] = ucs4_get_end_p(k, key_dt_size) - k;             \
+            v[j] = lr->packed + j * dt_size;                            \
+            if (k_size[j] > dt_size || !ucs4_to_latin1(k, k_size[j], v[j])) { \
+                k_size[j] = -1;                                         \
+                continue;                                               \
+            }                                                           \
+            h[j] = string_to_hash(v[j], k_size[j]);                     \
+            AM_PREFETCH(table + (h[j] & mask) * te_size);               \
+        }                                                               \
+        for (j = 0; j < block; j++) {                                   \
+            kp = k_size[j] < 0 ? -1 : table_keys_pos(self, h[j] & mask); \
+            if (kp >= 0) {                                              \
+                AM_PREFETCH(self->keys_packed + kp * dt_size);          \
+            }                                                           \
+        }                                                               \
+        for (j = 0; j < block; j++) {                                   \
+            i = i_block + j;                                            \
+            kp = -1;                                                    \
+            if (k_size[j] >= 0) {                                       \
+                table_pos = lookup_hash_packed(self, v[j], k_size[j], h[j]); \
+                kp = table_pos < 0 ? -1 : table_keys_pos(self, table_pos); \
+            }                                                           \
+            if (kp == -1) {                                             \
+                positions[i] = -1;                                      \
+                if (lr->missing == -1) {                                \
+                    lr->missing = i;                                    \
+                    if (lr->stop_on_missing) {                          \
+                        return;                                         \
+                    }                                                   \
+                }                                                       \
+                continue;                                               \
+            }                                                           \
+            positions[i] = (position_t)kp;                               \
+        }                                                               \
+    }                                                                   \
+}                                                                       \
+
+// Lookup all keys in the range for a KM_RANGE FAM, where keys_pos is derived arithmetically.
+// Depends on self, lr, key_array, positions.
+# define LOOKUP_ARITHMETIC(npy_type_src, convert_func)                  \
+{                                                                       \
+    Py_ssize_t kp;                                                      \
+    npy_int64 v;                                                        \
+    for (Py_ssize_t i = lr->start; i < lr->stop; i++) {                 \
+        kp = convert_func(*(npy_type_src*)PyArray_GETPTR1(key_array, i), &v) ? range_keys_pos(self, v) : -1; \
+        positions[i] = (position_t)kp;                                   \
+        if (kp == -1 && lr->missing == -1) {                            \
+            lr->missing = i;                                            \
+            if (lr->stop_on_missing) {                                  \
+                return;                                                 \
+            }                                                           \
+        }                                                               \
+    }                                                                   \
+}                                                                       \
+
+// Lookup all keys in the range for a KM_SORTED FAM with `search_func`. Depends on self, lr,
+// key_array, positions.
+# define LOOKUP_SORTED(npy_type_src, npy_type_dst, search_func, convert_func) \
+{                                                                       \
+    Py_ssize_t kp;                                                      \
+    npy_type_dst v;                                                     \
+    for (Py_ssize_t i = lr->start; i < lr->stop; i++) {                 \
+        kp = convert_func(*(npy_type_src*)PyArray_GETPTR1(key_array, i), &v) ? search_func(self, v, true) : -1; \
+        positions[i] = (position_t)kp;                                   \
+        if (kp == -1 && lr->missing == -1) {                            \
+            lr->missing = i;                                            \
+            if (lr->stop_on_missing) {                                  \
+                return;                                                 \
+            }                                                           \
+        }                                                               \
+    }                                                                   \
+}                                                                       \
+
+// Lookup all keys in the range for a signed integer or datetime64 KAT, converting each key from
+// npy_type_src with `convert_func`. Depends on self, lr, key_array, positions.
+# define LOOKUP_INT(npy_type_src, convert_func)                         \
+    if (self->keys_mode == KM_RANGE) {                                  \
+        LOOKUP_ARITHMETIC(npy_type_src, convert_func);                  \
+    }                                                                   \
+    else if (self->keys_mode == KM_SORTED) {                            \
+        LOOKUP_SORTED(npy_type_src, npy_int64, sorted_search_int, convert_func); \
+    }                                                                   \
+    else {                                                              \
+        LOOKUP_SCALARS(npy_type_src, npy_int64, lookup_hash_int, int_to_hash, convert_func); \
+    }                                                                   \
+
+// As LOOKUP_INT, for an unsigned integer KAT.
+# define LOOKUP_UINT(npy_type_src, convert_func)                        \
+    if (self->keys_mode == KM_SORTED) {                                 \
+        LOOKUP_SORTED(npy_type_src, npy_uint64, sorted_search_uint, convert_func); \
+    }                                                                   \
+    else {                                                              \
+        LOOKUP_SCALARS(npy_type_src, npy_uint64, lookup_hash_uint, uint_to_hash, convert_func); \
+    }                                                                   \
+
+// As LOOKUP_INT, for a float KAT.
+# define LOOKUP_DOUBLE(npy_type_src, convert_func)                      \
+    if (self->keys_mode == KM_SORTED) {                                 \
+        LOOKUP_SORTED(npy_type_src, npy_double, sorted_search_double, convert_func); \
+    }                                                                   \
+    else {                                                              \
+        LOOKUP_SCALARS(npy_type_src, npy_double, lookup_hash_double, double_to_hash, convert_func); \
+    }                                                                   \
+
+// Given a numeric query array, call `lookup_kat` (LOOKUP_INT, LOOKUP_UINT, or LOOKUP_DOUBLE) with
+// the type of the array and the function converting signed integer, unsigned integer, float, or
+// half keys. Depends on key_array.
+# define LOOKUP_NUMERIC(lookup_kat, int_func, uint_func, double_func, half_func) \
+    switch (PyArray_TYPE(key_array)) {                                  \
+        case NPY_INT64:                                                 \
+            lookup_kat(npy_int64, int_func);                            \
+            break;                                                      \
+        case NPY_INT32:                                                 \
+            lookup_kat(npy_int32, int_func);                            \
+            break;                                                      \
+        case NPY_INT16:                                                 \
+            lookup_kat(npy_int16, int_func);                            \
+            break;                                                      \
+        case NPY_INT8:                                                  \
+            lookup_kat(npy_int8, int_func);                             \
+            break;                                                      \
+        case NPY_UINT64:                                                \
+            lookup_kat(npy_uint64, uint_func);                          \
+            break;                                                      \
+        case NPY_UINT32:                                                \
+            lookup_kat(npy_uint32, uint_func);                          \
+            break;                                                      \
+        case NPY_UINT16:                                                \
+            lookup_kat(npy_uint16, uint_func);                          \
+            break;                                                      \
+        case NPY_UINT8:                                                 \
+            lookup_kat(npy_uint8, uint_func);                           \
+            break;                                                      \
+        case NPY_FLOAT64:                                               \
+            lookup_kat(npy_double, double_func);                        \
+            break;                                                      \
+        case NPY_FLOAT32:                                               \
+            lookup_kat(npy_float, double_func);                         \
+            break;                                                      \
+        case NPY_FLOAT16:                                               \
+            lookup_kat(npy_half, half_func);                            \
+            break;                                                      \
+    }                                                                   \
+
+// Defines a WorkerFunc for looking up a LookupRange, storing positions as `pos_type`. This does not
+// use the Python C-API and can run without the GIL. Numeric keys are converted to the kind of the
+// KAT, and datetime64 keys of any unit are accepted.
+# define LOOKUP_RANGE(name, pos_type)                                           \
+static void                                                                     \
+name(void *arg)                                                                 \
+{                                                                               \
+    LookupRange *lr = (LookupRange *)arg;                                       \
+    FAMObject *self = lr->fam;                                                  \
+    PyArrayObject *keys = (PyArrayObject *)self->keys;                          \
+    PyArrayObject *key_array = lr->key_array;                                   \
+    typedef pos_type position_t;                                                \
+    position_t *positions = (position_t *)lr->positions;                        \
+                                                                                \
+    switch (self->keys_array_type) {                                            \
+        case KAT_INT64:                                                         \
+        case KAT_INT32:                                                         \
+        case KAT_INT16:                                                         \
+        case KAT_INT8:                                                          \
+            LOOKUP_NUMERIC(LOOKUP_INT, key_to_int, key_uint_to_int, key_double_to_int, key_half_to_int); \
+            break;                                                              \
+        case KAT_UINT64:                                                        \
+        case KAT_UINT32:                                                        \
+        case KAT_UINT16:                                                        \
+        case KAT_UINT8:                                                         \
+            LOOKUP_NUMERIC(LOOKUP_UINT, key_int_to_uint, key_to_uint, key_double_to_uint, key_half_to_uint); \
+            break;                                                              \
+        case KAT_FLOAT64:                                                       \
+        case KAT_FLOAT32:                                                       \
+        case KAT_FLOAT16:                                                       \
+            LOOKUP_NUMERIC(LOOKUP_DOUBLE, key_to_double, key_to_double, key_to_double, key_half_to_double); \
+            break;                                                              \
+        case KAT_UNICODE:                                                       \
+            if (self->keys_packed) {                                            \
+                LOOKUP_PACKED();                                                \
+                break;                                                          \
+            }                                                                   \
+            LOOKUP_FLEXIBLE(Py_UCS4, ucs4_get_end_p, lookup_hash_unicode, unicode_to_hash); \
+            break;                                                              \
+        case KAT_STRING:                                                        \
+            LOOKUP_FLEXIBLE(char, char_get_end_p, lookup_hash_string, string_to_hash); \
+            break;                                                              \
+        default: /* all datetime64 KATs */                                      \
+            if (kat_is_datetime_unit(self->keys_array_type, dt_unit_from_array(key_array))) { \
+                LOOKUP_INT(npy_int64, key_to_int);                              \
+            }                                                                   \
+            else {                                                              \
+                LOOKUP_INT(npy_int64, key_nat_to_int);                          \
+            }                                                                   \
+            break;                                                              \
+    }                                                                           \
+}                                                                               \
+
+LOOKUP_RANGE(lookup_range_int64, npy_int64)
+LOOKUP_RANGE(lookup_range_int32, npy_int32)
+
+# undef LOOKUP_RANGE
+# undef LOOKUP_NUMERIC
+# undef LOOKUP_INT
+# undef LOOKUP_UINT
+# undef LOOKUP_DOUBLE
+# undef LOOKUP_SCALARS
+# undef LOOKUP_PACKED
+# undef LOOKUP_ARITHMETIC
+# undef LOOKUP_SORTED
+# undef LOOKUP_FLEXIBLE
+
+
+// Set or get the position at `i` of `positions`, an array of either npy_int32 or npy_int64.
+static inline void
+positions_set(void *positions, bool int32, Py_ssize_t i, npy_int64 v) {
+    if (int32) {
+        ((npy_int32*)positions)[i] = (npy_int32)v;
+    }
+    else {
+        ((npy_int64*)positions)[i] = v;
+    }
+}
+
+static inline npy_int64
+positions_get(void *positions, bool int32, Py_ssize_t i) {
+    return int32 ? ((npy_int32*)positions)[i] : ((npy_int64*)positions)[i];
+}
+
+// Lookup all keys of an object key_array, as lookup_array(). Objects are borrowed from the array
+// buffer and passed to lookup(); for KAT_LIST, hashes of a block of keys are computed and their
+// table elements prefetched before probing. The GIL is held.
+static Py_ssize_t
+lookup_objects(
+        FAMObject *self,
+        PyArrayObject *key_array,
+        void *positions,
+        bool int32,
+        bool stop_on_missing)
+{
+    PyObject *k[LOOKUP_BLOCK];
+    Py_hash_t h[LOOKUP_BLOCK];
+    Py_ssize_t key_size = PyArray_SIZE(key_array);
+    Py_ssize_t mask = self->table_size - 1;
+    bool hashed = self->keys_array_type == KAT_LIST;
+    Py_ssize_t missing = -1;
+    Py_ssize_t keys_pos, block, i, j;
+    Py_ssize_t held = 0;
+
+    for (Py_ssize_t i_block = 0; i_block < key_size; i_block += LOOKUP_BLOCK) {
+        block = Py_MIN(LOOKUP_BLOCK, key_size - i_block);
+        for (held = 0; held < block; held++) {
+            k[held] = *(PyObject **)PyArray_GETPTR1(key_array, i_block + held);
+            if (k[held] == NULL) { // as in NumPy, a NULL element is read as None
+                k[held] = Py_None;
+            }
+            Py_INCREF(k[held]);
+            if (hashed) {
+                h[held] = PyObject_Hash(k[held]);
+                if (h[held] == -1) {
+                    held++;
+                    goto error;
+                }
+                AM_PREFETCH((char *)self->table + (h[held] & mask) * table_element_size(self->table_layout));
+            }
+        }
+        for (j = 0; j < block; j++) {
+            i = i_block + j;
+            if (hashed) {
+                keys_pos = found_keys_pos(self, lookup_hash_obj(self, k[j], h[j]));
+            }
+            else {
+                keys_pos = lookup(self, k[j]);
+            }
+            if (keys_pos < 0) {
+                if (PyErr_Occurred()) {
+                    goto error;
+                }
+                if (missing == -1) {
+                    missing = i;
+                    if (stop_on_missing) {
+                        break;
+                    }
+                }
+            }
+            positions_set(positions, int32, i, keys_pos);
+        }
+        for (j = 0; j < block; j++) {
+            Py_DECREF(k[j]);
+        }
+        if (missing != -1 && stop_on_missing) {
+            break;
+        }
+    }
+    return missing;
+error:
+    for (j = 0; j < held; j++) {
+        Py_DECREF(k[j]);
+    }
+    return -2;
+}
+
+
+// Given an array for which kat_is_lookup_array() is true, store the keys_pos of each key, or -1 if
+// not found, in `positions`, of NPY_INT64 or NPY_INT32. If `stop_on_missing`, lookups might stop at
+// the first key not found. Returns the index of the first key not found, -1 if all keys are found,
+// or -2 on error.
+static Py_ssize_t
+lookup_array_table(
+        FAMObject *self,
+        PyArrayObject *key_array,
+        void *positions,
+        int positions_type,
+        Py_ssize_t threads,
+        bool stop_on_missing)
+{
+    // keys are looked up in the table only
+    table_migrate(self, PY_SSIZE_T_MAX);
+    if (PyArray_TYPE(key_array) == NPY_OBJECT) {
+        return lookup_objects(self, key_array, positions, positions_type == NPY_INT32, stop_on_missing);
+    }
+    WorkerFunc func = positions_type == NPY_INT32 ? lookup_range_int32 : lookup_range_int64;
+    Py_ssize_t key_size = PyArray_SIZE(key_array);
+    // As an AutoMap might be mutated by another thread, the GIL is only released for immutable FAMs
+    if (PyObject_TypeCheck(self, &AMType) || key_size < THREAD_RELEASE_MIN_KEYS) {
+        threads = 0;
+    }
+    else {
+        threads = threads_for_size(threads, key_size, THREAD_MIN_KEYS);
+    }
+    LookupRange lr_single;
+    LookupRange *ranges = &lr_single;
+    if (threads > 1) {
+        ranges = PyMem_New(LookupRange, threads);
+        if (!ranges) {
+            PyErr_NoMemory();
+            return -2;
+        }
+    }
+    Py_ssize_t count = Py_MAX(threads, 1);
+    Py_ssize_t step = key_size / count;
+    char *packed = NULL;
+    Py_ssize_t packed_size = 0;
+    if (self->keys_packed && PyArray_TYPE(key_array) == NPY_UNICODE) {
+        packed_size = LOOKUP_BLOCK * (PyArray_ITEMSIZE((PyArrayObject *)self->keys) / UCS4_SIZE);
+        packed = (char*)PyMem_Malloc(count * packed_size);
+        if (!packed) {
+            if (threads > 1) {
+                PyMem_Del(ranges);
+            }
+            PyErr_NoMemory();
+            return -2;
+        }
+    }
+    for (Py_ssize_t t = 0; t < count; t++) {
+        ranges[t].fam = self;
+        ranges[t].key_array = key_array;
+        ranges[t].start = t * step;
+        ranges[t].stop = t == count - 1 ? key_size : (t + 1) * step;
+        ranges[t].positions = positions;
+        ranges[t].stop_on_missing = stop_on_missing;
+        ranges[t].missing = -1;
+        ranges[t].packed = packed ? packed + t * packed_size : NULL;
+    }
+    if (threads) {
+        if (run_threaded(func, (char*)ranges, sizeof(LookupRange), count)) {
+            if (threads > 1) {
+                PyMem_Del(ranges);
+            }
+            PyMem_Free(packed);
+            return -2;
+        }
+    }
+    else {
+        func(ranges);
+    }
+    Py_ssize_t missing = -1;
+    for (Py_ssize_t t = 0; t < count; t++) {
+        if (ranges[t].missing != -1) {
+            missing = ranges[t].missing;
+            break;
+        }
+    }
+    if (threads > 1) {
+        PyMem_Del(ranges);
+    }
+    PyMem_Free(packed);
+    return missing;
+}
+
+// Lookup all keys of an array as lookup_array_table(), and then, if keys have been discarded, store
+// -1 for each key found to be discarded. Returns the index of the first key not found, -1 if all
+// keys are found, or -2 on error.
+static Py_ssize_t
+lookup_array(
+        FAMObject *self,
+        PyArrayObject *key_array,
+        void *positions,
+        int positions_type,
+        Py_ssize_t threads,
+        bool stop_on_missing)
+{
+    Py_ssize_t missing = lookup_array_table(
+            self, key_array, positions, positions_type, threads, stop_on_missing);
+    if (missing == -2 || !self->discarded) {
+        return missing;
+    }
+    // if stopped on a missing key, later positions are not set
+    Py_ssize_t stop = missing != -1 && stop_on_missing ? missing : PyArray_SIZE(key_array);
+    Py_ssize_t keys_pos;
+    for (Py_ssize_t i = 0; i < stop; i++) {
+        keys_pos = positions_type == NPY_INT32
+                ? ((npy_int32*)positions)[i] : ((npy_int64*)positions)[i];
+        if (keys_pos < 0 || !key_discarded(self, keys_pos)) {
+            continue;
+        }
+        if (positions_type == NPY_INT32) {
+            ((npy_int32*)positions)[i] = -1;
+        }
+        else {
+            ((npy_int64*)positions)[i] = -1;
+        }
+        if (missing == -1 || i < missing) {
+            missing = i;
+        }
+        if (stop_on_missing) {
+            break;
+        }
+    }
+    return missing;
+}
+
+
+// Return a new reference to a Python object for the key at index `i` in a typed key_array, for use
+// in a KeyError. Numeric keys are returned as Python objects, datetime64 as NumPy scalars.
+static PyObject *
+array_key_at(PyArrayObject *key_array, Py_ssize_t i)
+{
+    void *p = PyArray_GETPTR1(key_array, i);
+    switch (PyArray_TYPE(key_array)) {
+        case NPY_INT64:
+            return PyLong_FromLongLong(*(npy_int64*)p);
+        case NPY_INT32:
+            return PyLong_FromLongLong(*(npy_int32*)p);
+        case NPY_INT16:
+            return PyLong_FromLongLong(*(npy_int16*)p);
+        case NPY_INT8:
+            return PyLong_FromLongLong(*(npy_int8*)p);
+        case NPY_UINT64:
+            return PyLong_FromUnsignedLongLong(*(npy_uint64*)p);
+        case NPY_UINT32:
+            return PyLong_FromUnsignedLongLong(*(npy_uint32*)p);
+        case NPY_UINT16:
+            return PyLong_FromUnsignedLongLong(*(npy_uint16*)p);
+        case NPY_UINT8:
+            return PyLong_FromUnsignedLongLong(*(npy_uint8*)p);
+        case NPY_FLOAT64:
+            return PyFloat_FromDouble(*(npy_double*)p);
+        case NPY_FLOAT32:
+            return PyFloat_FromDouble(*(npy_float*)p);
+        case NPY_FLOAT16:
+            return PyFloat_FromDouble(npy_half_to_double(*(npy_half*)p));
+        case NPY_UNICODE: {
+            Py_ssize_t dt_size = PyArray_ITEMSIZE(key_array) / UCS4_SIZE;
+            return PyUnicode_FromUCS4AndData(p, ucs4_get_end_p((Py_UCS4*)p, dt_size) - (Py_UCS4*)p);
+        }
+        case NPY_STRING: {
+            Py_ssize_t dt_size = PyArray_ITEMSIZE(key_array);
+            return PyBytes_FromStringAndSize(p, char_get_end_p((char*)p, dt_size) - (char*)p);
+        }
+        default:
+            return PyArray_ToScalar(p, key_array);
+    }
+}
+
+
+// Given a list or array of keys, return an array of the lookup-up integer values. If any unmatched
+// keys are found, a KeyError will raise, unless `missing` is given, in which case unmatched keys
+// are given the `missing` value, or `found` is True, in which case a tuple of the array and a
+// Boolean array of found keys is returned. Positions are written to `out` if given.
+static PyObject *
+fam_get_all(FAMObject *self, PyObject *args, PyObject *kwargs) {
+    PyObject *key = NULL;
+    Py_ssize_t threads = 1;
+    PyObject *missing_obj = Py_None;
+    int found = 0;
+    PyObject *out = Py_None;
+    PyArray_Descr *dtype = NULL;
+    static char *kwlist[] = {"", "threads", "missing", "found", "out", "dtype", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|$nOpOO&:get_all", kwlist,
+            &key, &threads, &missing_obj, &found, &out,
+            PyArray_DescrConverter2, &dtype)) {
+        return NULL;
+    }
+
+    Py_ssize_t key_size = 0;
+    Py_ssize_t keys_pos = -1;
+    PyObject* k = NULL;
+    PyObject *array = NULL;
+    PyObject *mask = NULL;
+    Py_ssize_t i = 0;
+
+    int key_is_list;
+    if (PyList_CheckExact(key)) {
+        key_is_list = 1;
+        key_size = PyList_GET_SIZE(key);
+    }
+    else if (PyArray_Check(key)) {
+        key_is_list = 0;
+        key_size = PyArray_SIZE((PyArrayObject *)key);
+    }
+    else {
+        Py_XDECREF(dtype);
+        PyErr_SetString(PyExc_TypeError, "Must provide a list or array.");
+        return NULL;
+    }
+    if (threads < 1) {
+        Py_XDECREF(dtype);
+        PyErr_SetString(PyExc_ValueError, "threads must be greater than zero");
+        return NULL;
+    }
+    // if raising, the first unmatched key raises a KeyError; otherwise, unmatched keys get
+    // `missing`
+    bool raising = missing_obj == Py_None && !found;
+    npy_int64 missing = -1;
+    if (missing_obj != Py_None) {
+        missing = PyLong_AsLongLong(missing_obj);
+        if (missing == -1 && PyErr_Occurred()) {
+            Py_XDECREF(dtype);
+            return NULL;
+        }
+    }
+
+    // determine the size of positions from `out` or `dtype`; only 32- and 64-bit signed integers
+    // are supported
+    int itemsize = 8;
+    if (dtype) {
+        itemsize = (int)PyDataType_ELSIZE(dtype);
+        if (dtype->kind != 'i' || (itemsize != 4 && itemsize != 8)) {
+            PyErr_SetString(PyExc_TypeError, "dtype must be a 32- or 64-bit signed integer");
+            goto error;
+        }
+    }
+    if (out != Py_None) {
+        PyArrayObject *o = (PyArrayObject *)out;
+        if (!PyArray_Check(out)
+                || PyArray_DESCR(o)->kind != 'i'
+                || (PyArray_ITEMSIZE(o) != 4 && PyArray_ITEMSIZE(o) != 8)
+                || (dtype && PyArray_ITEMSIZE(o) != itemsize)) {
+            PyErr_SetString(PyExc_TypeError, "out must be an array of 32- or 64-bit signed integers, matching dtype if given");
+            goto error;
+        }
+        if (PyArray_NDIM(o) != 1 || PyArray_SIZE(o) != key_size) {
+            PyErr_SetString(PyExc_ValueError, "out must be a 1D array of the same size as the keys");
+            goto error;
+        }
+        if (!PyArray_ISCARRAY(o) || !PyArray_ISNOTSWAPPED(o)) {
+            PyErr_SetString(PyExc_ValueError, "out must be writeable, aligned, contiguous, and in native byte order");
+            goto error;
+        }
+        itemsize = (int)PyArray_ITEMSIZE(o);
+        array = out;
+        Py_INCREF(array);
+    }
+    bool int32 = itemsize == 4;
+    if (int32 && (self->keys_size > INT32_MAX || missing < INT32_MIN || missing > INT32_MAX)) {
+        PyErr_SetString(PyExc_ValueError, "positions and missing must fit in a 32-bit integer");
+        goto error;
+    }
+
+    // construct array to be returned; this is a little expensive if we do not yet know if we can use it
+    npy_intp dims[] = {key_size};
+    if (!array) {
+        array = PyArray_EMPTY(1, dims, int32 ? NPY_INT32 : NPY_INT64, 0);
+        if (array == NULL) {
+            goto error;
+        }
+    }
+    void* b = PyArray_DATA((PyArrayObject*)array);
+    npy_bool* m = NULL;
+    if (found) {
+        mask = PyArray_EMPTY(1, dims, NPY_BOOL, 0);
+        if (mask == NULL) {
+            goto error;
+        }
+        m = (npy_bool*)PyArray_DATA((PyArrayObject*)mask);
+    }
+
+    if (key_is_list) {
+        for (; i < key_size; i++) {
+            k = PyList_GET_ITEM(key, i); // borrow
+            keys_pos = lookup(self, k);
+            if (keys_pos < 0) {
+                if (PyErr_Occurred()) {
+                    goto error;
+                }
+                if (raising) {
+                    PyErr_SetObject(PyExc_KeyError, k);
+                    goto error;
+                }
+            }
+            positions_set(b, int32, i, keys_pos);
+        }
+    }
+    else { // key is an array
+        PyArrayObject* key_array = (PyArrayObject *)key;
+        // if key is an np array that can be converted to the kind of this FAMs keys, we can do
+        // optimized lookups; otherwise, we have to go through scalar to do full branching and
+        // coercion into lookup
+        if (kat_is_lookup_array(self->keys_array_type, key_array)) {
+            Py_ssize_t missing_at = lookup_array(self, key_array, b,
+                    int32 ? NPY_INT32 : NPY_INT64, threads, raising);
+            if (missing_at == -2) {
+                goto error;
+            }
+            if (missing_at != -1 && raising) {
+                k = array_key_at(key_array, missing_at);
+                if (k == NULL) {
+                    goto error;
+                }
+                PyErr_SetObject(PyExc_KeyError, k);
+                Py_DECREF(k);
+                goto error;
+            }
+        }
+        else {
+            for (; i < key_size; i++) {
+                k = PyArray_ToScalar(PyArray_GETPTR1(key_array, i), key_array);
+                if (k == NULL) {
+                    goto error;
+                }
+                keys_pos = lookup(self, k);
+                if (keys_pos < 0) {
+                    if (PyErr_Occurred()) {
+                        Py_DECREF(k);
+                        goto error;
+                    }
+                    if (raising) {
+                        PyErr_SetObject(PyExc_KeyError, k);
+                        Py_DECREF(k);
+                        goto error;
+                    }
+                }
+                Py_DECREF(k);
+                positions_set(b, int32, i, keys_pos);
+            }
+        }
+    }
+    // all unmatched keys have -1; set the mask and replace -1 with missing
+    if (m) {
+        for (i = 0; i < key_size; i++) {
+            m[i] = positions_get(b, int32, i) >= 0;
+        }
+    }
+    if (missing != -1) {
+        for (i = 0; i < key_size; i++) {
+            if (positions_get(b, int32, i) < 0) {
+                positions_set(b, int32, i, missing);
+            }
+        }
+    }
+
+    Py_XDECREF(dtype);
+    if (out == Py_None) {
+        PyArray_CLEARFLAGS((PyArrayObject *)array, NPY_ARRAY_WRITEABLE);
+    }
+    if (mask) {
+        PyArray_CLEARFLAGS((PyArrayObject *)mask, NPY_ARRAY_WRITEABLE);
+        PyObject *post = PyTuple_Pack(2, array, mask);
+        Py_DECREF(array);
+        Py_DECREF(mask);
+        return post;
+    }
+    return array;
+error:
+    Py_XDECREF(dtype);
+    Py_XDECREF(array);
+    Py_XDECREF(mask);
+    return NULL;
+}
+
+
+// Given a list or array of keys, return the lookup-up integer values of the keys that are found, in
+// order; unmatched keys are skipped. A list of ints is returned, or, if `as_array` is True, an
+// immutable int64 array.
+static PyObject *
+fam_get_any(FAMObject *self, PyObject *args, PyObject *kwargs) {
+    PyObject *key = NULL;
+    Py_ssize_t threads = 1;
+    int as_array = 0;
+    static char *kwlist[] = {"", "threads", "as_array", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|$np:get_any", kwlist,
+            &key, &threads, &as_array)) {
+        return NULL;
+    }
+
+    Py_ssize_t key_size = 0;
+    Py_ssize_t keys_pos = -1;
+    Py_ssize_t i = 0;
+    PyObject* k = NULL;
+    PyObject* array = NULL;
+
+    int key_is_list;
+    if (PyList_CheckExact(key)) {
+        key_is_list = 1;
+        key_size = PyList_GET_SIZE(key);
+    }
+    else if (PyArray_Check(key)) {
+        key_is_list = 0;
+        key_size = PyArray_SIZE((PyArrayObject *)key);
+    }
+    else {
+        PyErr_SetString(PyExc_TypeError, "Must provide a list or array.");
+        return NULL;
+    }
+    if (threads < 1) {
+        PyErr_SetString(PyExc_ValueError, "threads must be greater than zero");
+        return NULL;
+    }
+
+    // positions of found keys are collected at the start of this array, which is then truncated to
+    // the count found
+    npy_intp dims[] = {key_size};
+    array = PyArray_EMPTY(1, dims, NPY_INT64, 0);
+    if (array == NULL) {
+        return NULL;
+    }
+    npy_int64* b = (npy_int64*)PyArray_DATA((PyArrayObject*)array);
+    Py_ssize_t count = 0;
+
+    if (key_is_list) {
+        for (; i < key_size; i++) {
+            k = PyList_GET_ITEM(key, i); // borrow
+            keys_pos = lookup(self, k);
+            if (keys_pos < 0) {
+                if (PyErr_Occurred()) { // only exit if exception set
+                    goto error;
+                }
+                continue;
+            }
+            b[count++] = (npy_int64)keys_pos;
+        }
+    }
+    else {
+        PyArrayObject* key_array = (PyArrayObject *)key;
+        // if key is an np array that can be converted to the kind of this FAMs keys, we can do
+        // optimized lookups; otherwise, we have to go through scalar to do full branching and
+        // coercion into lookup
+        if (kat_is_lookup_array(self->keys_array_type, key_array)) {
+            if (lookup_array(self, key_array, b, NPY_INT64, threads, false) == -2) {
+                goto error;
+            }
+            for (; i < key_size; i++) {
+                if (b[i] >= 0) {
+                    b[count++] = b[i];
+                }
+            }
+        }
+        else {
+            for (; i < key_size; i++) {
+                k = PyArray_ToScalar(PyArray_GETPTR1(key_array, i), key_array);
+                if (k == NULL) {
+                    goto error;
+                }
+                keys_pos = lookup(self, k);
+                Py_DECREF(k);
+                if (keys_pos < 0) {
+                    if (PyErr_Occurred()) { // only exit if exception set
+                        goto error;
+                    }
+                    continue; // do not raise
+                }
+                b[count++] = (npy_int64)keys_pos;
+            }
+        }
+    }
+    if (!as_array) {
+        PyObject* values = PyList_New(count);
+        if (!values) {
+            goto error;
+        }
+        for (i = 0; i < count; i++) {
+            PyObject* v = int_cache_get(b[i]);
+            if (!v) {
+                Py_DECREF(values);
+                goto error;
+            }
+            PyList_SET_ITEM(values, i, v);
+        }
+        Py_DECREF(array);
+        return values; // might be empty
+    }
+    if (count < key_size) {
+        dims[0] = count;
+        PyArray_Dims shape = {dims, 1};
+        PyObject *resized = PyArray_Resize((PyArrayObject *)array, &shape, 0, NPY_CORDER);
+        if (!resized) {
+            goto error;
+        }
+        Py_DECREF(resized); // returns None
+    }
+    PyArray_CLEARFLAGS((PyArrayObject *)array, NPY_ARRAY_WRITEABLE);
+    return array;
+error:
+    Py_DECREF(array);
+    return NULL;
+}
+
+
+// Given a list or array of keys, return an immutable Boolean array, aligned with the keys, that is
+// True where a key is found.
+static PyObject *
+fam_isin(FAMObject *self, PyObject *args, PyObject *kwargs) {
+    PyObject *key = NULL;
+    Py_ssize_t threads = 1;
+    static char *kwlist[] = {"", "threads", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|$n:isin", kwlist,
+            &key, &threads)) {
+        return NULL;
+    }
+
+    Py_ssize_t key_size = 0;
+    Py_ssize_t keys_pos = -1;
+    Py_ssize_t i = 0;
+    PyObject* k = NULL;
+    PyObject* array = NULL;
+    void* positions = NULL;
+
+    int key_is_list;
+    if (PyList_CheckExact(key)) {
+        key_is_list = 1;
+        key_size = PyList_GET_SIZE(key);
+    }
+    else if (PyArray_Check(key)) {
+        key_is_list = 0;
+        key_size = PyArray_SIZE((PyArrayObject *)key);
+    }
+    else {
+        PyErr_SetString(PyExc_TypeError, "Must provide a list or array.");
+        return NULL;
+    }
+    if (threads < 1) {
+        PyErr_SetString(PyExc_ValueError, "threads must be greater than zero");
+        return NULL;
+    }
+
+    npy_intp dims[] = {key_size};
+    array = PyArray_ZEROS(1, dims, NPY_BOOL, 0);
+    if (array == NULL) {
+        return NULL;
+    }
+    npy_bool* b = (npy_bool*)PyArray_DATA((PyArrayObject*)array);
+
+    if (key_is_list) {
+        for (; i < key_size; i++) {
+            keys_pos = lookup(self, PyList_GET_ITEM(key, i)); // borrow
+            if (keys_pos < 0 && PyErr_Occurred()) {
+                goto error;
+            }
+            b[i] = keys_pos >= 0;
+        }
+    }
+    else {
+        PyArrayObject* key_array = (PyArrayObject *)key;
+        // if key is an np array that can be converted to the kind of this FAMs keys, we can do
+        // optimized lookups; otherwise, we have to go through scalar to do full branching and
+        // coercion into lookup
+        if (kat_is_lookup_array(self->keys_array_type, key_array)) {
+            // positions are only needed to derive the mask; use int32 positions where possible to
+            // halve the size of this temporary buffer
+            bool int32 = self->keys_size <= INT32_MAX;
+            positions = PyMem_Malloc(key_size * (int32 ? sizeof(npy_int32) : sizeof(npy_int64)));
+            if (positions == NULL && key_size) {
+                PyErr_NoMemory();
+                goto error;
+            }
+            if (lookup_array(self, key_array, positions,
+                    int32 ? NPY_INT32 : NPY_INT64, threads, false) == -2) {
+                goto error;
+            }
+            for (; i < key_size; i++) {
+                b[i] = positions_get(positions, int32, i) >= 0;
+            }
+        }
+        else {
+            for (; i < key_size; i++) {
+                k = PyArray_ToScalar(PyArray_GETPTR1(key_array, i), key_array);
+                if (k == NULL) {
+                    goto error;
+                }
+                keys_pos = lookup(self, k);
+                Py_DECREF(k);
+                if (keys_pos < 0 && PyErr_Occurred()) {
+                    goto error;
+                }
+                b[i] = keys_pos >= 0;
+            }
+        }
+    }
+    PyMem_Free(positions);
+    PyArray_CLEARFLAGS((PyArrayObject *)array, NPY_ARRAY_WRITEABLE);
+    return array;
+error:
+    PyMem_Free(positions);
+    Py_DECREF(array);
+    return NULL;
+}
+
+// Given a bound for get_slice(), return the position of the first key not less than the bound, or
+// `unbounded` if the bound is None. A datetime64 bound must have the unit of the keys; other
+// objects are converted to that unit. Returns -1 on error.
+static Py_ssize_t
+slice_bound(FAMObject *self, PyObject *bound, Py_ssize_t unbounded)
+{
+    if (bound == Py_None) {
+        return unbounded;
+    }
+    Py_ssize_t pos;
+    switch (self->keys_array_type) {
+        case KAT_FLOAT64:
+        case KAT_FLOAT32:
+        case KAT_FLOAT16: {
+            double v = PyFloat_AsDouble(bound);
+            if (v == -1.0 && PyErr_Occurred()) {
+                return -1;
+            }
+            if (isnan(v)) {
+                PyErr_SetString(PyExc_ValueError, "get_slice() bounds cannot be NaN");
+                return -1;
+            }
+            return sorted_search_double(self, v, false);
+        }
+        case KAT_INT64:
+        case KAT_INT32:
+        case KAT_INT16:
+        case KAT_INT8:
+        case KAT_UINT64:
+        case KAT_UINT32:
+        case KAT_UINT16:
+        case KAT_UINT8: {
+            PyObject *index;
+            if (PyFloat_Check(bound) || PyArray_IsScalar(bound, Floating)) {
+                // the first integer key not less than a float is not less than its ceiling
+                double v = PyFloat_AsDouble(bound);
+                if (v == -1.0 && PyErr_Occurred()) {
+                    return -1;
+                }
+                if (isnan(v)) {
+                    PyErr_SetString(PyExc_ValueError, "get_slice() bounds cannot be NaN");
+                    return -1;
+                }
+                if (isinf(v)) {
+                    return v > 0 ? self->keys_size : 0;
+                }
+                index = PyLong_FromDouble(ceil(v));
+            }
+            else {
+                index = PyNumber_Index(bound);
+            }
+            if (!index) {
+                return -1;
+            }
+            bool is_uint = self->keys_array_type >= KAT_UINT8;
+            int overflow;
+            npy_int64 v = PyLong_AsLongLongAndOverflow(index, &overflow);
+            if (v == -1 && PyErr_Occurred()) {
+                Py_DECREF(index);
+                return -1;
+            }
+            if (overflow > 0) {
+                pos = self->keys_size;
+                if (is_uint) {
+                    npy_uint64 uv = PyLong_AsUnsignedLongLong(index);
+                    if (uv == (unsigned long long)-1 && PyErr_Occurred()) {
+                        PyErr_Clear(); // greater than all keys
+                    }
+                    else {
+                        pos = sorted_search_uint(self, uv, false);
+                    }
+                }
+            }
+            else if (overflow < 0 || (is_uint && v < 0)) {
+                pos = 0;
+            }
+            else if (is_uint) {
+                pos = sorted_search_uint(self, (npy_uint64)v, false);
+            }
+            else if (self->keys_mode == KM_RANGE) {
+                pos = range_lower(self, v);
+            }
+            else {
+                pos = sorted_search_int(self, v, false);
+            }
+            Py_DECREF(index);
+            return pos;
+        }
+        default: { // all datetime64 KATs
+            npy_int64 v;
+            if (PyArray_IsScalar(bound, Datetime)) {
+                v = (npy_int64)PyArrayScalar_VAL(bound, Datetime);
+                if (v != NPY_DATETIME_NAT && !kat_is_datetime_unit(
+                        self->keys_array_type,
+                        dt_unit_from_scalar((PyDatetimeScalarObject *)bound))) {
+                    PyErr_SetString(PyExc_ValueError, "datetime64 units do not match");
+                    return -1;
+                }
+            }
+            else {
+                PyArray_Descr *descr = PyArray_DESCR((PyArrayObject *)self->keys);
+                Py_INCREF(descr); // stolen
+                PyArrayObject *a = (PyArrayObject *)PyArray_FromAny(bound, descr, 0, 0, 0, NULL);
+                if (!a) {
+                    return -1;
+                }
+                if (PyArray_NDIM(a) != 0) {
+                    Py_DECREF(a);
+                    PyErr_SetString(PyExc_TypeError, "get_slice() bounds must be scalars");
+                    return -1;
+                }
+                v = *(npy_int64*)PyArray_DATA(a);
+                Py_DECREF(a);
+            }
+            if (v == NPY_DATETIME_NAT) {
+                PyErr_SetString(PyExc_ValueError, "get_slice() bounds cannot be NaT");
+                return -1;
+            }
+            if (self->keys_mode == KM_RANGE) {
+                return range_lower(self, v);
+            }
+            return sorted_search_int(self, v, false);
+        }
+    }
+}
+
+
+// Given start and stop bounds, return a slice of the positions of all keys greater than or equal to
+// start and less than stop, where either bound can be None. Only available for keys in increasing
+// order, i.e., a FAM created with `sorted=True` or of a range of positive step.
+static PyObject *
+fam_get_slice(FAMObject *self, PyObject *args)
+{
+    PyObject *start, *stop;
+    if (!PyArg_UnpackTuple(args, "get_slice", 2, 2, &start, &stop)) {
+        return NULL;
+    }
+    if (!(self->keys_mode == KM_SORTED ||
+            (self->keys_mode == KM_RANGE && self->range_step > 0))) {
+        PyErr_Format(PyExc_ValueError, "%s get_slice() requires sorted keys", Py_TYPE(self)->tp_name);
+        return NULL;
+    }
+    Py_ssize_t start_pos = slice_bound(self, start, 0);
+    if (start_pos < 0) {
+        return NULL;
+    }
+    Py_ssize_t stop_pos = slice_bound(self, stop, self->keys_size);
+    if (stop_pos < 0) {
+        return NULL;
+    }
+    start = PyLong_FromSsize_t(start_pos);
+    if (!start) {
+        return NULL;
+    }
+    stop = PyLong_FromSsize_t(Py_MAX(start_pos, stop_pos));
+    if (!stop) {
+        Py_DECREF(start);
+        return NULL;
+    }
+    PyObject *slice = PySlice_New(start, stop, NULL);
+    Py_DECREF(start);
+    Py_DECREF(stop);
+    return slice;
+}
+
+
+static PyObject *
+fam_subscript(FAMObject *self, PyObject *key)
+{
+    return get(self, key, NULL);
+}
+
+
+static PyMappingMethods fam_as_mapping = {
+    .mp_length = (lenfunc) fam_length,
+    .mp_subscript = (binaryfunc) fam_subscript,
+};
+
+
+static PyObject *
+fam_or(PyObject *left, PyObject *right)
+{
+    if (!PyObject_TypeCheck(left, &FAMType) ||
+        !PyObject_TypeCheck(right, &FAMType)
+    ) {
+        Py_RETURN_NOTIMPLEMENTED;
+    }
+    FAMObject *updated = copy(Py_TYPE(left), (FAMObject *)left);
+    if (!updated) {
+        return NULL;
+    }
+    if (extend(updated, right)) {
+        Py_DECREF(updated);
+        return NULL;
+    }
+    return (PyObject *)updated;
+}
+
+
+static PyNumberMethods fam_as_number = {
+    .nb_or = (binaryfunc) fam_or,
+};
+
+
+static int
+fam_contains(FAMObject *self, PyObject *key)
+{
+    if (lookup(self, key) < 0) {
+        if (PyErr_Occurred()) {
+            return -1;
+        }
+        return 0;
+    }
+    return 1;
+}
+
+
+static PySequenceMethods fam_as_sequence = {
+    .sq_contains = (objobjproc) fam_contains,
+};
+
+
+static void
+fam_dealloc(FAMObject *self)
+{
+    if (self->mapped) { // the keys array keeps this memory
+        self->table = NULL;
+        self->keys_packed = NULL;
+        self->keys_lengths = NULL;
+    }
+    if (self->table) {
+        PyMem_Free(self->table);
+    }
+    if (self->table_old) {
+        PyMem_Free(self->table_old->table);
+        PyMem_Free(self->table_old);
+    }
+    if (self->key_buffer) {
+        PyMem_Free(self->key_buffer);
+    }
+    if (self->keys_packed) {
+        PyMem_Free(self->keys_packed);
+    }
+    if (self->keys_lengths) {
+        PyMem_Free(self->keys_lengths);
+    }
+    if (self->discarded) {
+        PyMem_Free(self->discarded);
+    }
+    if (self->keys) {
+        Py_DECREF(self->keys);
+    }
+
+    key_count_global -= self->keys_size;
+
+    Py_TYPE(self)->tp_free((PyObject *)self);
+    int_cache_remove(key_count_global);
+}
+
+
+// Return a hash integer for an entire FAM by combining the hashes of all keys in order. As equal
+// FAMs have equal keys, this does not depend on the arrangement of keys in the table, which might
+// differ if built with threads. As keys are hashed again, the result is cached.
+static Py_hash_t
+fam_hash(FAMObject *self)
+{
+    if (self->hash != -1) {
+        return self->hash;
+    }
+    Py_hash_t hash = 0;
+    Py_hash_t h;
+    for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+        if (key_discarded(self, i)) {
+            continue;
+        }
+        if (self->keys_packed) { // as FAMs of equal keys might differ in being packed, keys are hashed as UCS4
+            h = unicode_to_hash((Py_UCS4*)PyArray_GETPTR1((PyArrayObject *)self->keys, i), key_length_at(self, i));
+        }
+        else {
+            h = key_hash_at(self, i);
+        }
+        if (h == -1) {
+            return -1;
+        }
+        hash = hash * 3 + h;
+    }
+    if (hash == -1) { // most not return -1
+        hash = 0;
+    }
+    self->hash = hash;
+    return hash;
+}
+
+
+static PyObject *
+fam_iter(FAMObject *self)
+{
+    return fami_new(self, KEYS, false);
+}
+
+
+static PyObject *
+fam_getnewargs(FAMObject *self)
+{
+    PyObject *keys = keys_view(self);
+    if (!keys) {
+        return NULL;
+    }
+    PyObject *args = PyTuple_Pack(1, keys);
+    Py_DECREF(keys);
+    return args;
+}
+
+
+static PyObject *
+fam_reversed(FAMObject *self)
+{
+    return fami_new(self, KEYS, true);
+}
+
+
+static PyObject *
+fam_sizeof(FAMObject *self)
+{
+    PyObject *listsizeof = PyObject_CallMethod(self->keys, "__sizeof__", NULL);
+    if (!listsizeof) {
+        return NULL;
+    }
+    Py_ssize_t listbytes = PyLong_AsSsize_t(listsizeof);
+    Py_DECREF(listsizeof);
+    if (listbytes == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    // as with the keys array of a buffer, mapped memory is not counted
+    Py_ssize_t tablebytes = 0;
+    if (self->table && !self->mapped) {
+        tablebytes = (self->table_size + SCAN - 1) * table_element_size(self->table_layout);
+    }
+    if (self->table_old) {
+        tablebytes += sizeof(TableOld)
+                + (self->table_old->size + SCAN - 1) * table_element_size(self->table_old->layout);
+    }
+    Py_ssize_t packedbytes = 0;
+    // keys_packed and keys_lengths have an element for each element of the keys array, which might
+    // have room to append
+    if (self->keys_packed && !self->mapped) {
+        PyArrayObject *a = (PyArrayObject *)self->keys;
+        packedbytes = PyArray_SIZE(a) * (PyArray_ITEMSIZE(a) / UCS4_SIZE);
+    }
+    Py_ssize_t lengthsbytes = 0;
+    if (self->keys_lengths && !self->mapped) {
+        lengthsbytes = PyArray_SIZE((PyArrayObject *)self->keys) * self->keys_lengths_width;
+    }
+    Py_ssize_t discardedbytes = 0;
+    if (self->discarded) {
+        discardedbytes = sizeof(Discarded) + self->discarded->size;
+    }
+    return PyLong_FromSsize_t(
+        Py_TYPE(self)->tp_basicsize
+        + listbytes
+        + tablebytes
+        + packedbytes
+        + lengthsbytes
+        + discardedbytes
+    );
+}
+
+
+static PyObject *
+fam_get(FAMObject *self, PyObject *args)
+{
+    PyObject *key, *missing = Py_None;
+    if (!PyArg_UnpackTuple(args, Py_TYPE(self)->tp_name, 1, 2, &key, &missing))
+    {
+        return NULL;
+    }
+    return get(self, key, missing);
+}
+
+
+static PyObject *
+fam_items(FAMObject *self)
+{
+    return famv_new(self, ITEMS);
+}
+
+
+static PyObject *
+fam_keys(FAMObject *self)
+{
+    return famv_new(self, KEYS);
+}
+
+
+static PyObject *
+fam_values(FAMObject *self)
+{
+    return famv_new(self, VALUES);
 }
 
 
-// Given a key for a FAM, return the Python integer (via the int_cache) associated with that key. Utility function used in both fam_subscript() and fam_get()
 static PyObject *
-get(FAMObject *self, PyObject *key, PyObject *missing) {
-    Py_ssize_t keys_pos = lookup(self, key);
-    if (keys_pos < 0) {
-        if (PyErr_Occurred()) {
-            return NULL;
-        }
-        if (missing) {
-            Py_INCREF(missing);
-            return missing;
-        }
-        PyErr_SetObject(PyExc_KeyError, key);
+fam_new(PyTypeObject *cls, PyObject *args, PyObject *kwargs)
+{
+    // NOTE: The original fam_new used to be able to provide a same reference back if a fam was in the args; this is tricky now that we have fam_init
+    FAMObject *self = (FAMObject *)cls->tp_alloc(cls, 0);
+    if (!self) {
         return NULL;
     }
-    // use a C-integer to fetch the Python integer
-    PyObject *index = PyList_GET_ITEM(int_cache, keys_pos);
-    Py_INCREF(index);
-    return index;
-}
-
-
-// Give an array of the same kind as KAT, lookup and load all keys_pos. Depends on self, key_size, key_array, table_pos, i, k, b
-# define GET_ALL_SCALARS(npy_type_src, npy_type_dst, kat, lookup_func, hash_func, to_obj_func, post_deref) \
-{                                                                      \
-    npy_type_dst v;                                                    \
-    for (; i < key_size; i++) {                                        \
-        v = post_deref(*(npy_type_src*)PyArray_GETPTR1(key_array, i)); \
-        table_pos = lookup_func(self, v, hash_func(v), kat);           \
-        if (table_pos < 0 || (self->table[table_pos].hash == -1)) {    \
-            Py_DECREF(array);                                          \
-            if (PyErr_Occurred()) {                                    \
-                return NULL;                                           \
-            }                                                          \
-            k = to_obj_func(v);                                        \
-            if (k == NULL) {                                           \
-                return NULL;                                           \
-            }                                                          \
-            PyErr_SetObject(PyExc_KeyError, k);                        \
-            Py_DECREF(k);                                              \
-            return NULL;                                               \
-        }                                                              \
-        b[i] = (npy_int64)self->table[table_pos].keys_pos;             \
-    }                                                                  \
-}                                                                      \
-
-# define GET_ALL_DT64(npy_type_src, npy_type_dst, kat, lookup_func, hash_func) \
-{                                                                      \
-    npy_type_dst v;                                                    \
-    for (; i < key_size; i++) {                                        \
-        v = *(npy_type_src*)PyArray_GETPTR1(key_array, i);             \
-        table_pos = lookup_func(self, v, hash_func(v), kat);           \
-        if (table_pos < 0 || (self->table[table_pos].hash == -1)) {    \
-            Py_DECREF(array);                                          \
-            if (PyErr_Occurred()) {                                    \
-                return NULL;                                           \
-            }                                                          \
-            k = PyArray_ToScalar(&v, key_array);                       \
-            if (k == NULL) {                                           \
-                return NULL;                                           \
-            }                                                          \
-            PyErr_SetObject(PyExc_KeyError, k);                        \
-            Py_DECREF(k);                                              \
-            return NULL;                                               \
-        }                                                              \
-        b[i] = (npy_int64)self->table[table_pos].keys_pos;             \
-    }                                                                  \
-}                                                                      \
-
-# define GET_ALL_FLEXIBLE(char_type, get_end_func, lookup_func, hash_func, to_obj_func) \
-{                                                                             \
-    char_type* v;                                                             \
-    Py_ssize_t dt_size = PyArray_ITEMSIZE(key_array) / sizeof(char_type);\
-    Py_ssize_t k_size;                                                        \
-    for (; i < key_size; i++) {                                               \
-        v = (char_type*)PyArray_GETPTR1(key_array, i);                        \
-        k_size = get_end_func(v, dt_size) - v;                                \
-        table_pos = lookup_func(self, v, k_size, hash_func(v, k_size));       \
-        if (table_pos < 0 || (self->table[table_pos].hash == -1)) {           \
-            Py_DECREF(array);                                                 \
-            if (PyErr_Occurred()) {                                           \
-                return NULL;                                                  \
-            }                                                                 \
-            k = to_obj_func(v, k_size);                                       \
-            if (k == NULL) {                                                  \
-                return NULL;                                                  \
-            }                                                                 \
-            PyErr_SetObject(PyExc_KeyError, k);                               \
-            Py_DECREF(k);                                                     \
-            return NULL;                                                      \
-        }                                                                     \
-        b[i] = (npy_int64)self->table[table_pos].keys_pos;                    \
-    }                                                                         \
-}                                                                             \
+    self->table = NULL;
+    self->table_layout = TL_WIDE;
+    self->table_old = NULL;
+    self->discarded = NULL;
+    self->incremental = false;
+    self->mapped = false;
+    self->keys_mode = KM_TABLE;
+    self->keys = NULL;
+    self->key_buffer = NULL;
+    self->keys_packed = NULL;
+    self->keys_lengths = NULL;
+    self->keys_size = 0;
+    self->hash = -1;
+    return (PyObject*)self;
+}
 
-// Given a list or array of keys, return an array of the lookup-up integer values. If any unmatched keys are found, a KeyError will raise. An immutable array is always returned.
-static PyObject *
-fam_get_all(FAMObject *self, PyObject *key) {
-    Py_ssize_t key_size = 0;
-    Py_ssize_t keys_pos = -1;
-    PyObject* k = NULL;
-    PyObject *array = NULL;
-    Py_ssize_t i = 0;
 
-    int key_is_list;
-    if (PyList_CheckExact(key)) {
-        key_is_list = 1;
-        key_size = PyList_GET_SIZE(key);
+// This macro can be used with integer and floating point NumPy types, given an `npy_type` and a specialized `insert_func`. Uses context of `fam_init` to get `fam`, `contiguous`, `a`, `keys_size`, and `i`. An optional `post_deref` function can be supplied to transform extracted values before calling the appropriate insert function.
+# define INSERT_SCALARS(npy_type, insert_func, kat, post_deref)   \
+{                                                                 \
+    if (contiguous) {                                             \
+        npy_type* b = (npy_type*)PyArray_DATA(a);                 \
+        npy_type* b_end = b + keys_size;                          \
+        while (b < b_end) {                                       \
+            if (insert_func(fam, post_deref(*b), i, -1, kat)) {   \
+                goto error;                                       \
+            }                                                     \
+            b++;                                                  \
+            i++;                                                  \
+        }                                                         \
+    }                                                             \
+    else {                                                        \
+        for (; i < keys_size; i++) {                              \
+            if (insert_func(fam,                                  \
+                    post_deref(*(npy_type*)PyArray_GETPTR1(a, i)),\
+                    i,                                            \
+                    -1,                                           \
+                    kat)) {                                       \
+                goto error;                                       \
+            }                                                     \
+        }                                                         \
+    }                                                             \
+}                                                                 \
+
+// This macro is for inserting flexible-sized types, Unicode (Py_UCS4) or strings (char), read from
+// `base` with `stride` bytes between keys. Uses context of `fam_init`. Keys are processed in
+// blocks, as with LOOKUP_FLEXIBLE.
+# define INSERT_FLEXIBLE(char_type, insert_func, hash_func, base, stride) \
+{                                                                  \
+    char_type* v[LOOKUP_BLOCK];                                    \
+    Py_ssize_t k_size[LOOKUP_BLOCK];                               \
+    Py_hash_t h[LOOKUP_BLOCK];                                     \
+    Py_ssize_t mask = fam->table_size - 1;                         \
+    char *table = (char *)fam->table;                              \
+    size_t te_size = table_element_size(fam->table_layout);        \
+    Py_ssize_t block, j;                                           \
+    while (i < keys_size) {                                        \
+        block = Py_MIN(LOOKUP_BLOCK, keys_size - i);               \
+        for (j = 0; j < block; j++) {                              \
+            v[j] = (char_type*)((base) + (i + j) * (stride));      \
+            k_size[j] = key_length_at(fam, i + j);                 \
+            h[j] = hash_func(v[j], k_size[j]);                     \
+            AM_PREFETCH(table + (h[j] & mask) * te_size);          \
+        }                                                          \
+        for (j = 0; j < block; j++) {                              \
+            if (insert_func(fam, v[j], k_size[j], i, h[j])) {      \
+                goto error;                                        \
+            }                                                      \
+            i++;                                                   \
+        }                                                          \
+    }                                                              \
+}                                                                  \
+
+// Initialize an allocated FAMObject. Returns 0 on success, -1 on error.
+int
+fam_init(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    PyTypeObject* cls = Py_TYPE(self); // borrowed ref
+    const char *name = cls->tp_name;
+    FAMObject* fam = (FAMObject*)self;
+
+    KeysArrayType keys_array_type = KAT_LIST; // default, will override if necessary
+
+    PyObject *keys = NULL;
+    Py_ssize_t keys_size = 0;
+    Py_ssize_t threads = 1;
+    int inline_keys = 0;
+    int packed = 0;
+    int sorted = 0;
+    Py_ssize_t capacity = 0;
+    int incremental = 0;
+
+    static char *kwlist[] = {"", "threads", "inline", "sorted", "packed", "capacity", "incremental", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O$npppnp", kwlist,
+            &keys, &threads, &inline_keys, &sorted, &packed, &capacity, &incremental)) {
+        return -1;
     }
-    else if (PyArray_Check(key)) {
-        key_is_list = 0;
-        key_size = PyArray_SIZE((PyArrayObject *)key);
+    if (threads < 1) {
+        PyErr_Format(PyExc_ValueError, "%s threads must be greater than zero", name);
+        return -1;
     }
-    else {
-        PyErr_SetString(PyExc_TypeError, "Must provide a list or array.");
-        return NULL;
+    if (capacity < 0) {
+        PyErr_Format(PyExc_ValueError, "%s capacity must not be negative", name);
+        return -1;
+    }
+    if (capacity && !PyType_IsSubtype(cls, &AMType)) {
+        PyErr_Format(PyExc_TypeError, "%s does not take a capacity", name);
+        return -1;
+    }
+    if (incremental && !PyType_IsSubtype(cls, &AMType)) {
+        PyErr_Format(PyExc_TypeError, "%s does not grow incrementally", name);
+        return -1;
     }
 
-    // construct array to be returned; this is a little expensive if we do not yet know if we can use it
-    npy_intp dims[] = {key_size};
-    array = PyArray_EMPTY(1, dims, NPY_INT64, 0);
-    if (array == NULL) {
-        return NULL;
+    if (!keys) {
+        keys = PyList_New(0);
+        if (!keys) {
+            return -1;
+        }
     }
-    npy_int64* b = (npy_int64*)PyArray_DATA((PyArrayObject*)array);
+    else if (PyObject_TypeCheck(keys, &FAMType)) {
+        // Use `keys` as old, `self` as new, and fill from old to new. This returns the same error codes as this function.
+        if (copy_to_new(cls, (FAMObject*)keys, fam)) {
+            return -1;
+        }
+        goto done;
+    }
+    else if (PyArray_Check(keys)) {
+        PyArrayObject *a = (PyArrayObject *)keys;
+        if (PyArray_NDIM(a) != 1) {
+            PyErr_SetString(PyExc_TypeError, "Arrays must be 1-dimensional");
+            return -1;
+        }
 
-    if (key_is_list) {
-        for (; i < key_size; i++) {
-            k = PyList_GET_ITEM(key, i); // borrow
-            keys_pos = lookup(self, k);
-            if (keys_pos < 0) {
-                Py_DECREF(array);
-                if (PyErr_Occurred()) {
-                    return NULL;
-                }
-                PyErr_SetObject(PyExc_KeyError, k);
-                return NULL;
+        int array_t = PyArray_TYPE(a);
+        keys_size = PyArray_SIZE(a);
+
+        if (PyTypeNum_ISINTEGER(array_t) // signed and unsigned
+                || PyTypeNum_ISFLOAT(array_t)
+                || PyTypeNum_ISFLEXIBLE(array_t)
+                || array_t == NPY_DATETIME)
+            {
+            if ((PyArray_FLAGS(a) & NPY_ARRAY_WRITEABLE)
+                    && !PyType_IsSubtype(cls, &AMType)) {
+                PyErr_Format(PyExc_TypeError, "Arrays must be immutable when given to a %s", name);
+                return -1;
             }
-            b[i] = (npy_int64)keys_pos;
+            // NOTE: this might return 0 (list) given a dt64 array without a unit
+            keys_array_type = at_to_kat(array_t, a);
         }
-    }
-    else { // key is an array
-        PyArrayObject* key_array = (PyArrayObject *)key;
-        // if key is an np array of the same kind as this FAMs keys, we can do optimized lookups; otherwise, we have to go through scalar to do full branching and coercion into lookup
-        int key_array_t = PyArray_TYPE(key_array);
-
-        // NOTE: we only match numeric kinds of the KAT is 64 bit; we could support, for each key_array_t, a switch for every KAT, but the size of that code is huge and the performance benefit is not massive
-        if (kat_is_kind(self->keys_array_type, PyArray_DESCR(key_array)->kind)) {
-            Py_ssize_t table_pos;
-            switch (key_array_t) { // type of passed in array
-                case NPY_INT64:
-                    GET_ALL_SCALARS(npy_int64, npy_int64, KAT_INT64, lookup_hash_int, int_to_hash, PyLong_FromLongLong,);
-                    break;
-                case NPY_INT32:
-                    GET_ALL_SCALARS(npy_int32, npy_int64, KAT_INT32, lookup_hash_int, int_to_hash, PyLong_FromLongLong,);
-                    break;
-                case NPY_INT16:
-                    GET_ALL_SCALARS(npy_int16, npy_int64, KAT_INT16, lookup_hash_int, int_to_hash, PyLong_FromLongLong,);
-                    break;
-                case NPY_INT8:
-                    GET_ALL_SCALARS(npy_int8, npy_int64, KAT_INT8, lookup_hash_int, int_to_hash, PyLong_FromLongLong,);
-                    break;
-                case NPY_UINT64:
-                    GET_ALL_SCALARS(npy_uint64, npy_uint64, KAT_UINT64, lookup_hash_uint, uint_to_hash, PyLong_FromUnsignedLongLong,);
-                    break;
-                case NPY_UINT32:
-                    GET_ALL_SCALARS(npy_uint32, npy_uint64, KAT_UINT32, lookup_hash_uint, uint_to_hash, PyLong_FromUnsignedLongLong,);
-                    break;
-                case NPY_UINT16:
-                    GET_ALL_SCALARS(npy_uint16, npy_uint64, KAT_UINT16, lookup_hash_uint, uint_to_hash, PyLong_FromUnsignedLongLong,);
-                    break;
-                case NPY_UINT8:
-                    GET_ALL_SCALARS(npy_uint8, npy_uint64, KAT_UINT8, lookup_hash_uint, uint_to_hash, PyLong_FromUnsignedLongLong,);
-                    break;
-                case NPY_FLOAT64:
-                    GET_ALL_SCALARS(npy_double, npy_double, KAT_FLOAT64, lookup_hash_double, double_to_hash, PyFloat_FromDouble,);
-                    break;
-                case NPY_FLOAT32:
-                    GET_ALL_SCALARS(npy_float, npy_double, KAT_FLOAT32, lookup_hash_double, double_to_hash, PyFloat_FromDouble,);
-                    break;
-                case NPY_FLOAT16:
-                    GET_ALL_SCALARS(npy_half, npy_double, KAT_FLOAT16, lookup_hash_double, double_to_hash, PyFloat_FromDouble, npy_half_to_double);
-                    break;
-                case NPY_UNICODE:
-                    GET_ALL_FLEXIBLE(Py_UCS4, ucs4_get_end_p, lookup_hash_unicode, unicode_to_hash, PyUnicode_FromUCS4AndData);
-                    break;
-                case NPY_STRING:
-                    GET_ALL_FLEXIBLE(char, char_get_end_p, lookup_hash_string, string_to_hash, PyBytes_FromStringAndSize);
-                    break;
-                case NPY_DATETIME: {
-                    NPY_DATETIMEUNIT key_unit = dt_unit_from_array(key_array);
-                    if (!kat_is_datetime_unit(self->keys_array_type, key_unit)) {
-                        PyErr_SetString(PyExc_KeyError, "datetime64 units do not match");
-                        Py_DECREF(array);
-                        return NULL;
-                    }
-                    GET_ALL_DT64(npy_int64, npy_int64, KAT_INT64, lookup_hash_int, int_to_hash);
-                    break;
+
+        if (keys_array_type) { // we have a usable array
+            if (!PyArray_ISNOTSWAPPED(a)) {
+                // keys are stored, hashed, and compared in native byte order, so a copy is swapped
+                PyArray_Descr *dtype = PyArray_DescrNewByteorder(PyArray_DESCR(a), NPY_NATIVE);
+                if (!dtype) {
+                    return -1;
+                }
+                keys = PyArray_FromArray(a, dtype, NPY_ARRAY_DEFAULT | NPY_ARRAY_ENSURECOPY);
+                if (!keys) {
+                    return -1;
                 }
+                PyArray_CLEARFLAGS((PyArrayObject *)keys, NPY_ARRAY_WRITEABLE);
+            }
+            else if (PyArray_FLAGS(a) & NPY_ARRAY_WRITEABLE) {
+                // an AutoMap copies a mutable array, such that changes to that array are not seen
+                keys = PyArray_NewCopy(a, NPY_CORDER);
+                if (!keys) {
+                    return -1;
+                }
+                PyArray_CLEARFLAGS((PyArrayObject *)keys, NPY_ARRAY_WRITEABLE);
+            }
+            else {
+                Py_INCREF(keys);
             }
         }
         else {
-            for (; i < key_size; i++) {
-                k = PyArray_ToScalar(PyArray_GETPTR1(key_array, i), key_array);
-                if (k == NULL) {
-                    Py_DECREF(array);
-                    return NULL;
+            // DEBUG_MSG_OBJ("got KAT", PyLong_FromLongLong(keys_array_type));
+            // if an AutoMap or an array that we do not handle, create a list
+            if (array_t == NPY_DATETIME || array_t == NPY_TIMEDELTA){
+                keys = PySequence_List(keys); // force scalars
+            }
+            else {
+                keys = PyArray_ToList(a); // converts to objs
+            }
+            if (!keys) {
+                return -1;
+            }
+        }
+    }
+    else { // assume an arbitrary iterable
+        keys = PySequence_List(keys);
+        if (!keys) {
+            return -1;
+        }
+        keys_size = PyList_GET_SIZE(keys);
+    }
+
+    fam->keys = keys;
+    fam->keys_array_type = keys_array_type;
+    fam->keys_size = keys_size;
+    fam->key_buffer = NULL;
+    fam->keys_packed = NULL;
+    fam->keys_lengths = NULL;
+    fam->table_layout = table_layout_for(keys_array_type, keys_size, inline_keys);
+    key_count_global += keys_size;
+
+    // as a range of an AutoMap changes to KM_TABLE when extended out of order, sorted AutoMap keys
+    // are KM_SORTED
+    if (keys_array_type
+            && !(sorted && PyType_IsSubtype(cls, &AMType))
+            && range_init(fam)) { // no table is needed
+        if (sorted && fam->range_step < 0) {
+            PyErr_Format(PyExc_ValueError,
+                    "%s keys must be in increasing order when sorted", name);
+            return -1;
+        }
+        if (int_cache_fill(keys_size)) {
+            return -1;
+        }
+        goto done;
+    }
+    if (sorted) { // no table is needed
+        if (sorted_init(fam) || int_cache_fill(keys_size)) {
+            return -1;
+        }
+        goto done;
+    }
+
+    // NOTE: on itialization, grow_table() does not use keys; the table is sized for any reserved
+    // capacity
+    if (grow_table(fam, Py_MAX(keys_size, capacity))) {
+        return -1;
+    }
+    Py_ssize_t i = 0;
+    if (keys_array_type) {
+        threads = threads_for_size(threads, keys_size, THREAD_MIN_KEYS);
+        if (keys_array_type == KAT_UNICODE && packed && packed_init(fam)) {
+            return -1;
+        }
+        if ((keys_array_type == KAT_UNICODE || keys_array_type == KAT_STRING) && lengths_init(fam)) {
+            return -1;
+        }
+        if (keys_array_type == KAT_UNICODE && !fam->keys_packed) {
+            // Over allocate buffer by 1 so there is room for null at end. This buffer is only used
+            // in lookup();
+            Py_ssize_t dt_size = PyArray_ITEMSIZE((PyArrayObject *)fam->keys) / UCS4_SIZE;
+            fam->key_buffer = (Py_UCS4*)PyMem_Malloc((dt_size+1) * UCS4_SIZE);
+            if (!fam->key_buffer) {
+                PyErr_NoMemory();
+                return -1;
+            }
+        }
+        if (threads > 1) {
+            int err = insert_threaded(fam, threads);
+            if (err < 0) {
+                return -1;
+            }
+            if (err == 0) {
+                goto done;
+            }
+        } // else, insert serially
+        PyArrayObject *a = (PyArrayObject *)fam->keys;
+        int contiguous = PyArray_IS_C_CONTIGUOUS(a);
+        switch (keys_array_type) {
+            case KAT_INT64:
+                INSERT_SCALARS(npy_int64, insert_int, keys_array_type,);
+                break;
+            case KAT_INT32:
+                INSERT_SCALARS(npy_int32, insert_int, keys_array_type,);
+                break;
+            case KAT_INT16:
+                INSERT_SCALARS(npy_int16, insert_int, keys_array_type,);
+                break;
+            case KAT_INT8:
+                INSERT_SCALARS(npy_int8, insert_int, keys_array_type,);
+                break;
+            case KAT_UINT64:
+                INSERT_SCALARS(npy_uint64, insert_uint, keys_array_type,);
+                break;
+            case KAT_UINT32:
+                INSERT_SCALARS(npy_uint32, insert_uint, keys_array_type,);
+                break;
+            case KAT_UINT16:
+                INSERT_SCALARS(npy_uint16, insert_uint, keys_array_type,);
+                break;
+            case KAT_UINT8:
+                INSERT_SCALARS(npy_uint8, insert_uint, keys_array_type,);
+                break;
+            case KAT_FLOAT64:
+                INSERT_SCALARS(npy_double, insert_double, keys_array_type,);
+                break;
+            case KAT_FLOAT32:
+                INSERT_SCALARS(npy_float, insert_double, keys_array_type,);
+                break;
+            case KAT_FLOAT16:
+                INSERT_SCALARS(npy_half, insert_double, keys_array_type, npy_half_to_double);
+                break;
+            case KAT_UNICODE:
+                if (fam->keys_packed) {
+                    INSERT_FLEXIBLE(char, insert_packed, string_to_hash, fam->keys_packed, PyArray_ITEMSIZE(a) / UCS4_SIZE);
                 }
-                keys_pos = lookup(self, k);
-                if (keys_pos < 0) {
-                    Py_DECREF(array);
-                    if (PyErr_Occurred()) {
-                        Py_DECREF(k);
-                        return NULL;
-                    }
-                    PyErr_SetObject(PyExc_KeyError, k);
-                    Py_DECREF(k);
-                    return NULL;
+                else {
+                    INSERT_FLEXIBLE(Py_UCS4, insert_unicode, unicode_to_hash, PyArray_BYTES(a), PyArray_STRIDE(a, 0));
                 }
-                Py_DECREF(k);
-                b[i] = (npy_int64)keys_pos;
+                break;
+            case KAT_STRING:
+                INSERT_FLEXIBLE(char, insert_string, string_to_hash, PyArray_BYTES(a), PyArray_STRIDE(a, 0));
+                break;
+            case KAT_DTY:
+            case KAT_DTM:
+            case KAT_DTW:
+            case KAT_DTD:
+            case KAT_DTh:
+            case KAT_DTm:
+            case KAT_DTs:
+            case KAT_DTms:
+            case KAT_DTus:
+            case KAT_DTns:
+            case KAT_DTps:
+            case KAT_DTfs:
+            case KAT_DTas:
+                INSERT_SCALARS(npy_int64, insert_int, KAT_INT64,);
+                break;
+            default:
+                return -1;
+        }
+    }
+    else {
+        for (; i < keys_size; i++) {
+            if (insert_obj(fam, PyList_GET_ITEM(keys, i), i, -1)) {
+                goto error;
             }
         }
     }
-
-    PyArray_CLEARFLAGS((PyArrayObject *)array, NPY_ARRAY_WRITEABLE);
-    return array;
-
+done:
+    if (capacity && reserve(fam, capacity)) {
+        return -1;
+    }
+    if (incremental) {
+        fam->incremental = true;
+    }
+    return 0;
+error:
+    // assume all dynamic memory assigned to struct attrs that will be cleaned
+    return -1;
 }
 
 
-# undef GET_ALL_SCALARS
-# undef GET_ALL_FLEXIBLE
+# undef INSERT_SCALARS
+# undef INSERT_FLEXIBLE
 
 
-// Give an array of the same kind as KAT, lookup and load any keys_pos. Depends on self, key_size, key_array, table_pos, i, k, values
-# define GET_ANY_SCALARS(npy_type_src, npy_type_dst, kat, lookup_func, hash_func, post_deref) \
-{                                                                          \
-    npy_type_dst v;                                                        \
-    for (; i < key_size; i++) {                                            \
-        v = post_deref(*(npy_type_src*)PyArray_GETPTR1(key_array, i));     \
-        table_pos = lookup_func(self, v, hash_func(v), kat);               \
-        if (table_pos < 0 || (self->table[table_pos].hash == -1)) {        \
-            if (PyErr_Occurred()) {                                        \
-                Py_DECREF(values);                                         \
-                return NULL;                                               \
-            }                                                              \
-            continue;                                                      \
-        }                                                                  \
-        keys_pos = self->table[table_pos].keys_pos;                        \
-        if (PyList_Append(values, PyList_GET_ITEM(int_cache, keys_pos))) { \
-            Py_DECREF(values);                                             \
-            return NULL;                                                   \
-        }                                                                  \
-    }                                                                      \
-}                                                                          \
+static PyObject *
+fam_repr(FAMObject *self)
+{
+    PyObject *keys = keys_live(self);
+    if (!keys) {
+        return NULL;
+    }
+    PyObject *repr = PyUnicode_FromFormat("%s(%R)", Py_TYPE(self)->tp_name, keys);
+    Py_DECREF(keys);
+    return repr;
+}
 
-# define GET_ANY_FLEXIBLE(char_type, get_end_func, lookup_func, hash_func)    \
-{                                                                             \
-    char_type* v;                                                             \
-    Py_ssize_t dt_size = PyArray_ITEMSIZE(key_array) / sizeof(char_type);\
-    Py_ssize_t k_size;                                                        \
-    for (; i < key_size; i++) {                                               \
-        v = (char_type*)PyArray_GETPTR1(key_array, i);                        \
-        k_size = get_end_func(v, dt_size) - v;                                \
-        table_pos = lookup_func(self, v, k_size, hash_func(v, k_size));       \
-        if (table_pos < 0 || (self->table[table_pos].hash == -1)) {           \
-            if (PyErr_Occurred()) {                                           \
-                Py_DECREF(values);                                            \
-                return NULL;                                                  \
-            }                                                                 \
-            continue;                                                         \
-        }                                                                     \
-        keys_pos = self->table[table_pos].keys_pos;                           \
-        if (PyList_Append(values, PyList_GET_ITEM(int_cache, keys_pos))) {    \
-            Py_DECREF(values);                                                \
-            return NULL;                                                      \
-        }                                                                     \
-    }                                                                         \
-}                                                                             \
 
-// Given a list or array of keys, return a list of the lookup-up integer values. If any unmatched keys are found, they are ignored. A list is always returned.
+// Compare the items of two FAMs, as lists of key, position pairs.
 static PyObject *
-fam_get_any(FAMObject *self, PyObject *key) {
-    Py_ssize_t key_size = 0;
-    Py_ssize_t keys_pos = -1;
-    Py_ssize_t i = 0;
-    PyObject* k = NULL;
-    PyObject* values = NULL;
-
-    int key_is_list;
-    if (PyList_CheckExact(key)) {
-        key_is_list = 1;
-        key_size = PyList_GET_SIZE(key);
+fam_richcompare_items(FAMObject *self, FAMObject *other, int op)
+{
+    PyObject *items = fami_new(self, ITEMS, false);
+    if (!items) {
+        return NULL;
     }
-    else if (PyArray_Check(key)) {
-        key_is_list = 0;
-        key_size = PyArray_SIZE((PyArrayObject *)key);
+    PyObject *left = PySequence_List(items);
+    Py_DECREF(items);
+    if (!left) {
+        return NULL;
     }
-    else {
-        PyErr_SetString(PyExc_TypeError, "Must provide a list or array.");
+    items = fami_new(other, ITEMS, false);
+    if (!items) {
+        Py_DECREF(left);
+        return NULL;
+    }
+    PyObject *right = PySequence_List(items);
+    Py_DECREF(items);
+    if (!right) {
+        Py_DECREF(left);
         return NULL;
     }
+    PyObject *result = PyObject_RichCompare(left, right, op);
+    Py_DECREF(left);
+    Py_DECREF(right);
+    return result;
+}
+
 
-    values = PyList_New(0);
-    if (!values) {
+static PyObject *
+fam_richcompare(FAMObject *self, PyObject *other, int op)
+{
+    if (!PyObject_TypeCheck(other, &FAMType)) {
+        Py_RETURN_NOTIMPLEMENTED;
+    }
+    if (self->discarded || ((FAMObject *)other)->discarded) {
+        // as positions of keys are not derived from the order of keys, compare items
+        return fam_richcompare_items(self, (FAMObject *)other, op);
+    }
+    PyObject *keys = keys_view(self);
+    if (!keys) {
         return NULL;
     }
+    PyObject *keys_other = keys_view((FAMObject *)other);
+    if (!keys_other) {
+        Py_DECREF(keys);
+        return NULL;
+    }
+    PyObject *result = PyObject_RichCompare(keys, keys_other, op);
+    Py_DECREF(keys);
+    Py_DECREF(keys_other);
+    return result;
+}
 
-    if (key_is_list) {
-        for (; i < key_size; i++) {
-            k = PyList_GET_ITEM(key, i); // borrow
-            keys_pos = lookup(self, k);
-            if (keys_pos < 0) {
-                if (PyErr_Occurred()) { // only exit if exception set
-                    Py_DECREF(values);
-                    return NULL;
-                }
-                continue;
-            }
-            if (PyList_Append(values, PyList_GET_ITEM(int_cache, keys_pos))) {
-                Py_DECREF(values);
+
+// State is a tuple of keys, followed by a dictionary of keyword arguments if the table layout, keys
+// mode, or table growth was selected by keyword arguments, or if keys have been discarded. If keys
+// have been discarded, the dictionary is followed by an array of the positions of discarded keys.
+static PyObject*
+fam_getstate(FAMObject *self)
+{
+    PyObject *keys = keys_view(self);
+    if (!keys) {
+        return NULL;
+    }
+    PyObject *state;
+    if (self->table_layout == TL_INLINE
+            || self->keys_mode == KM_SORTED
+            || self->keys_packed
+            || self->incremental
+            || self->discarded) {
+        PyObject *kwargs = Py_BuildValue("{sOsOsOsO}",
+                "inline", self->table_layout == TL_INLINE ? Py_True : Py_False,
+                "sorted", self->keys_mode == KM_SORTED ? Py_True : Py_False,
+                "packed", self->keys_packed ? Py_True : Py_False,
+                "incremental", self->incremental ? Py_True : Py_False);
+        if (!kwargs) {
+            Py_DECREF(keys);
+            return NULL;
+        }
+        if (self->discarded) {
+            npy_intp count = self->discarded->count;
+            PyArrayObject *positions = (PyArrayObject *)PyArray_SimpleNew(1, &count, NPY_INT64);
+            if (!positions) {
+                Py_DECREF(kwargs);
+                Py_DECREF(keys);
                 return NULL;
             }
-        }
-    }
-    else {
-        PyArrayObject* key_array = (PyArrayObject *)key;
-        // if key is an np array of the same kind as this FAMs keys, we can do optimized lookups; otherwise, we have to go through scalar to do full branching and coercion into lookup
-        int key_array_t = PyArray_TYPE(key_array);
-
-        if (kat_is_kind(self->keys_array_type, PyArray_DESCR(key_array)->kind)) {
-            Py_ssize_t table_pos;
-            switch (key_array_t) {
-                case NPY_INT64:
-                    GET_ANY_SCALARS(npy_int64, npy_int64, KAT_INT64, lookup_hash_int, int_to_hash,);
-                    break;
-                case NPY_INT32:
-                    GET_ANY_SCALARS(npy_int32, npy_int64, KAT_INT32, lookup_hash_int, int_to_hash,);
-                    break;
-                case NPY_INT16:
-                    GET_ANY_SCALARS(npy_int16, npy_int64, KAT_INT16, lookup_hash_int, int_to_hash,);
-                    break;
-                case NPY_INT8:
-                    GET_ANY_SCALARS(npy_int8, npy_int64, KAT_INT8, lookup_hash_int, int_to_hash,);
-                    break;
-                case NPY_UINT64:
-                    GET_ANY_SCALARS(npy_uint64, npy_uint64, KAT_UINT64, lookup_hash_uint, uint_to_hash,);
-                    break;
-                case NPY_UINT32:
-                    GET_ANY_SCALARS(npy_uint32, npy_uint64, KAT_UINT32, lookup_hash_uint, uint_to_hash,);
-                    break;
-                case NPY_UINT16:
-                    GET_ANY_SCALARS(npy_uint16, npy_uint64, KAT_UINT16, lookup_hash_uint, uint_to_hash,);
-                    break;
-                case NPY_UINT8:
-                    GET_ANY_SCALARS(npy_uint8, npy_uint64, KAT_UINT8, lookup_hash_uint, uint_to_hash,);
-                    break;
-                case NPY_FLOAT64:
-                    GET_ANY_SCALARS(npy_double, npy_double, KAT_FLOAT64, lookup_hash_double, double_to_hash,);
-                    break;
-                case NPY_FLOAT32:
-                    GET_ANY_SCALARS(npy_float, npy_double, KAT_FLOAT32, lookup_hash_double, double_to_hash,);
-                    break;
-                case NPY_FLOAT16:
-                    GET_ANY_SCALARS(npy_half, npy_double, KAT_FLOAT16, lookup_hash_double, double_to_hash, npy_half_to_double);
-                    break;
-                case NPY_UNICODE:
-                    GET_ANY_FLEXIBLE(Py_UCS4, ucs4_get_end_p, lookup_hash_unicode, unicode_to_hash);
-                    break;
-                case NPY_STRING:
-                    GET_ANY_FLEXIBLE(char, char_get_end_p, lookup_hash_string, string_to_hash);
-                    break;
-                case NPY_DATETIME: {
-                    NPY_DATETIMEUNIT key_unit = dt_unit_from_array(key_array);
-                    if (!kat_is_datetime_unit(self->keys_array_type, key_unit)) {
-                        return values;
-                    }
-                    GET_ANY_SCALARS(npy_int64, npy_int64, KAT_INT64, lookup_hash_int, int_to_hash,);
-                    break;
+            npy_int64 *p = (npy_int64 *)PyArray_DATA(positions);
+            for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+                if (key_discarded(self, i)) {
+                    *p++ = i;
                 }
             }
+            state = Py_BuildValue("(ONN)", keys, kwargs, positions);
         }
         else {
-            for (; i < key_size; i++) {
-                k = PyArray_ToScalar(PyArray_GETPTR1(key_array, i), key_array);
-                if (k == NULL) {
-                    Py_DECREF(values);
-                    return NULL;
-                }
-                keys_pos = lookup(self, k);
-                Py_DECREF(k);
-                if (keys_pos < 0) {
-                    if (PyErr_Occurred()) { // only exit if exception set
-                        Py_DECREF(values);
-                        return NULL;
-                    }
-                    continue; // do not raise
-                }
-                if (PyList_Append(values, PyList_GET_ITEM(int_cache, keys_pos))) {
-                    Py_DECREF(values);
-                    return NULL;
-                }
-            }
+            state = Py_BuildValue("(ON)", keys, kwargs);
         }
     }
-    return values; // might be empty
+    else {
+        state = PyTuple_Pack(1, keys);
+    }
+    Py_DECREF(keys);
+    return state;
 }
 
 
-# undef GET_ANY_SCALARS
-# undef GET_ANY_FLEXIBLE
-
-
-static PyObject *
-fam_subscript(FAMObject *self, PyObject *key)
+// Initialize from all keys, including those at the increasing positions of `discarded`. As a
+// discarded key might equal a later key, keys are extended up to and including each discarded key,
+// which is then discarded. Returns 0 on success, -1 on error.
+static int
+fam_init_discarded(FAMObject *self, PyObject *keys, PyObject *kwargs, PyObject *discarded)
 {
-    return get(self, key, NULL);
+    Py_ssize_t keys_size = PySequence_Size(keys);
+    if (keys_size < 0) {
+        return -1;
+    }
+    PyArrayObject *positions = (PyArrayObject *)PyArray_FROM_OTF(
+            discarded, NPY_INT64, NPY_ARRAY_IN_ARRAY);
+    if (!positions) {
+        return -1;
+    }
+    PyObject *segment = PySequence_GetSlice(keys, 0, 0);
+    PyObject *args = segment ? PyTuple_Pack(1, segment) : NULL;
+    Py_XDECREF(segment);
+    if (!args || fam_init((PyObject *)self, args, kwargs)) {
+        Py_XDECREF(args);
+        Py_DECREF(positions);
+        return -1;
+    }
+    Py_DECREF(args);
+    Py_ssize_t start = 0;
+    Py_ssize_t count = PyArray_SIZE(positions);
+    npy_int64 *p = (npy_int64 *)PyArray_DATA(positions);
+    // the last segment follows the last discarded key
+    for (Py_ssize_t i = 0; i <= count; i++) {
+        Py_ssize_t stop = i < count ? p[i] + 1 : keys_size;
+        if (stop < start || (stop == start && i < count) || stop > keys_size) {
+            PyErr_SetString(PyExc_ValueError, "Unexpected pickled object.");
+            Py_DECREF(positions);
+            return -1;
+        }
+        segment = PySequence_GetSlice(keys, start, stop);
+        if (!segment || extend(self, segment) || (i < count && discard_at(self, stop - 1))) {
+            Py_XDECREF(segment);
+            Py_DECREF(positions);
+            return -1;
+        }
+        Py_DECREF(segment);
+        start = stop;
+    }
+    Py_DECREF(positions);
+    return 0;
 }
 
 
-static PyMappingMethods fam_as_mapping = {
-    .mp_length = (lenfunc) fam_length,
-    .mp_subscript = (binaryfunc) fam_subscript,
-};
-
-
-static PyObject *
-fam_or(PyObject *left, PyObject *right)
+// Return a pointer to `bytes` bytes of the buffer of `obj`, or NULL with a ValueError of message
+// `invalid` if the buffer is of another size. If `copy`, a new PyMem allocation is returned;
+// otherwise, the caller must ensure the memory is aligned and outlives its use.
+static void *
+buffer_data(PyObject *obj, Py_ssize_t bytes, bool copy, const char *invalid)
 {
-    if (!PyObject_TypeCheck(left, &FAMType) ||
-        !PyObject_TypeCheck(right, &FAMType)
-    ) {
-        Py_RETURN_NOTIMPLEMENTED;
+    Py_buffer view;
+    if (PyObject_GetBuffer(obj, &view, PyBUF_SIMPLE)) {
+        return NULL;
     }
-    FAMObject *updated = copy(Py_TYPE(left), (FAMObject *)left);
-    if (!updated) {
+    if (view.len != bytes) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, invalid);
         return NULL;
     }
-    if (extend(updated, ((FAMObject *)right)->keys)) {
-        Py_DECREF(updated);
-        return NULL;
+    void *p = view.buf;
+    if (copy) {
+        p = PyMem_Malloc(Py_MAX(bytes, 1));
+        if (!p) {
+            PyBuffer_Release(&view);
+            PyErr_NoMemory();
+            return NULL;
+        }
+        memcpy(p, view.buf, bytes);
+    }
+    PyBuffer_Release(&view);
+    return p;
+}
+
+// Initialize from array keys of `keys_mode`, and, if KM_TABLE, the buffers of a built table, packed
+// keys (or None), and key lengths (or None). If `copy`, buffers are copied; otherwise, they must be
+// kept alive by the keys array. If `validate`, the table and keys are checked such that all probes
+// are bounded; otherwise, nothing is read. Invalid arguments raise a ValueError of message
+// `invalid`. Returns 0 on success, -1 on error.
+static int
+restore(FAMObject *self,
+        PyObject *keys,
+        int keys_mode,
+        int layout,
+        Py_ssize_t table_size,
+        PyObject *table,
+        PyObject *packed,
+        PyObject *lengths,
+        PyObject *discarded,
+        bool copy,
+        bool validate,
+        const char *invalid)
+{
+    PyArrayObject *a = (PyArrayObject *)keys;
+    KeysArrayType kat = KAT_LIST;
+    if (PyArray_Check(keys) && PyArray_NDIM(a) == 1 && PyArray_ISNOTSWAPPED(a)) {
+        int array_t = PyArray_TYPE(a);
+        if (PyTypeNum_ISINTEGER(array_t)
+                || PyTypeNum_ISFLOAT(array_t)
+                || PyTypeNum_ISFLEXIBLE(array_t)
+                || array_t == NPY_DATETIME) {
+            kat = at_to_kat(array_t, a);
+        }
+    }
+    bool flexible = kat == KAT_UNICODE || kat == KAT_STRING;
+    Py_ssize_t keys_size = kat ? PyArray_SIZE(a) : 0;
+    bool valid;
+    switch (keys_mode) {
+        case KM_TABLE:
+            valid = table_size > 0
+                    && !(table_size & (table_size - 1))
+                    && (Py_ssize_t)(keys_size / LOAD) < table_size
+                    && (packed == Py_None || kat == KAT_UNICODE)
+                    && (lengths == Py_None) != flexible;
+            break;
+        case KM_RANGE:
+            valid = keys_size > 1 && (kat_is_kind(kat, 'i') || kat_is_kind(kat, 'M'));
+            break;
+        case KM_SORTED:
+            valid = !flexible;
+            break;
+        default:
+            valid = false;
+    }
+    if (!kat
+            || !valid
+            || layout < (int)TL_WIDE
+            || layout > (int)TL_INLINE
+            || !(layout == TL_WIDE || layout == (int)table_layout_for(kat, keys_size, layout == TL_INLINE))) {
+        PyErr_SetString(PyExc_ValueError, invalid);
+        return -1;
+    }
+    Py_INCREF(keys);
+    self->keys = keys;
+    self->keys_array_type = kat;
+    self->keys_size = keys_size;
+    self->table_layout = (TableLayout)layout;
+    key_count_global += keys_size;
+
+    if (keys_mode == KM_RANGE) {
+        if (!validate) {
+            self->keys_mode = KM_RANGE;
+            self->range_start = inline_key_at(self, 0).i;
+            self->range_step = (npy_int64)((npy_uint64)inline_key_at(self, 1).i - (npy_uint64)self->range_start);
+        }
+        else if (!range_init(self)) {
+            PyErr_SetString(PyExc_ValueError, invalid);
+            return -1;
+        }
+    }
+    else if (keys_mode == KM_SORTED) {
+        if (!validate) {
+            self->keys_mode = KM_SORTED;
+        }
+        else if (sorted_init(self)) {
+            return -1;
+        }
+    }
+    else {
+        self->keys_mode = KM_TABLE;
+        self->table_size = table_size;
+        self->mapped = !copy;
+        self->table = buffer_data(table,
+                (table_size + SCAN - 1) * table_element_size(self->table_layout),
+                copy,
+                invalid);
+        if (!self->table) {
+            return -1;
+        }
+    }
+    if (discarded != Py_None) {
+        PyArrayObject *positions = (PyArrayObject *)PyArray_FROM_OTF(
+                discarded, NPY_INT64, NPY_ARRAY_IN_ARRAY);
+        if (!positions) {
+            return -1;
+        }
+        npy_int64 *p = (npy_int64 *)PyArray_DATA(positions);
+        Py_ssize_t start = 0;
+        for (Py_ssize_t i = 0; i < PyArray_SIZE(positions); i++) {
+            if (p[i] < start || p[i] >= keys_size) {
+                PyErr_SetString(PyExc_ValueError, invalid);
+                Py_DECREF(positions);
+                return -1;
+            }
+            if (discard_at(self, p[i])) {
+                Py_DECREF(positions);
+                return -1;
+            }
+            start = p[i] + 1;
+        }
+        Py_DECREF(positions);
+    }
+    if (keys_mode == KM_TABLE && validate) {
+        // each key must be in exactly one table element; as a discarded key might have been
+        // replaced by an equal key, it is in at most one
+        npy_bool *found = (npy_bool *)PyMem_Calloc(Py_MAX(keys_size, 1), 1);
+        if (!found) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        Py_ssize_t count = 0;
+        Py_ssize_t keys_pos;
+        for (Py_ssize_t table_pos = 0; table_pos < table_size + SCAN - 1; table_pos++) {
+            keys_pos = table_keys_pos(self, table_pos);
+            if (keys_pos == -1) {
+                continue;
+            }
+            if (keys_pos < 0 || keys_pos >= keys_size || found[keys_pos]) {
+                count = -1;
+                break;
+            }
+            found[keys_pos] = 1;
+            if (!key_discarded(self, keys_pos)) {
+                count++;
+            }
+        }
+        PyMem_Free(found);
+        if (count != keys_size - (self->discarded ? self->discarded->count : 0)) {
+            PyErr_SetString(PyExc_ValueError, invalid);
+            return -1;
+        }
+    }
+
+    if (keys_mode == KM_TABLE && flexible) {
+        Py_ssize_t dt_size = PyArray_ITEMSIZE(a);
+        if (kat == KAT_UNICODE) {
+            dt_size /= UCS4_SIZE;
+        }
+        // as packed keys are hashed as packed, keys are packed only if they were when the table was
+        // built
+        if (packed != Py_None) {
+            self->keys_packed = (char*)buffer_data(packed, keys_size * dt_size, copy, invalid);
+            if (!self->keys_packed) {
+                return -1;
+            }
+        }
+        else if (kat == KAT_UNICODE) {
+            self->key_buffer = (Py_UCS4*)PyMem_Malloc((dt_size+1) * UCS4_SIZE);
+            if (!self->key_buffer) {
+                PyErr_NoMemory();
+                return -1;
+            }
+        }
+        int width = dt_size <= UINT8_MAX ? 1 : dt_size <= UINT16_MAX ? 2 : 4;
+        self->keys_lengths_width = width;
+        self->keys_lengths = buffer_data(lengths, keys_size * width, copy, invalid);
+        if (!self->keys_lengths) {
+            return -1;
+        }
+        for (Py_ssize_t i = 0; validate && i < keys_size; i++) {
+            if (key_length_at(self, i) > dt_size) {
+                PyErr_SetString(PyExc_ValueError, invalid);
+                return -1;
+            }
+        }
+    }
+    if (validate && int_cache_fill(keys_size)) {
+        return -1;
     }
-    return (PyObject *)updated;
+    return 0;
 }
 
-
-static PyNumberMethods fam_as_number = {
-    .nb_or = (binaryfunc) fam_or,
-};
-
-
+// Initialize from array keys and a table state, as pickled with protocol 5 or greater, such that
+// the table is copied rather than built. Returns 0 on success, 1 if the table state is of another
+// format or platform, -1 on error.
 static int
-fam_contains(FAMObject *self, PyObject *key)
+fam_init_table(FAMObject *self, PyObject *keys, PyObject *kwargs, PyObject *discarded, PyObject *table_state)
 {
-    if (lookup(self, key) < 0) {
-        if (PyErr_Occurred()) {
+    if (!PyTuple_Check(table_state) || PyTuple_GET_SIZE(table_state) < 3) {
+        PyErr_SetString(PyExc_ValueError, "Unexpected pickled object.");
+        return -1;
+    }
+    for (Py_ssize_t i = 0; i < 3; i++) {
+        if (!PyLong_Check(PyTuple_GET_ITEM(table_state, i))) {
+            PyErr_SetString(PyExc_ValueError, "Unexpected pickled object.");
             return -1;
         }
-        return 0;
     }
-    return 1;
+    if (PyLong_AsSsize_t(PyTuple_GET_ITEM(table_state, 0)) != TABLE_FORMAT
+            || PyLong_AsSsize_t(PyTuple_GET_ITEM(table_state, 1)) != (Py_ssize_t)sizeof(Py_ssize_t)
+            || PyLong_AsSsize_t(PyTuple_GET_ITEM(table_state, 2)) != PY_LITTLE_ENDIAN) {
+        PyErr_Clear(); // values that overflow are also of another format
+        return 1;
+    }
+    Py_ssize_t format, ssize_bytes, table_size;
+    int little_endian, layout;
+    PyObject *table, *packed, *lengths;
+    if (!PyArg_ParseTuple(table_state, "nniinOOO", &format, &ssize_bytes, &little_endian,
+            &layout, &table_size, &table, &packed, &lengths)) {
+        return -1;
+    }
+    if (restore(self, keys, KM_TABLE, layout, table_size, table, packed, lengths, discarded,
+            true, true, "Unexpected pickled object.")) {
+        return -1;
+    }
+    if (kwargs && PyType_IsSubtype(Py_TYPE(self), &AMType)) {
+        PyObject *incremental = PyDict_GetItemString(kwargs, "incremental"); // borrowed ref
+        if (incremental) {
+            int v = PyObject_IsTrue(incremental);
+            if (v < 0) {
+                return -1;
+            }
+            self->incremental = v;
+        }
+    }
+    return 0;
 }
 
 
-static PySequenceMethods fam_as_sequence = {
-    .sq_contains = (objobjproc) fam_contains,
-};
-
-
-static void
-fam_dealloc(FAMObject *self)
+// State returned here is a tuple of keys, suitable for usage as an `args` argument, optionally
+// followed by a dictionary suitable for usage as a `kwargs` argument, an array of the positions of
+// discarded keys (or None), and a table state.
+static PyObject*
+fam_setstate(FAMObject *self, PyObject *state)
 {
-    if (self->table) {
-        PyMem_Free(self->table);
+    if (!PyTuple_CheckExact(state) || !PyTuple_GET_SIZE(state)) {
+        PyErr_SetString(PyExc_ValueError, "Unexpected pickled object.");
+        return NULL;
     }
-    if (self->key_buffer) {
-        PyMem_Free(self->key_buffer);
+    PyObject *keys = PyTuple_GetItem(state, 0);
+    if (PyArray_Check(keys)) {
+        // if we an array, make it immutable
+        PyArray_CLEARFLAGS((PyArrayObject*)keys, NPY_ARRAY_WRITEABLE);
     }
-    if (self->keys) {
-        Py_DECREF(self->keys);
+    PyObject *kwargs = NULL;
+    if (PyTuple_GET_SIZE(state) > 1 && PyDict_Check(PyTuple_GET_ITEM(state, 1))) {
+        kwargs = PyTuple_GET_ITEM(state, 1);
     }
-
-    key_count_global -= self->keys_size;
-
-    Py_TYPE(self)->tp_free((PyObject *)self);
-    int_cache_remove(key_count_global);
+    PyObject *discarded = PyTuple_GET_SIZE(state) > 2 ? PyTuple_GET_ITEM(state, 2) : Py_None;
+    if (PyTuple_GET_SIZE(state) > 3) {
+        int err = fam_init_table(self, keys, kwargs, discarded, PyTuple_GET_ITEM(state, 3));
+        if (err < 0) {
+            return NULL;
+        }
+        if (!err) {
+            Py_RETURN_NONE;
+        }
+        // else, the table is built from the keys
+    }
+    if (discarded != Py_None) {
+        if (fam_init_discarded(self, keys, kwargs, discarded)) {
+            return NULL;
+        }
+        Py_RETURN_NONE;
+    }
+    PyObject *args = PyTuple_GetSlice(state, 0, 1);
+    if (!args) {
+        return NULL;
+    }
+    int err = fam_init((PyObject*)self, args, kwargs);
+    Py_DECREF(args);
+    if (err) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
 }
 
 
-// Return a hash integer for an entire FAM by combining all stored hashes
-static Py_hash_t
-fam_hash(FAMObject *self)
+// Return a new PickleBuffer of `bytes` bytes at `p`, memory owned by `self`. As the memory of an
+// AutoMap changes as keys are added, it is copied; otherwise, the buffer is an immutable view.
+// Returns NULL on error.
+static PyObject *
+buffer_pickle(FAMObject *self, void *p, npy_intp bytes)
 {
-    Py_hash_t hash = 0;
-    for (Py_ssize_t i = 0; i < self->table_size; i++) {
-        hash = hash * 3 + self->table[i].hash;
+    PyObject *obj;
+    if (PyType_IsSubtype(Py_TYPE(self), &AMType)) {
+        obj = PyBytes_FromStringAndSize((char *)p, bytes);
     }
-    if (hash == -1) { // most not return -1
-        return 0;
+    else {
+        obj = PyArray_SimpleNewFromData(1, &bytes, NPY_UINT8, p);
+        if (obj) {
+            PyArray_CLEARFLAGS((PyArrayObject *)obj, NPY_ARRAY_WRITEABLE);
+            Py_INCREF(self);
+            if (PyArray_SetBaseObject((PyArrayObject *)obj, (PyObject *)self)) {
+                Py_DECREF(obj);
+                obj = NULL;
+            }
+        }
     }
-    return hash;
+    if (!obj) {
+        return NULL;
+    }
+    PyObject *buffer = PyPickleBuffer_FromObject(obj);
+    Py_DECREF(obj);
+    return buffer;
 }
 
-
+// For protocol 5 or greater, the state of a FAM of array keys in a table is followed by a table
+// state of TABLE_FORMAT, platform details, the table layout and size, and PickleBuffers of the
+// table, packed keys (or None), and key lengths (or None). For other protocols, or for keys that
+// are a list or not in a table, the default reduction is returned.
 static PyObject *
-fam_iter(FAMObject *self)
+fam_reduce_ex(FAMObject *self, PyObject *arg)
 {
-    return fami_new(self, KEYS, false);
+    long protocol = PyLong_AsLong(arg);
+    if (protocol == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    if (protocol < 5 || !self->keys_array_type || self->keys_mode != KM_TABLE) {
+        return PyObject_CallMethod((PyObject *)&PyBaseObject_Type, "__reduce_ex__", "Ol", self, protocol);
+    }
+    // as only the table is pickled, any incremental resize is first completed
+    table_migrate(self, PY_SSIZE_T_MAX);
+    PyObject *table = buffer_pickle(self, self->table,
+            (self->table_size + SCAN - 1) * table_element_size(self->table_layout));
+    if (!table) {
+        return NULL;
+    }
+    PyObject *packed = Py_None;
+    PyObject *lengths = Py_None;
+    Py_INCREF(packed);
+    Py_INCREF(lengths);
+    if (self->keys_lengths) {
+        Py_ssize_t dt_size = PyArray_ITEMSIZE((PyArrayObject *)self->keys);
+        if (self->keys_packed) {
+            Py_DECREF(packed);
+            packed = buffer_pickle(self, self->keys_packed, self->keys_size * (dt_size / UCS4_SIZE));
+        }
+        Py_DECREF(lengths);
+        lengths = buffer_pickle(self, self->keys_lengths, self->keys_size * self->keys_lengths_width);
+    }
+    PyObject *state = packed && lengths ? fam_getstate(self) : NULL;
+    PyObject *copyreg = state ? PyImport_ImportModule("copyreg") : NULL;
+    PyObject *newobj = copyreg ? PyObject_GetAttrString(copyreg, "__newobj__") : NULL;
+    Py_XDECREF(copyreg);
+    if (!newobj) {
+        Py_XDECREF(state);
+        Py_DECREF(table);
+        Py_XDECREF(packed);
+        Py_XDECREF(lengths);
+        return NULL;
+    }
+    Py_ssize_t size = PyTuple_GET_SIZE(state);
+    PyObject *keys = PyTuple_GET_ITEM(state, 0);
+    PyObject *reduced = Py_BuildValue("(N(OO)(OOO(nniinNNN)))",
+            newobj,
+            Py_TYPE(self),
+            keys,
+            keys,
+            size > 1 ? PyTuple_GET_ITEM(state, 1) : Py_None,
+            size > 2 ? PyTuple_GET_ITEM(state, 2) : Py_None,
+            (Py_ssize_t)TABLE_FORMAT,
+            (Py_ssize_t)sizeof(Py_ssize_t),
+            (int)PY_LITTLE_ENDIAN,
+            (int)self->table_layout,
+            self->table_size,
+            table,
+            packed,
+            lengths);
+    Py_DECREF(state);
+    return reduced;
 }
 
 
-static PyObject *
-fam_getnewargs(FAMObject *self)
+// The file format of FrozenAutoMap.save() and FrozenAutoMap.load(). A file begins with the bytes of
+// FILE_MAGIC, followed by FILE_FIELDS little-endian int64 fields:
+//   0: FILE_FORMAT
+//   1: TABLE_FORMAT
+//   2: the byte size of Py_ssize_t
+//   3: 1 if the platform is little-endian, else 0
+//   4: the KeysMode
+//   5: the TableLayout
+//   6: the table size, or 0 if not KM_TABLE
+//   7: the count of keys
+//   8: the count of discarded keys
+//   9: 1 if unicode keys are packed, else 0
+//   10: the byte size of the dtype string
+// followed by the dtype string (as given by `dtype.str`). Sections then follow, each starting at a
+// multiple of FILE_ALIGN bytes: the keys; the int64 positions of discarded keys, if any; and, if
+// KM_TABLE, the table, packed keys, and key lengths. If the platform or TABLE_FORMAT differs, the
+// table is built from the keys when loaded.
+# define FILE_MAGIC "ARRAYMAP"
+# define FILE_FORMAT 1
+# define FILE_FIELDS 11
+# define FILE_ALIGN 64
+
+static inline void
+file_field_set(char *p, npy_int64 v)
 {
-    return PyTuple_Pack(1, self->keys);
+    for (int i = 0; i < 8; i++) {
+        p[i] = (char)(((npy_uint64)v >> (i * 8)) & 0xFF);
+    }
 }
 
+static inline npy_int64
+file_field_get(const char *p)
+{
+    npy_uint64 v = 0;
+    for (int i = 0; i < 8; i++) {
+        v |= (npy_uint64)(unsigned char)p[i] << (i * 8);
+    }
+    return (npy_int64)v;
+}
 
-static PyObject *
-fam_reversed(FAMObject *self)
+// Given `end`, the end offset of the previous section, return the offset of the next section, of
+// `count` items of `item_size` bytes, and set `end` to its end. Returns -1 if the section would
+// extend beyond `size` bytes.
+static Py_ssize_t
+file_section(Py_ssize_t *end, npy_int64 count, Py_ssize_t item_size, Py_ssize_t size)
 {
-    return fami_new(self, KEYS, true);
+    Py_ssize_t start = (*end + FILE_ALIGN - 1) / FILE_ALIGN * FILE_ALIGN;
+    if (count < 0 || start > size || (item_size && count > (size - start) / item_size)) {
+        return -1;
+    }
+    *end = start + (Py_ssize_t)count * item_size;
+    return start;
 }
 
+// A destination of the file format: if `f` is set, a file object; if `dst` is set, memory of
+// sufficient size. If neither is set, nothing is written, such that `pos` gives the size required.
+typedef struct FileWriter {
+    PyObject *f;
+    char *dst;
+    Py_ssize_t pos;
+} FileWriter;
 
-static PyObject *
-fam_sizeof(FAMObject *self)
+// Write `pad` null bytes, then `bytes` bytes at `p`. Returns 0 on success, -1 on error.
+static int
+file_write(FileWriter *w, const void *p, Py_ssize_t bytes, Py_ssize_t pad)
 {
-    PyObject *listsizeof = PyObject_CallMethod(self->keys, "__sizeof__", NULL);
-    if (!listsizeof) {
-        return NULL;
+    static char nulls[FILE_ALIGN];
+    PyObject *view, *post;
+    if (w->dst) {
+        memset(w->dst + w->pos, 0, pad);
+        if (bytes) {
+            memcpy(w->dst + w->pos + pad, p, bytes);
+        }
     }
-    Py_ssize_t listbytes = PyLong_AsSsize_t(listsizeof);
-    Py_DECREF(listsizeof);
-    if (listbytes == -1 && PyErr_Occurred()) {
-        return NULL;
+    else if (w->f) {
+        if (pad) {
+            view = PyMemoryView_FromMemory(nulls, pad, PyBUF_READ);
+            post = view ? PyObject_CallMethod(w->f, "write", "O", view) : NULL;
+            Py_XDECREF(view);
+            if (!post) {
+                return -1;
+            }
+            Py_DECREF(post);
+        }
+        if (bytes) {
+            view = PyMemoryView_FromMemory((char *)p, bytes, PyBUF_READ);
+            post = view ? PyObject_CallMethod(w->f, "write", "O", view) : NULL;
+            Py_XDECREF(view);
+            if (!post) {
+                return -1;
+            }
+            Py_DECREF(post);
+        }
     }
-    return PyLong_FromSsize_t(
-        Py_TYPE(self)->tp_basicsize
-        + listbytes
-        + (self->table_size + SCAN - 1) * sizeof(TableElement)
-    );
+    w->pos += pad + bytes;
+    return 0;
 }
 
-
-static PyObject *
-fam_get(FAMObject *self, PyObject *args)
+// Write a section of `count` items of `item_size` bytes at `p`, starting at the multiple of
+// FILE_ALIGN bytes at or after the end of the previous section. Returns 0 on success, -1 on error.
+static int
+file_write_section(FileWriter *w, const void *p, Py_ssize_t count, Py_ssize_t item_size)
 {
-    PyObject *key, *missing = Py_None;
-    if (!PyArg_UnpackTuple(args, Py_TYPE(self)->tp_name, 1, 2, &key, &missing))
-    {
-        return NULL;
-    }
-    return get(self, key, missing);
+    Py_ssize_t end = w->pos;
+    Py_ssize_t start = file_section(&end, count, item_size, PY_SSIZE_T_MAX);
+    return file_write(w, p, end - start, start - w->pos);
 }
 
+// The parts of a FAM written in the file format, excepting those written from the FAM directly.
+typedef struct FileParts {
+    PyArrayObject *keys; // contiguous
+    PyObject *dtype;
+    const char *dtype_str;
+    Py_ssize_t dtype_size;
+    npy_int64 *positions; // of discarded keys; NULL if none
+    Py_ssize_t discarded_count;
+} FileParts;
 
-static PyObject *
-fam_items(FAMObject *self)
+static void
+file_parts_clear(FileParts *parts)
 {
-    return famv_new(self, ITEMS);
+    Py_CLEAR(parts->keys);
+    Py_CLEAR(parts->dtype);
+    PyMem_Free(parts->positions);
+    parts->positions = NULL;
 }
 
-
-static PyObject *
-fam_keys(FAMObject *self)
+// Prepare the parts of a FAM of array keys to be written; `parts` must be zero-initialized, and is
+// cleared on error. Returns 0 on success, -1 on error.
+static int
+file_parts_init(FAMObject *self, FileParts *parts)
 {
-    return famv_new(self, KEYS);
+    // as only the table is written, any incremental resize is first completed
+    table_migrate(self, PY_SSIZE_T_MAX);
+    PyObject *view = keys_view(self);
+    if (!view) {
+        return -1;
+    }
+    parts->keys = PyArray_GETCONTIGUOUS((PyArrayObject *)view);
+    Py_DECREF(view);
+    if (!parts->keys) {
+        return -1;
+    }
+    parts->dtype = PyObject_GetAttrString((PyObject *)PyArray_DESCR(parts->keys), "str");
+    if (!parts->dtype) {
+        goto error;
+    }
+    parts->dtype_str = PyUnicode_AsUTF8AndSize(parts->dtype, &parts->dtype_size);
+    if (!parts->dtype_str) {
+        goto error;
+    }
+    parts->discarded_count = self->discarded ? self->discarded->count : 0;
+    if (parts->discarded_count) {
+        parts->positions = (npy_int64 *)PyMem_Malloc(parts->discarded_count * sizeof(npy_int64));
+        if (!parts->positions) {
+            PyErr_NoMemory();
+            goto error;
+        }
+        npy_int64 *p = parts->positions;
+        for (Py_ssize_t i = 0; i < self->keys_size; i++) {
+            if (key_discarded(self, i)) {
+                *p++ = i;
+            }
+        }
+    }
+    return 0;
+error:
+    file_parts_clear(parts);
+    return -1;
 }
 
+// Write a FAM, with parts given by file_parts_init(), in the format described above. Returns 0 on
+// success, -1 on error.
+static int
+file_write_fam(FAMObject *self, FileParts *parts, FileWriter *w)
+{
+    bool table = self->keys_mode == KM_TABLE;
+    Py_ssize_t dt_size = PyArray_ITEMSIZE(parts->keys);
+    npy_int64 fields[FILE_FIELDS] = {
+        FILE_FORMAT,
+        TABLE_FORMAT,
+        sizeof(Py_ssize_t),
+        PY_LITTLE_ENDIAN,
+        self->keys_mode,
+        self->table_layout,
+        table ? self->table_size : 0,
+        self->keys_size,
+        parts->discarded_count,
+        self->keys_packed != NULL,
+        parts->dtype_size,
+    };
+    char header[sizeof(FILE_MAGIC) - 1 + FILE_FIELDS * 8];
+    memcpy(header, FILE_MAGIC, sizeof(FILE_MAGIC) - 1);
+    for (int i = 0; i < FILE_FIELDS; i++) {
+        file_field_set(header + sizeof(FILE_MAGIC) - 1 + i * 8, fields[i]);
+    }
+    if (file_write(w, header, sizeof(header), 0)
+            || file_write(w, parts->dtype_str, parts->dtype_size, 0)
+            || file_write_section(w, PyArray_DATA(parts->keys), self->keys_size, dt_size)
+            || file_write_section(w, parts->positions, parts->discarded_count, sizeof(npy_int64))
+            || (table && file_write_section(w, self->table,
+                    self->table_size + SCAN - 1, table_element_size(self->table_layout)))
+            || (self->keys_packed && file_write_section(w, self->keys_packed,
+                    self->keys_size, dt_size / UCS4_SIZE))
+            || (self->keys_lengths && file_write_section(w, self->keys_lengths,
+                    self->keys_size, self->keys_lengths_width))) {
+        return -1;
+    }
+    return 0;
+}
 
+// Save array keys, and any table, to `path` in the format described above, such that keys need not
+// be hashed when loaded.
 static PyObject *
-fam_values(FAMObject *self)
+fam_save(FAMObject *self, PyObject *path)
 {
-    return famv_new(self, VALUES);
+    if (!self->keys_array_type) {
+        PyErr_Format(PyExc_TypeError, "%s of list keys cannot be saved", Py_TYPE(self)->tp_name);
+        return NULL;
+    }
+    FileParts parts = {0};
+    if (file_parts_init(self, &parts)) {
+        return NULL;
+    }
+    PyObject *io = PyImport_ImportModule("io");
+    FileWriter w = {0};
+    w.f = io ? PyObject_CallMethod(io, "open", "Os", path, "wb") : NULL;
+    Py_XDECREF(io);
+    if (!w.f) {
+        file_parts_clear(&parts);
+        return NULL;
+    }
+    if (file_write_fam(self, &parts, &w)) {
+        // close the file, keeping the current exception
+        PyObject *type, *value, *traceback;
+        PyErr_Fetch(&type, &value, &traceback);
+        Py_XDECREF(PyObject_CallMethod(w.f, "close", NULL));
+        PyErr_Restore(type, value, traceback);
+        Py_DECREF(w.f);
+        file_parts_clear(&parts);
+        return NULL;
+    }
+    file_parts_clear(&parts);
+    PyObject *post = PyObject_CallMethod(w.f, "close", NULL);
+    Py_DECREF(w.f);
+    if (!post) {
+        return NULL;
+    }
+    Py_DECREF(post);
+    Py_RETURN_NONE;
 }
 
-
+// Share array keys, and any table, in a new multiprocessing.shared_memory.SharedMemory, in the
+// format described above, to be attached with FrozenAutoMap.attach(). The caller closes and unlinks
+// the returned SharedMemory.
 static PyObject *
-fam_new(PyTypeObject *cls, PyObject *args, PyObject *kwargs)
+fam_share(FAMObject *self, PyObject *args, PyObject *kwargs)
 {
-    // NOTE: The original fam_new used to be able to provide a same reference back if a fam was in the args; this is tricky now that we have fam_init
-    FAMObject *self = (FAMObject *)cls->tp_alloc(cls, 0);
-    if (!self) {
+    PyObject *name = Py_None;
+    static char *kwlist[] = {"name", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O:share", kwlist, &name)) {
         return NULL;
     }
-    self->table = NULL;
-    self->keys = NULL;
-    self->key_buffer = NULL;
-    self->keys_size = 0;
-    return (PyObject*)self;
+    if (!self->keys_array_type) {
+        PyErr_Format(PyExc_TypeError, "%s of list keys cannot be shared", Py_TYPE(self)->tp_name);
+        return NULL;
+    }
+    FileParts parts = {0};
+    if (file_parts_init(self, &parts)) {
+        return NULL;
+    }
+    // find the size with a writer of no destination, which cannot fail
+    FileWriter w = {0};
+    file_write_fam(self, &parts, &w);
+
+    PyObject *shm = NULL;
+    PyObject *buf = NULL;
+    Py_buffer view = {0};
+    PyObject *module = PyImport_ImportModule("multiprocessing.shared_memory");
+    PyObject *shm_type = module ? PyObject_GetAttrString(module, "SharedMemory") : NULL;
+    Py_XDECREF(module);
+    PyObject *shm_kwargs = shm_type ? Py_BuildValue("{sOsOsn}",
+            "name", name, "create", Py_True, "size", w.pos) : NULL;
+    PyObject *shm_args = shm_kwargs ? PyTuple_New(0) : NULL;
+    if (shm_args) {
+        shm = PyObject_Call(shm_type, shm_args, shm_kwargs);
+    }
+    Py_XDECREF(shm_args);
+    Py_XDECREF(shm_kwargs);
+    Py_XDECREF(shm_type);
+    if (!shm) {
+        file_parts_clear(&parts);
+        return NULL;
+    }
+    buf = PyObject_GetAttrString(shm, "buf");
+    if (!buf || PyObject_GetBuffer(buf, &view, PyBUF_WRITABLE)) {
+        goto error;
+    }
+    if (view.len < w.pos) {
+        PyErr_SetString(PyExc_ValueError, "SharedMemory is smaller than requested");
+        goto error;
+    }
+    w.dst = (char *)view.buf;
+    w.pos = 0;
+    file_write_fam(self, &parts, &w); // as is writing to memory
+    PyBuffer_Release(&view);
+    Py_DECREF(buf);
+    file_parts_clear(&parts);
+    return shm;
+error:
+    if (view.obj) {
+        PyBuffer_Release(&view);
+    }
+    Py_XDECREF(buf);
+    file_parts_clear(&parts);
+    { // close and unlink the segment, keeping the current exception
+        PyObject *type, *value, *traceback;
+        PyErr_Fetch(&type, &value, &traceback);
+        Py_XDECREF(PyObject_CallMethod(shm, "close", NULL));
+        Py_XDECREF(PyObject_CallMethod(shm, "unlink", NULL));
+        PyErr_Restore(type, value, traceback);
+    }
+    Py_DECREF(shm);
+    return NULL;
 }
 
-
-// This macro can be used with integer and floating point NumPy types, given an `npy_type` and a specialized `insert_func`. Uses context of `fam_init` to get `fam`, `contiguous`, `a`, `keys_size`, and `i`. An optional `post_deref` function can be supplied to transform extracted values before calling the appropriate insert function.
-# define INSERT_SCALARS(npy_type, insert_func, kat, post_deref)   \
-{                                                                 \
-    if (contiguous) {                                             \
-        npy_type* b = (npy_type*)PyArray_DATA(a);                 \
-        npy_type* b_end = b + keys_size;                          \
-        while (b < b_end) {                                       \
-            if (insert_func(fam, post_deref(*b), i, -1, kat)) {   \
-                goto error;                                       \
-            }                                                     \
-            b++;                                                  \
-            i++;                                                  \
-        }                                                         \
-    }                                                             \
-    else {                                                        \
-        for (; i < keys_size; i++) {                              \
-            if (insert_func(fam,                                  \
-                    post_deref(*(npy_type*)PyArray_GETPTR1(a, i)),\
-                    i,                                            \
-                    -1,                                           \
-                    kat)) {                                       \
-                goto error;                                       \
-            }                                                     \
-        }                                                         \
-    }                                                             \
-}                                                                 \
-
-// This macro is for inserting flexible-sized types, Unicode (Py_UCS4) or strings (char). Uses context of `fam_init`.
-# define INSERT_FLEXIBLE(char_type, insert_func, get_end_func)     \
-{                                                                  \
-    char_type* p = NULL;                                           \
-    if (contiguous) {                                              \
-        char_type *b = (char_type*)PyArray_DATA(a);                \
-        char_type *b_end = b + keys_size * dt_size;                \
-        while (b < b_end) {                                        \
-            p = get_end_func(b, dt_size);                          \
-            if (insert_func(fam, b, p-b, i, -1)) {                 \
-                goto error;                                        \
-            }                                                      \
-            b += dt_size;                                          \
-            i++;                                                   \
-        }                                                          \
-    }                                                              \
-    else {                                                         \
-        for (; i < keys_size; i++) {                               \
-            char_type* v = (char_type*)PyArray_GETPTR1(a, i);      \
-            p = get_end_func(v, dt_size);                          \
-            if (insert_func(fam, v, p-v, i, -1)) {                 \
-                goto error;                                        \
-            }                                                      \
-        }                                                          \
-    }                                                              \
-}                                                                  \
-
-// Initialize an allocated FAMObject. Returns 0 on success, -1 on error.
-int
-fam_init(PyObject *self, PyObject *args, PyObject *kwargs)
+// Return a read-only 1-D array of `count` items of `descr` at `p`, kept alive by `base`. Steals a
+// reference to `descr`.
+static PyObject *
+buffer_array(PyObject *base, PyArray_Descr *descr, npy_intp count, const char *p)
 {
-    PyTypeObject* cls = Py_TYPE(self); // borrowed ref
-    const char *name = cls->tp_name;
-    FAMObject* fam = (FAMObject*)self;
-
-    if (kwargs) {
-        PyErr_Format(PyExc_TypeError, "%s takes no keyword arguments", name);
-        return -1;
+    PyObject *a = PyArray_NewFromDescr(&PyArray_Type, descr, 1, &count, NULL, (void *)p, 0, NULL);
+    if (!a) {
+        return NULL;
     }
+    Py_INCREF(base);
+    if (PyArray_SetBaseObject((PyArrayObject *)a, base)) { // steals base
+        Py_DECREF(a);
+        return NULL;
+    }
+    return a;
+}
 
-    KeysArrayType keys_array_type = KAT_LIST; // default, will override if necessary
-
+// Return a new FAM of type `cls` from `size` bytes at `buf` in the format described above, of
+// memory kept alive by `base`. If `map`, keys and any table are used in place; otherwise, they are
+// copied. If `validate`, the table is validated as when unpickled.
+static PyObject *
+fam_from_buffer(PyTypeObject *cls, PyObject *base, const char *buf, Py_ssize_t size, bool map, bool validate)
+{
+    static const char *invalid = "Unexpected file format.";
     PyObject *keys = NULL;
-    Py_ssize_t keys_size = 0;
-
-    if (!PyArg_UnpackTuple(args, name, 0, 1, &keys)) {
-        return -1;
+    PyObject *fam = NULL;
+    PyObject *positions = NULL;
+    PyObject *table = NULL;
+    PyObject *packed = NULL;
+    PyObject *lengths = NULL;
+    int err;
+
+    Py_ssize_t end = sizeof(FILE_MAGIC) - 1 + FILE_FIELDS * 8;
+    npy_int64 fields[FILE_FIELDS];
+    if (size < end || memcmp(buf, FILE_MAGIC, sizeof(FILE_MAGIC) - 1)) {
+        PyErr_SetString(PyExc_ValueError, invalid);
+        return NULL;
     }
-
+    for (int i = 0; i < FILE_FIELDS; i++) {
+        fields[i] = file_field_get(buf + sizeof(FILE_MAGIC) - 1 + i * 8);
+    }
+    npy_int64 keys_mode = fields[4];
+    npy_int64 layout = fields[5];
+    npy_int64 table_size = fields[6];
+    npy_int64 keys_size = fields[7];
+    npy_int64 discarded_count = fields[8];
+    npy_int64 dtype_size = fields[10];
+    if (fields[0] != FILE_FORMAT
+            || keys_mode < KM_TABLE
+            || keys_mode > KM_SORTED
+            || dtype_size < 0
+            || dtype_size > size - end) {
+        PyErr_SetString(PyExc_ValueError, invalid);
+        return NULL;
+    }
+    PyObject *dtype = PyUnicode_FromStringAndSize(buf + end, (Py_ssize_t)dtype_size);
+    if (!dtype) {
+        return NULL;
+    }
+    end += (Py_ssize_t)dtype_size;
+    PyArray_Descr *descr = NULL;
+    err = !PyArray_DescrConverter(dtype, &descr);
+    Py_DECREF(dtype);
+    if (err) {
+        return NULL;
+    }
+    Py_ssize_t item_size = (Py_ssize_t)PyDataType_ELSIZE(descr);
+    Py_ssize_t start = file_section(&end, keys_size, item_size, size);
+    if (start < 0 || !item_size) {
+        Py_DECREF(descr);
+        PyErr_SetString(PyExc_ValueError, invalid);
+        return NULL;
+    }
+    keys = buffer_array(base, descr, (npy_intp)keys_size, buf + start); // steals descr
     if (!keys) {
-        keys = PyList_New(0);
-        if (!keys) {
-            return -1;
+        return NULL;
+    }
+    start = file_section(&end, discarded_count, sizeof(npy_int64), size);
+    if (start < 0) {
+        PyErr_SetString(PyExc_ValueError, invalid);
+        goto error;
+    }
+    // mapped buffers are kept alive by the keys array, so it must not be converted
+    bool native = fields[1] == TABLE_FORMAT
+            && fields[2] == (npy_int64)sizeof(Py_ssize_t)
+            && fields[3] == PY_LITTLE_ENDIAN
+            && PyArray_ISNOTSWAPPED((PyArrayObject *)keys);
+    if (discarded_count) {
+        PyArray_Descr *descr_positions = PyArray_DescrFromType(NPY_INT64);
+        if (fields[3] != PY_LITTLE_ENDIAN) {
+            Py_SETREF(descr_positions, PyArray_DescrNewByteorder(descr_positions, NPY_SWAP));
+        }
+        if (!descr_positions) {
+            goto error;
+        }
+        positions = buffer_array(base, descr_positions, (npy_intp)discarded_count, buf + start);
+        if (!positions) {
+            goto error;
         }
     }
-    else if (PyObject_TypeCheck(keys, &FAMType)) {
-        // Use `keys` as old, `self` as new, and fill from old to new. This returns the same error codes as this function.
-        return copy_to_new(cls, (FAMObject*)keys, fam);
+    else {
+        positions = Py_None;
+        Py_INCREF(positions);
     }
-    else if (PyArray_Check(keys)) {
-        PyArrayObject *a = (PyArrayObject *)keys;
-        if (PyArray_NDIM(a) != 1) {
-            PyErr_SetString(PyExc_TypeError, "Arrays must be 1-dimensional");
-            return -1;
+    if (!PyArray_ISNOTSWAPPED((PyArrayObject *)keys)) {
+        PyArray_Descr *descr_native = PyArray_DescrNewByteorder(PyArray_DESCR((PyArrayObject *)keys), NPY_NATIVE);
+        Py_SETREF(keys, descr_native ? PyArray_FromArray((PyArrayObject *)keys, descr_native, NPY_ARRAY_DEFAULT) : NULL);
+        if (!keys) {
+            goto error;
         }
-
-        int array_t = PyArray_TYPE(a);
-        keys_size = PyArray_SIZE(a);
-
-        if (cls != &AMType &&
-                (PyTypeNum_ISINTEGER(array_t) // signed and unsigned
-                || PyTypeNum_ISFLOAT(array_t)
-                || PyTypeNum_ISFLEXIBLE(array_t)
-                || array_t == NPY_DATETIME ))
-            {
-            if ((PyArray_FLAGS(a) & NPY_ARRAY_WRITEABLE)) {
-                PyErr_Format(PyExc_TypeError, "Arrays must be immutable when given to a %s", name);
-                return -1;
-            }
-            // NOTE: this might return 0 (list) given a dt64 array without a unit
-            keys_array_type = at_to_kat(array_t, a);
+        PyArray_CLEARFLAGS((PyArrayObject *)keys, NPY_ARRAY_WRITEABLE);
+    }
+    else if (!map) {
+        Py_SETREF(keys, PyArray_NewCopy((PyArrayObject *)keys, NPY_CORDER));
+        if (!keys) {
+            goto error;
         }
-
-        if (keys_array_type) { // we have a usable array
-            Py_INCREF(keys);
+        PyArray_CLEARFLAGS((PyArrayObject *)keys, NPY_ARRAY_WRITEABLE);
+    }
+    fam = fam_new(cls, NULL, NULL);
+    if (!fam) {
+        goto error;
+    }
+    if (native) {
+        table = Py_None;
+        Py_INCREF(table);
+        packed = Py_None;
+        Py_INCREF(packed);
+        lengths = Py_None;
+        Py_INCREF(lengths);
+    }
+    if (native && keys_mode == KM_TABLE) {
+        if (layout < TL_WIDE || layout > TL_INLINE || table_size < 1 || table_size > size) {
+            PyErr_SetString(PyExc_ValueError, invalid);
+            goto error;
         }
-        else {
-            // DEBUG_MSG_OBJ("got KAT", PyLong_FromLongLong(keys_array_type));
-            // if an AutoMap or an array that we do not handle, create a list
-            if (array_t == NPY_DATETIME || array_t == NPY_TIMEDELTA){
-                keys = PySequence_List(keys); // force scalars
+        start = file_section(&end, table_size + SCAN - 1, table_element_size((TableLayout)layout), size);
+        if (start < 0) {
+            PyErr_SetString(PyExc_ValueError, invalid);
+            goto error;
+        }
+        Py_SETREF(table, PyMemoryView_FromMemory((char *)buf + start, end - start, PyBUF_READ));
+        if (!table) {
+            goto error;
+        }
+        Py_ssize_t dt_size = PyArray_ITEMSIZE((PyArrayObject *)keys);
+        if (PyArray_TYPE((PyArrayObject *)keys) == NPY_UNICODE) {
+            dt_size /= UCS4_SIZE;
+        }
+        if (fields[9]) {
+            start = file_section(&end, keys_size, dt_size, size);
+            if (start < 0) {
+                PyErr_SetString(PyExc_ValueError, invalid);
+                goto error;
             }
-            else {
-                keys = PyArray_ToList(a); // converts to objs
+            Py_SETREF(packed, PyMemoryView_FromMemory((char *)buf + start, end - start, PyBUF_READ));
+            if (!packed) {
+                goto error;
             }
-            if (!keys) {
-                return -1;
+        }
+        if (PyTypeNum_ISFLEXIBLE(PyArray_TYPE((PyArrayObject *)keys))) {
+            int width = dt_size <= UINT8_MAX ? 1 : dt_size <= UINT16_MAX ? 2 : 4;
+            start = file_section(&end, keys_size, width, size);
+            if (start < 0) {
+                PyErr_SetString(PyExc_ValueError, invalid);
+                goto error;
+            }
+            Py_SETREF(lengths, PyMemoryView_FromMemory((char *)buf + start, end - start, PyBUF_READ));
+            if (!lengths) {
+                goto error;
             }
         }
     }
-    else { // assume an arbitrary iterable
-        keys = PySequence_List(keys);
-        if (!keys) {
-            return -1;
+    if (native) {
+        // an AutoMap changes its table as keys are added, so it is always copied
+        bool copy = !map || PyType_IsSubtype(cls, &AMType);
+        if (restore((FAMObject *)fam, keys, (int)keys_mode, (int)layout, (Py_ssize_t)table_size,
+                table, packed, lengths, positions, copy, validate, invalid)) {
+            goto error;
         }
-        keys_size = PyList_GET_SIZE(keys);
-    }
-
-    fam->keys = keys;
-    fam->keys_array_type = keys_array_type;
-    fam->keys_size = keys_size;
-    fam->key_buffer = NULL;
-    key_count_global += keys_size;
-
-    // NOTE: on itialization, grow_table() does not use keys
-    if (grow_table(fam, keys_size)) {
-        return -1;
     }
-    Py_ssize_t i = 0;
-    if (keys_array_type) {
-        PyArrayObject *a = (PyArrayObject *)fam->keys;
-        int contiguous = PyArray_IS_C_CONTIGUOUS(a);
-        switch (keys_array_type) {
-            case KAT_INT64:
-                INSERT_SCALARS(npy_int64, insert_int, keys_array_type,);
-                break;
-            case KAT_INT32:
-                INSERT_SCALARS(npy_int32, insert_int, keys_array_type,);
-                break;
-            case KAT_INT16:
-                INSERT_SCALARS(npy_int16, insert_int, keys_array_type,);
-                break;
-            case KAT_INT8:
-                INSERT_SCALARS(npy_int8, insert_int, keys_array_type,);
-                break;
-            case KAT_UINT64:
-                INSERT_SCALARS(npy_uint64, insert_uint, keys_array_type,);
-                break;
-            case KAT_UINT32:
-                INSERT_SCALARS(npy_uint32, insert_uint, keys_array_type,);
-                break;
-            case KAT_UINT16:
-                INSERT_SCALARS(npy_uint16, insert_uint, keys_array_type,);
-                break;
-            case KAT_UINT8:
-                INSERT_SCALARS(npy_uint8, insert_uint, keys_array_type,);
-                break;
-            case KAT_FLOAT64:
-                INSERT_SCALARS(npy_double, insert_double, keys_array_type,);
-                break;
-            case KAT_FLOAT32:
-                INSERT_SCALARS(npy_float, insert_double, keys_array_type,);
-                break;
-            case KAT_FLOAT16:
-                INSERT_SCALARS(npy_half, insert_double, keys_array_type, npy_half_to_double);
-                break;
-            case KAT_UNICODE: {
-                // Over allocate buffer by 1 so there is room for null at end. This buffer is only used in lookup();
-                Py_ssize_t dt_size = PyArray_ITEMSIZE(a) / UCS4_SIZE;
-                fam->key_buffer = (Py_UCS4*)PyMem_Malloc((dt_size+1) * UCS4_SIZE);
-                INSERT_FLEXIBLE(Py_UCS4, insert_unicode, ucs4_get_end_p);
-                break;
-            }
-            case KAT_STRING: {
-                Py_ssize_t dt_size = PyArray_ITEMSIZE(a);
-                INSERT_FLEXIBLE(char, insert_string, char_get_end_p);
-                break;
-            }
-            case KAT_DTY:
-            case KAT_DTM:
-            case KAT_DTW:
-            case KAT_DTD:
-            case KAT_DTh:
-            case KAT_DTm:
-            case KAT_DTs:
-            case KAT_DTms:
-            case KAT_DTus:
-            case KAT_DTns:
-            case KAT_DTps:
-            case KAT_DTfs:
-            case KAT_DTas:
-                INSERT_SCALARS(npy_int64, insert_int, KAT_INT64,);
-                break;
-            default:
-                return -1;
+    else { // build the table, or find keys without one, as on initialization
+        PyObject *fam_kwargs = Py_BuildValue("{sOsO}",
+                "inline", layout == TL_INLINE ? Py_True : Py_False,
+                "sorted", keys_mode == KM_SORTED ? Py_True : Py_False);
+        if (!fam_kwargs) {
+            goto error;
         }
-    }
-    else {
-        for (; i < keys_size; i++) {
-            if (insert_obj(fam, PyList_GET_ITEM(keys, i), i, -1)) {
-                goto error;
-            }
+        if (positions != Py_None) {
+            err = fam_init_discarded((FAMObject *)fam, keys, fam_kwargs, positions);
+        }
+        else {
+            PyObject *fam_args = PyTuple_Pack(1, keys);
+            err = !fam_args || fam_init(fam, fam_args, fam_kwargs);
+            Py_XDECREF(fam_args);
+        }
+        Py_DECREF(fam_kwargs);
+        if (err) {
+            goto error;
         }
     }
-    return 0;
+    Py_XDECREF(table);
+    Py_XDECREF(packed);
+    Py_XDECREF(lengths);
+    Py_DECREF(positions);
+    Py_DECREF(keys);
+    return fam;
 error:
-    // assume all dynamic memory assigned to struct attrs that will be cleaned
-    return -1;
+    Py_XDECREF(table);
+    Py_XDECREF(packed);
+    Py_XDECREF(lengths);
+    Py_XDECREF(positions);
+    Py_XDECREF(fam);
+    Py_XDECREF(keys);
+    return NULL;
 }
 
-
-# undef INSERT_SCALARS
-# undef INSERT_FLEXIBLE
-
-
+// Load a FAM saved with FrozenAutoMap.save(). If `mmap`, the file is memory-mapped, and keys and
+// any table are used in place; otherwise, they are copied. The table is validated as when
+// unpickled.
 static PyObject *
-fam_repr(FAMObject *self)
+fam_load(PyTypeObject *cls, PyObject *args, PyObject *kwargs)
 {
-    return PyUnicode_FromFormat("%s(%R)", Py_TYPE(self)->tp_name, self->keys);
+    PyObject *path;
+    int map = 1;
+    static char *kwlist[] = {"path", "mmap", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|$p", kwlist, &path, &map)) {
+        return NULL;
+    }
+    PyObject *mm = NULL;
+    PyObject *io = PyImport_ImportModule("io");
+    PyObject *f = io ? PyObject_CallMethod(io, "open", "Os", path, "rb") : NULL;
+    Py_XDECREF(io);
+    if (!f) {
+        return NULL;
+    }
+    PyObject *fileno = PyObject_CallMethod(f, "fileno", NULL);
+    PyObject *module = fileno ? PyImport_ImportModule("mmap") : NULL;
+    PyObject *access = module ? PyObject_GetAttrString(module, "ACCESS_READ") : NULL;
+    PyObject *mm_args = access ? Py_BuildValue("(Oi)", fileno, 0) : NULL;
+    PyObject *mm_kwargs = mm_args ? Py_BuildValue("{sO}", "access", access) : NULL;
+    PyObject *mm_type = mm_kwargs ? PyObject_GetAttrString(module, "mmap") : NULL;
+    if (mm_type) {
+        mm = PyObject_Call(mm_type, mm_args, mm_kwargs);
+    }
+    Py_XDECREF(mm_type);
+    Py_XDECREF(mm_kwargs);
+    Py_XDECREF(mm_args);
+    Py_XDECREF(access);
+    Py_XDECREF(module);
+    Py_XDECREF(fileno);
+    // the map is not closed with the file
+    PyObject *post = mm ? PyObject_CallMethod(f, "close", NULL) : NULL;
+    Py_DECREF(f);
+    if (!post) {
+        Py_XDECREF(mm);
+        return NULL;
+    }
+    Py_DECREF(post);
+    Py_buffer view;
+    if (PyObject_GetBuffer(mm, &view, PyBUF_SIMPLE)) {
+        Py_DECREF(mm);
+        return NULL;
+    }
+    PyObject *fam = fam_from_buffer(cls, mm, (const char *)view.buf, view.len, map, true);
+    PyBuffer_Release(&view);
+    Py_DECREF(mm);
+    return fam;
 }
 
-
+// Return a new reference to the existing multiprocessing.shared_memory.SharedMemory of `name`, not
+// registered with the resource tracker of this process, such that the segment is not unlinked when
+// this process exits. Returns NULL on error.
 static PyObject *
-fam_richcompare(FAMObject *self, PyObject *other, int op)
+shm_open(PyObject *name)
 {
-    if (!PyObject_TypeCheck(other, &FAMType)) {
-        Py_RETURN_NOTIMPLEMENTED;
+    PyObject *module = PyImport_ImportModule("multiprocessing.shared_memory");
+    if (!module) {
+        return NULL;
     }
-    return PyObject_RichCompare(self->keys, ((FAMObject *)other)->keys, op);
-}
-
-
-static PyObject*
-fam_getstate(FAMObject *self)
-{
-    PyObject* state = PyTuple_Pack(1, self->keys);
-    return state;
+    PyObject *shm_type = PyObject_GetAttrString(module, "SharedMemory");
+    if (!shm_type) {
+        Py_DECREF(module);
+        return NULL;
+    }
+#if PY_VERSION_HEX >= 0x030D0000
+    Py_DECREF(module);
+    PyObject *shm_args = PyTuple_Pack(1, name);
+    PyObject *shm_kwargs = shm_args ? Py_BuildValue("{sO}", "track", Py_False) : NULL;
+    PyObject *shm = shm_kwargs ? PyObject_Call(shm_type, shm_args, shm_kwargs) : NULL;
+    Py_XDECREF(shm_args);
+    Py_XDECREF(shm_kwargs);
+    Py_DECREF(shm_type);
+    return shm;
+#else
+    // before Python 3.13, opening a segment on POSIX registers it, so it is unregistered
+    PyObject *shm = PyObject_CallFunctionObjArgs(shm_type, name, NULL);
+    Py_DECREF(shm_type);
+    PyObject *posix = shm ? PyObject_GetAttrString(module, "_USE_POSIX") : NULL;
+    Py_DECREF(module);
+    int use_posix = posix ? PyObject_IsTrue(posix) : -1;
+    Py_XDECREF(posix);
+    if (use_posix > 0) {
+        PyObject *tracker = PyImport_ImportModule("multiprocessing.resource_tracker");
+        PyObject *shm_name = tracker ? PyObject_GetAttrString(shm, "_name") : NULL;
+        PyObject *post = shm_name ? PyObject_CallMethod(tracker, "unregister", "Os",
+                shm_name, "shared_memory") : NULL;
+        Py_XDECREF(tracker);
+        Py_XDECREF(shm_name);
+        Py_XDECREF(post);
+        if (!post) {
+            use_posix = -1;
+        }
+    }
+    if (use_posix < 0) {
+        Py_XDECREF(shm);
+        return NULL;
+    }
+    return shm;
+#endif
 }
 
-
-// State returned here is a tuple of keys, suitable for usage as an `args` argument.
-static PyObject*
-fam_setstate(FAMObject *self, PyObject *state)
+// Attach a FAM shared with FrozenAutoMap.share(), given the returned SharedMemory or its name. Keys
+// and any table are used in place, without being read or copied. The SharedMemory is kept open
+// while the FAM, or any array of its keys, exists.
+static PyObject *
+fam_attach(PyTypeObject *cls, PyObject *shm)
 {
-    if (!PyTuple_CheckExact(state) || !PyTuple_GET_SIZE(state)) {
-        PyErr_SetString(PyExc_ValueError, "Unexpected pickled object.");
+    if (PyUnicode_Check(shm)) {
+        shm = shm_open(shm);
+        if (!shm) {
+            return NULL;
+        }
+    }
+    else {
+        Py_INCREF(shm);
+    }
+    // a view of the buffer of the SharedMemory prevents closing it while in use
+    PyObject *buf = PyObject_GetAttrString(shm, "buf");
+    PyObject *view = buf ? PyMemoryView_FromObject(buf) : NULL;
+    Py_XDECREF(buf);
+    PyObject *base = view ? PyTuple_Pack(2, shm, view) : NULL;
+    Py_XDECREF(view);
+    Py_DECREF(shm);
+    if (!base) {
         return NULL;
     }
-    PyObject *keys = PyTuple_GetItem(state, 0);
-    if (PyArray_Check(keys)) {
-        // if we an array, make it immutable
-        PyArray_CLEARFLAGS((PyArrayObject*)keys, NPY_ARRAY_WRITEABLE);
+    Py_buffer data;
+    if (PyObject_GetBuffer(PyTuple_GET_ITEM(base, 1), &data, PyBUF_SIMPLE)) {
+        Py_DECREF(base);
+        return NULL;
     }
-    fam_init((PyObject*)self, state, NULL);
-    Py_RETURN_NONE;
+    PyObject *fam = fam_from_buffer(cls, base, (const char *)data.buf, data.len, true, false);
+    PyBuffer_Release(&data);
+    Py_DECREF(base);
+    return fam;
 }
 
 
@@ -2618,14 +7672,21 @@ static PyMethodDef fam_methods[] = {
     {"__getnewargs__", (PyCFunction) fam_getnewargs, METH_NOARGS, NULL},
     {"__reversed__", (PyCFunction) fam_reversed, METH_NOARGS, NULL},
     {"__sizeof__", (PyCFunction) fam_sizeof, METH_NOARGS, NULL},
+    {"__reduce_ex__", (PyCFunction) fam_reduce_ex, METH_O, NULL},
     {"__getstate__", (PyCFunction) fam_getstate, METH_NOARGS, NULL},
     {"__setstate__", (PyCFunction) fam_setstate, METH_O, NULL},
     {"get", (PyCFunction) fam_get, METH_VARARGS, NULL},
     {"items", (PyCFunction) fam_items, METH_NOARGS, NULL},
     {"keys", (PyCFunction) fam_keys, METH_NOARGS, NULL},
     {"values", (PyCFunction) fam_values, METH_NOARGS, NULL},
-    {"get_all", (PyCFunction) fam_get_all, METH_O, NULL},
-    {"get_any", (PyCFunction) fam_get_any, METH_O, NULL},
+    {"get_all", (PyCFunction) fam_get_all, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"get_any", (PyCFunction) fam_get_any, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"isin", (PyCFunction) fam_isin, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"get_slice", (PyCFunction) fam_get_slice, METH_VARARGS, NULL},
+    {"save", (PyCFunction) fam_save, METH_O, NULL},
+    {"load", (PyCFunction) fam_load, METH_VARARGS | METH_KEYWORDS | METH_CLASS, NULL},
+    {"share", (PyCFunction) fam_share, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"attach", (PyCFunction) fam_attach, METH_O | METH_CLASS, NULL},
     {NULL},
 };
 
@@ -2655,9 +7716,6 @@ static PyTypeObject FAMType = {
 static PyObject *
 am_inplace_or(FAMObject *self, PyObject *other)
 {
-    if (PyObject_TypeCheck(other, &FAMType)) {
-        other = ((FAMObject *)other)->keys;
-    }
     if (extend(self, other)) {
         return NULL;
     }
@@ -2684,9 +7742,6 @@ am_add(FAMObject *self, PyObject *other)
 static PyObject *
 am_update(FAMObject *self, PyObject *other)
 {
-    if (PyObject_TypeCheck(other, &FAMType)) {
-        other = ((FAMObject *)other)->keys;
-    }
     if (extend(self, other)) {
         return NULL;
     }
@@ -2694,8 +7749,81 @@ am_update(FAMObject *self, PyObject *other)
 }
 
 
+static PyObject *
+am_reserve(FAMObject *self, PyObject *arg)
+{
+    Py_ssize_t capacity = PyNumber_AsSsize_t(arg, PyExc_OverflowError);
+    if (capacity == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    if (capacity < 0) {
+        PyErr_Format(PyExc_ValueError, "%s capacity must not be negative", Py_TYPE(self)->tp_name);
+        return NULL;
+    }
+    if (reserve(self, capacity)) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *
+am_discard(FAMObject *self, PyObject *key)
+{
+    Py_ssize_t keys_pos = lookup(self, key);
+    if (keys_pos < 0) {
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
+        Py_RETURN_NONE;
+    }
+    if (discard_at(self, keys_pos)) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *
+am_pop(FAMObject *self, PyObject *args)
+{
+    PyObject *key;
+    PyObject *missing = NULL;
+    if (!PyArg_UnpackTuple(args, "pop", 1, 2, &key, &missing)) {
+        return NULL;
+    }
+    Py_ssize_t keys_pos = lookup(self, key);
+    if (keys_pos < 0) {
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
+        if (missing) {
+            Py_INCREF(missing);
+            return missing;
+        }
+        PyErr_SetObject(PyExc_KeyError, key);
+        return NULL;
+    }
+    if (discard_at(self, keys_pos)) {
+        return NULL;
+    }
+    return int_cache_get(keys_pos);
+}
+
+
+static PyObject *
+am_compact(FAMObject *self)
+{
+    return compact(self);
+}
+
+
 static PyMethodDef am_methods[] = {
     {"add", (PyCFunction) am_add, METH_O, NULL},
+    {"compact", (PyCFunction) am_compact, METH_NOARGS, NULL},
+    {"discard", (PyCFunction) am_discard, METH_O, NULL},
+    {"pop", (PyCFunction) am_pop, METH_VARARGS, NULL},
+    {"reserve", (PyCFunction) am_reserve, METH_O, NULL},
     {"update", (PyCFunction) am_update, METH_O, NULL},
     {NULL},
 };
@@ -0,0 +1,130 @@
+"""
+Compare the previous byte-at-a-time djb2 hash of unicode and byte-string keys with the current word-at-a-time hash. Probe lengths are simulated in Python using the same table size and probe sequence as `arraymap.c`; throughput is measured with the installed `arraymap`.
+"""
+
+import timeit
+
+import numpy as np
+
+import arraymap
+
+
+MASK64 = (1 << 64) - 1
+LOAD = 0.9
+SCAN = 16
+NUMBER = 10
+
+PRIME_1 = 0x9E3779B185EBCA87
+PRIME_2 = 0xC2B2AE3D27D4EB4F
+PRIME_3 = 0x165667B19E3779F9
+PRIME_4 = 0x85EBCA77C2B2AE63
+PRIME_5 = 0x27D4EB2F165667C5
+
+
+def to_signed(v: int) -> int:
+    return v - (1 << 64) if v >> 63 else v
+
+
+def hash_djb2(data: bytes, width: int) -> int:
+    h = 5381
+    for i in range(0, len(data), width):
+        h = (h * 33 + int.from_bytes(data[i : i + width], "little")) & MASK64
+    h = to_signed(h)
+    return -2 if h == -1 else h
+
+
+def rotl(v: int, r: int) -> int:
+    return ((v << r) | (v >> (64 - r))) & MASK64
+
+
+def hash_word(data: bytes, width: int) -> int:
+    h = (PRIME_5 + len(data)) & MASK64
+    for i in range(0, len(data), 8):
+        w = int.from_bytes(data[i : i + 8], "little")
+        w = (rotl((w * PRIME_2) & MASK64, 31) * PRIME_1) & MASK64
+        h = (rotl(h ^ w, 27) * PRIME_1 + PRIME_4) & MASK64
+    h ^= h >> 33
+    h = (h * PRIME_2) & MASK64
+    h ^= h >> 29
+    h = (h * PRIME_3) & MASK64
+    h ^= h >> 32
+    h = to_signed(h)
+    return -2 if h == -1 else h
+
+
+def table_size(keys_size: int) -> int:
+    keys_load = int(keys_size / LOAD)
+    size = 1
+    while size <= keys_load:
+        size <<= 1
+    return size
+
+
+def probe_lengths(hashes: list) -> np.ndarray:
+    """Insert each hash into a simulated table, returning the count of slots visited per insertion."""
+    size = table_size(len(hashes))
+    mask = size - 1
+    table = bytearray(size + SCAN - 1)
+    post = np.empty(len(hashes), dtype=np.int64)
+    for i, h in enumerate(hashes):
+        mixin = abs(h)
+        pos = h & mask
+        count = 0
+        while True:
+            for _ in range(SCAN):
+                count += 1
+                if not table[pos]:
+                    break
+                pos += 1
+            else:
+                mixin >>= 1
+                pos = (5 * (pos - SCAN) + mixin + 1) & mask
+                continue
+            break
+        table[pos] = 1
+        post[i] = count
+    return post
+
+
+# -------------------------------------------------------------------------------
+def fixtures(size: int):
+    """Prefix-heavy keys: tickers and ISIN-like codes that differ only in their trailing characters."""
+    yield "ticker", np.array([f"TICKER{i:06d}" for i in range(size)])
+    yield "isin", np.array([f"US{i:09d}{i % 10}" for i in range(size)])
+    yield "path", np.array([f"/data/archive/2024/{i:08d}.csv" for i in range(size)])
+
+
+def run_probes(size: int):
+    print(f"probe length, {size:,} keys: mean / max (djb2 -> word)")
+    for label, array in fixtures(size):
+        for dtype, width in (("U", 4), ("S", 1)):
+            keys = array.astype(dtype)
+            data = [k.tobytes() if dtype == "U" else bytes(k) for k in keys]
+            old = probe_lengths([hash_djb2(d, width) for d in data])
+            new = probe_lengths([hash_word(d, width) for d in data])
+            print(
+                f"  {label:8}{keys.dtype.str:6}"
+                f"{old.mean():8.2f} / {old.max():<8}-> {new.mean():.2f} / {new.max()}"
+            )
+
+
+def run_throughput(size: int):
+    print(f"throughput, {size:,} shuffled keys: construct / get_all (ns per key)")
+    rng = np.random.default_rng(0)
+    for label, array in fixtures(size):
+        array = array[rng.permutation(size)]
+        for dtype in ("U", "S"):
+            keys = array.astype(dtype)
+            keys.flags.writeable = False
+            fam = arraymap.FrozenAutoMap(keys)
+            t_init = timeit.timeit(lambda: arraymap.FrozenAutoMap(keys), number=NUMBER)
+            t_get = timeit.timeit(lambda: fam.get_all(keys), number=NUMBER)
+            print(
+                f"  {label:8}{keys.dtype.str:6}"
+                f"{t_init / NUMBER / size * 1e9:8.1f} / {t_get / NUMBER / size * 1e9:.1f}"
+            )
+
+
+if __name__ == "__main__":
+    run_probes(100_000)
+    run_throughput(1_000_000)
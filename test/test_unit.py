@@ -1,4 +1,7 @@
+import copy
 import pickle
+import subprocess
+import sys
 import pytest
 import numpy as np
 
@@ -22,12 +25,24 @@ def test_am_extend():
     assert list(am2.keys()) == ["a", "b", "c", "d"]
 
 
+def test_fam_or_a():
+    fam1 = FrozenAutoMap(("a", "b"))
+    fam2 = fam1 | FrozenAutoMap(("c",))
+    assert fam2 is not fam1
+    assert list(fam1) == ["a", "b"]
+    assert list(fam2) == ["a", "b", "c"]
+
+
 def test_am_add():
     a = AutoMap()
     for l, key in enumerate(["a", "b", "c", "d"]):
         assert a.add(key) is None
         assert len(a) == l + 1
         assert a[key] == l
+    with pytest.raises(NonUniqueError):
+        a.add("a")
+    assert len(a) == 4
+    assert list(a) == ["a", "b", "c", "d"]
 
 
 def test_fam_contains():
@@ -55,6 +70,59 @@ def test_fam_constructor_b():
 # ------------------------------------------------------------------------------
 
 
+def test_fam_constructor_threads_a():
+    a1 = np.arange(50_000, dtype=np.int64)[::-1]
+    a1.flags.writeable = False
+    fam1 = FrozenAutoMap(a1)
+    fam2 = FrozenAutoMap(a1, threads=4)
+    assert len(fam2) == len(a1)
+    assert fam2.get_all(a1).tolist() == fam1.get_all(a1).tolist()
+    assert hash(fam1) == hash(fam2)
+
+
+def test_fam_constructor_threads_b():
+    a1 = np.arange(50_000).astype(str)
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1, threads=3)
+    assert fam["0"] == 0
+    assert fam["49999"] == 49999
+    assert "50000" not in fam
+
+
+def test_fam_constructor_threads_c():
+    a1 = np.concatenate((np.arange(50_000), [20_000])).astype(np.float64)
+    a1.flags.writeable = False
+    with pytest.raises(NonUniqueError):
+        FrozenAutoMap(a1, threads=4)
+
+
+def test_fam_constructor_threads_d():
+    with pytest.raises(ValueError):
+        FrozenAutoMap(("a", "b"), threads=0)
+    with pytest.raises(TypeError):
+        FrozenAutoMap(("a", "b"), foo=2)
+    # threads are ignored for non-array keys
+    assert list(FrozenAutoMap(("a", "b"), threads=4)) == ["a", "b"]
+
+
+def test_fam_hash_a():
+    class Key:
+        count = 0
+
+        def __hash__(self):
+            Key.count += 1
+            return 1
+
+    fam = FrozenAutoMap((Key(), Key()))
+    assert Key.count == 2
+    assert hash(fam) == hash(fam)
+    # keys are hashed once more, and the result is cached
+    assert Key.count == 4
+
+
+# ------------------------------------------------------------------------------
+
+
 def test_fam_constructor_array_int_a1():
     a1 = np.array((10, 20, 30), dtype=np.int64)
     with pytest.raises(TypeError):
@@ -720,6 +788,377 @@ def test_am_array_constructor_c():
     assert list(am.keys()) == [10, 20, 30, 40, 60, 80, 90]
 
 
+def test_am_array_constructor_d():
+    a1 = np.array((10, 20, 30))
+    am = AutoMap(a1)
+    a1[0] = 99
+    assert am[10] == 0
+    assert 99 not in am
+    assert isinstance(am.__getstate__()[0], np.ndarray)
+
+
+def test_am_array_get_a():
+    # keys of other types are found only if equal, as with list keys
+    for dtype in (np.int64, np.uint8, np.float64):
+        am = AutoMap(np.array([1, 2, 3], dtype=dtype))
+        al = AutoMap([dtype(1), dtype(2), dtype(3)])
+        for key in (
+            np.datetime64("2020-01-01"),
+            np.timedelta64(1),
+            np.timedelta64("NaT"),
+            1 + 0j,
+            1 + 1j,
+            np.complex64(2),
+        ):
+            assert (key in am) == (key in al)
+            assert am.get(key) == al.get(key)
+    am = AutoMap(np.array([1, 2, 3]))
+    assert np.datetime64("2020-01-01") not in am
+    assert am.get(np.datetime64("2020-01-01")) is None
+    assert np.timedelta64(1) in am
+    assert am.get(1 + 0j) == 0
+
+
+def test_am_array_add_a():
+    for dtype in (np.int64, np.int8, np.uint32, np.float32, "datetime64[D]"):
+        a1 = np.array((3, 1, 2)).astype(dtype)
+        am = AutoMap(a1)
+        a2 = np.arange(4, 100).astype(dtype)
+        am.update(a2[:-1])
+        am.add(a2[-1])
+        keys = am.__getstate__()[0]
+        assert keys.dtype == a1.dtype
+        assert keys.tolist() == np.concatenate((a1, a2)).tolist()
+        assert am.get_all(a2).tolist() == list(range(3, 99))
+        with pytest.raises(NonUniqueError):
+            am.add(a2[0])
+        assert len(am) == 99
+        assert len(list(am)) == 99
+
+
+def test_am_array_add_b():
+    a1 = np.arange(0, 10, 2)
+    a1.flags.writeable = False
+    am = AutoMap(a1)
+    am.update((10, 12))
+    assert am[12] == 6
+    am.add(3)
+    assert am[3] == 7
+    assert am.get_all(np.array([0, 12, 3])).tolist() == [0, 6, 7]
+    with pytest.raises(NonUniqueError):
+        am.add(4)
+    assert len(am) == 8
+
+
+def test_am_array_add_c():
+    for packed in (False, True):
+        am = AutoMap(np.array(("a", "bb")), packed=packed)
+        am.add("cccc")
+        am.add("dé")
+        assert am.__getstate__()[0].dtype == np.dtype("<U4")
+        # a key that is not latin-1 unpacks packed keys
+        am.add("日本語の")
+        assert am.get_all(np.array(("a", "dé", "日本語の"))).tolist() == [0, 3, 4]
+        assert am.__getstate__()[0].tolist() == ["a", "bb", "cccc", "dé", "日本語の"]
+
+    am = AutoMap(np.array((b"a", b"b")))
+    am.update((b"ccc", b""))
+    assert am.__getstate__()[0].dtype == np.dtype("S3")
+    assert am[b""] == 3
+
+
+def test_am_array_add_d():
+    for a1, key in (
+        (np.array((1, 2)), "a"),
+        (np.array((1, 2), dtype=np.uint8), 256),
+        (np.array((1.5, 2.5), dtype=np.float32), 0.1),
+        (np.array(("a", "b")), "c\x00"),
+        (np.array(("2022-01", "2023-05"), dtype=np.datetime64), np.datetime64("2022")),
+    ):
+        am = AutoMap(a1)
+        am.add(key)
+        assert isinstance(am.__getstate__()[0], list)
+        assert list(am) == a1.tolist() + [key]
+        assert am[key] == 2
+        assert am[a1[1]] == 1
+
+
+def test_am_array_byteorder_a():
+    am = AutoMap(np.array([3, 1, 2], ">i8"))
+    am.add(4)
+    assert am.get(3) == 0
+    assert am[4] == 3
+    assert list(am) == [3, 1, 2, 4]
+
+    am = AutoMap(np.array(["ab", "c"], ">U2"))
+    am.add("z")
+    assert list(am) == ["ab", "c", "z"]
+    assert am["z"] == 2
+    assert list(copy.deepcopy(am).items()) == [("ab", 0), ("c", 1), ("z", 2)]
+    assert list(pickle.loads(pickle.dumps(am, protocol=5))) == ["ab", "c", "z"]
+
+    a1 = np.array([3, 1, 2], ">i8")
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    assert fam.get(3) == 0
+    assert fam.get_all(np.array([2, 3])).tolist() == [2, 0]
+
+
+def test_am_array_add_e():
+    a1 = np.array((1, 5, 7))
+    a1.flags.writeable = False
+    am = AutoMap(a1, sorted=True)
+    am.add(10)
+    assert am.get_slice(5, 11) == slice(1, 4)
+    with pytest.raises(NonUniqueError):
+        am.add(10)
+    with pytest.raises(ValueError):
+        am.add(8)
+    with pytest.raises(ValueError):
+        am.add("a")
+    assert len(am) == 4
+
+
+def test_am_array_add_f():
+    am = AutoMap(np.array([1, 5, 9]), sorted=True)
+    with pytest.raises(ValueError):
+        am.add(2)
+    am.add(13)
+    assert am.get_slice(5, 13) == slice(1, 3)
+    am2 = pickle.loads(pickle.dumps(am))
+    assert am2.get_slice(None, None) == slice(0, 4)
+    with pytest.raises(ValueError):
+        am2.add(0)
+    with pytest.raises(ValueError):
+        AutoMap(np.array([9, 5, 1]), sorted=True)
+
+
+def test_am_update_array_a():
+    am = AutoMap()
+    am.update(np.arange(10))
+    am.update(np.array([20, 10], dtype=np.int32))
+    assert am.__getstate__()[0].tolist() == list(range(10)) + [20, 10]
+    assert am.get_all(np.array([10, 20, 0])).tolist() == [11, 10, 0]
+    with pytest.raises(NonUniqueError):
+        am.update(np.array([30, 5]))
+    assert len(am) == 13
+    assert am[30] == 12
+
+    am.update(np.array([1.5]))
+    assert isinstance(am.__getstate__()[0], list)
+    assert am[1.5] == 13
+
+
+def test_am_update_array_b():
+    am = AutoMap(np.array(("a", "bb")))
+    am.update(np.array(("ccc", "dé")))
+    am |= np.array(("日",))
+    assert am.__getstate__()[0].dtype == np.dtype("<U3")
+    assert am.get_all(np.array(("a", "dé", "日"))).tolist() == [0, 3, 4]
+
+    a1 = np.array(("2020-01-01", "2020-01-03"), dtype="datetime64[D]")
+    am = AutoMap(a1[:1])
+    am.update(a1[1:])
+    assert am.__getstate__()[0].dtype == a1.dtype
+    am.update(np.array(("2020-02",), dtype="datetime64[M]"))
+    assert am[np.datetime64("2020-02")] == 2
+    assert am[a1[1]] == 1
+
+
+def test_am_update_map_a():
+    fam1 = FrozenAutoMap(("a", (1, 2)))
+    fam2 = FrozenAutoMap(("b", (3, 4)))
+    am = AutoMap(fam1)
+    am.update(fam2)
+    a1 = np.arange(3)
+    a1.flags.writeable = False
+    am |= FrozenAutoMap(a1)
+    assert list(am) == ["a", (1, 2), "b", (3, 4), 0, 1, 2]
+    assert am[(3, 4)] == 3
+    with pytest.raises(NonUniqueError):
+        am.update(fam1)
+    assert len(am) == 7
+    assert list(fam1 | fam2) == ["a", (1, 2), "b", (3, 4)]
+
+
+def test_am_capacity_a():
+    am = AutoMap(capacity=1_000)
+    assert am.__sizeof__() > AutoMap().__sizeof__()
+    for i in range(900):
+        am.add(str(i))
+    assert am["899"] == 899
+
+    a1 = np.array((), dtype=np.int64)
+    am = AutoMap(a1, capacity=1_000)
+    size = am.__sizeof__()
+    am.update(range(900))
+    assert am.__sizeof__() == size
+
+    with pytest.raises(ValueError):
+        AutoMap(capacity=-1)
+    with pytest.raises(TypeError):
+        FrozenAutoMap(("a",), capacity=10)
+
+
+def test_am_reserve_a():
+    for a1 in (
+        np.array((3, 1, 2)),
+        np.array((3.0, 1.0, 2.0)),
+        np.array(("a", "b", "c"), dtype="U4"),
+    ):
+        am = AutoMap(a1)
+        assert am.reserve(1_000) is None
+        size = am.__sizeof__()
+        am.update(a1.dtype.type(v) for v in range(10, 910))
+        assert am.__sizeof__() == size
+        assert len(am) == 903
+        assert am[a1.dtype.type(909)] == 902
+        assert am[a1[1]] == 1
+    with pytest.raises(ValueError):
+        am.reserve(-1)
+
+
+def test_am_array_copy_a():
+    am1 = AutoMap(np.arange(5))
+    am1.add(5)
+    am2 = AutoMap(am1)
+    fam = FrozenAutoMap(am1)
+    am1.add(6)
+    am2.add(7)
+    assert list(am1) == [0, 1, 2, 3, 4, 5, 6]
+    assert list(am2) == [0, 1, 2, 3, 4, 5, 7]
+    assert list(fam) == [0, 1, 2, 3, 4, 5]
+    assert pickle.loads(pickle.dumps(am1)).__getstate__()[0].tolist() == list(am1)
+
+
+def test_am_incremental_a():
+    for keys in (
+        [str(i) for i in range(3)],
+        np.array((0, 1, 2)),
+        np.array(("0", "1", "2")),
+    ):
+        am = AutoMap(keys, incremental=True)
+        for i in range(3, 2_000):
+            key = keys[0].__class__(i)
+            am.add(key)
+            with pytest.raises(NonUniqueError):
+                am.add(keys[i % 3])
+            assert am[key] == i
+            assert am.get(keys[0].__class__(i - 50)) == (i - 50 if i >= 50 else None)
+        assert len(am) == 2_000
+        assert am.get_all(keys[:3]).tolist() == [0, 1, 2]
+        assert list(am.values()) == list(range(2_000))
+
+
+def test_am_incremental_b():
+    am1 = AutoMap(range(14), incremental=True)
+    size = am1.__sizeof__()
+    am1.add(14)
+    # the old table is retained until all keys are migrated
+    assert am1.__sizeof__() > size
+    am2 = AutoMap(am1)
+    am1.update(range(15, 100))
+    assert list(am2) == list(range(15))
+    am2 = AutoMap((None,), incremental=True)
+    am2.update(am1)
+    assert am2[99] == 100
+    am3 = pickle.loads(pickle.dumps(am2))
+    assert am3.__getstate__()[1]["incremental"]
+    with pytest.raises(NonUniqueError):
+        am3.add(50)
+    with pytest.raises(TypeError):
+        FrozenAutoMap(range(3), incremental=True)
+
+
+def test_am_discard_a():
+    for keys in (["a", "b", "c", "d"], np.array(["a", "b", "c", "d"])):
+        am = AutoMap(keys)
+        assert am.discard("b") is None
+        assert am.discard("b") is None
+        assert len(am) == 3
+        assert "b" not in am
+        assert am.get("b") is None
+        assert am["c"] == 2
+        assert list(am.items()) == [("a", 0), ("c", 2), ("d", 3)]
+        assert list(reversed(am.values())) == [3, 2, 0]
+        assert am.get_all(np.array(["d", "a"])).tolist() == [3, 0]
+        assert am.get_any(np.array(["a", "b", "d"])) == [0, 3]
+        assert am.isin(np.array(["b", "c"])).tolist() == [False, True]
+        with pytest.raises(KeyError):
+            am.get_all(np.array(["a", "b"]))
+        am.add("b")
+        assert am["b"] == 4
+        with pytest.raises(NonUniqueError):
+            am.add("a")
+
+
+def test_am_pop_a():
+    am = AutoMap(np.arange(10, 15))
+    assert am.pop(12) == 2
+    assert am.pop(12, None) is None
+    with pytest.raises(KeyError):
+        am.pop(12)
+    assert am.pop(14) == 4
+    assert len(am) == 3
+    assert list(am) == [10, 11, 13]
+    assert am.get_slice(10, 14) == slice(0, 4)
+
+
+def test_am_compact_a():
+    am = AutoMap(np.arange(10, 20))
+    assert am.compact().tolist() == list(range(10))
+    am.discard(10)
+    am.discard(19)
+    assert am.compact().tolist() == [-1, 0, 1, 2, 3, 4, 5, 6, 7, -1]
+    assert am[11] == 0
+    am.discard(15)
+    am.add(15)
+    assert am.compact().tolist() == [0, 1, 2, 3, -1, 4, 5, 6, 7]
+    assert list(am.items())[3:] == [(14, 3), (16, 4), (17, 5), (18, 6), (15, 7)]
+    assert am.get(10) is None
+
+    am = AutoMap([str(i) for i in range(100)])
+    for i in range(0, 100, 2):
+        am.discard(str(i))
+    size = am.__sizeof__()
+    remap = am.compact()
+    assert am.__sizeof__() < size
+    assert remap[:4].tolist() == [-1, 0, -1, 1]
+    assert list(am.values()) == list(range(50))
+    assert am["99"] == 49
+
+
+def test_am_discard_pickle_a():
+    am1 = AutoMap(["a", "b", "c"])
+    am1.discard("a")
+    am1.add("a")
+    am2 = pickle.loads(pickle.dumps(am1))
+    assert list(am2.items()) == [("b", 1), ("c", 2), ("a", 3)]
+    assert am2 == am1
+    assert am2 != AutoMap(["b", "c", "a"])
+    assert repr(am2) == "arraymap.AutoMap(['b', 'c', 'a'])"
+
+    am3 = AutoMap(np.array([1.0, 2.0, 3.0]), sorted=True)
+    am3.discard(2.0)
+    fam = FrozenAutoMap(am3)
+    assert dict(pickle.loads(pickle.dumps(fam)).items()) == {1.0: 0, 3.0: 2}
+
+
+def test_am_discard_pickle_b():
+    am1 = AutoMap(np.array([1.5, 2.5, 3.5]))
+    am1.discard(2.5)
+    am1.add(2.5)
+    am2 = pickle.loads(pickle.dumps(am1, protocol=5))
+    assert list(am2.items()) == [(1.5, 0), (3.5, 2), (2.5, 3)]
+    assert am2 == am1
+
+    buffers = []
+    data = pickle.dumps(am1, protocol=5, buffer_callback=buffers.append)
+    am3 = pickle.loads(data, buffers=buffers)
+    assert list(am3.items()) == [(1.5, 0), (3.5, 2), (2.5, 3)]
+    assert am3.get(2.5) == 3
+
+
 # ------------------------------------------------------------------------------
 
 
@@ -731,6 +1170,191 @@ def test_fam_array_pickle_a():
     assert list(fam1.values()) == list(fam2.values())
 
 
+def test_fam_pickle_table_a():
+    for a1 in (
+        np.array((3, 100, 7, 4000)),
+        np.array((3.5, 100.0, -7.0, 4000.0)),
+        np.array(("a", "bb", "", "cccc")),
+        np.array(("a", "\u1234", "", "cccc")),
+        np.array((b"a", b"bb", b"", b"cccc")),
+        np.array((3, 100, 7, 4000), dtype="datetime64[D]"),
+    ):
+        a1.flags.writeable = False
+        inline = a1.dtype.kind in "fM"
+        for fam1 in (FrozenAutoMap(a1), FrozenAutoMap(a1, inline=inline)):
+            # the table is pickled with protocol 5, and not rebuilt
+            assert len(fam1.__reduce_ex__(5)[2]) == 4
+            fam2 = pickle.loads(pickle.dumps(fam1, protocol=5))
+            assert fam2.get_all(a1).tolist() == [0, 1, 2, 3]
+            assert fam2.get(a1[0]) == 0
+            buffers = []
+            data = pickle.dumps(fam1, protocol=5, buffer_callback=buffers.append)
+            fam3 = pickle.loads(data, buffers=buffers)
+            assert buffers
+            assert fam3.get_all(a1).tolist() == [0, 1, 2, 3]
+            assert hash(fam3) == hash(fam1)
+    # list keys and keys not in a table pickle as with other protocols
+    assert len(FrozenAutoMap(["a", "b"]).__reduce_ex__(5)[2]) == 1
+    assert len(AutoMap(np.arange(4)).__reduce_ex__(5)[2]) == 1
+
+
+def test_fam_pickle_table_b():
+    a1 = np.array(("a", "bb", "c"))
+    a1.flags.writeable = False
+    func, args, state = FrozenAutoMap(a1).__reduce_ex__(5)
+    # a table of another format is rebuilt from the keys
+    fam = func(*args)
+    fam.__setstate__(state[:3] + ((-1,) + state[3][1:],))
+    assert fam.get_all(a1).tolist() == [0, 1, 2]
+    table = state[3]
+    for table_state in (
+        table[:5] + (bytes(len(table[5].raw())),) + table[6:],
+        table[:5] + (b"",) + table[6:],
+        table[:7] + (b"\xff\xff\xff",),
+        table[:4] + (3,) + table[5:],
+        table[:7] + (b"\x09\x01\x01",),
+    ):
+        with pytest.raises(ValueError):
+            func(*args).__setstate__(state[:3] + (table_state,))
+
+
+def test_fam_save_a(tmp_path):
+    path = tmp_path / "keys.am"
+    for a1, sorted in (
+        (np.array((3, 100, 7, 4000)), False),
+        (np.array((3.5, 100.0, -7.0, 4000.0)), False),
+        (np.array(("a", "bb", "", "cccc")), False),
+        (np.array(("a", "\u1234", "", "cccc")), False),
+        (np.array((b"a", b"bb", b"", b"cccc")), False),
+        (np.array((3, 100, 7, 4000), dtype="datetime64[D]"), False),
+        (np.arange(4), False),
+        (np.array((3, 7, 100, 4000)), True),
+    ):
+        a1.flags.writeable = False
+        FrozenAutoMap(a1, sorted=sorted).save(str(path))
+        for mmap in (True, False):
+            fam = FrozenAutoMap.load(path, mmap=mmap)
+            assert type(fam) is FrozenAutoMap
+            assert fam.get_all(a1).tolist() == [0, 1, 2, 3]
+            assert fam.get(a1[0]) == 0
+            assert hash(fam) == hash(FrozenAutoMap(a1))
+            fam2 = pickle.loads(pickle.dumps(fam, protocol=5))
+            assert fam2.get_all(a1).tolist() == [0, 1, 2, 3]
+        del fam, fam2
+    with pytest.raises(TypeError):
+        FrozenAutoMap(["a", "b"]).save(str(path))
+
+
+def test_fam_save_b(tmp_path):
+    path = tmp_path / "keys.am"
+    a1 = np.array(("a", "bb", "c"))
+    a1.flags.writeable = False
+    FrozenAutoMap(a1).save(path)
+    data = path.read_bytes()
+    # a table of another format is built from the keys
+    path.write_bytes(data[:16] + (-1).to_bytes(8, "little", signed=True) + data[24:])
+    assert FrozenAutoMap.load(path).get_all(a1).tolist() == [0, 1, 2]
+    for invalid in (b"", data[:40], b"ARRAYMAQ" + data[8:], data[:-1]):
+        path.write_bytes(invalid)
+        with pytest.raises(ValueError):
+            FrozenAutoMap.load(path)
+
+
+def test_am_save_a(tmp_path):
+    path = tmp_path / "keys.am"
+    am1 = AutoMap(np.array(("a", "b", "c")))
+    am1.discard("b")
+    am1.save(path)
+    am2 = AutoMap.load(path)
+    am2.add("b")
+    assert list(am2.items()) == [("a", 0), ("c", 2), ("b", 3)]
+    fam = FrozenAutoMap.load(path)
+    assert list(fam.items()) == [("a", 0), ("c", 2)]
+
+
+def test_fam_share_a():
+    pytest.importorskip("multiprocessing.shared_memory")
+    for a1, sorted in (
+        (np.array((3, 100, 7, 4000)), False),
+        (np.array(("a", "\u1234", "", "cccc")), False),
+        (np.array((b"a", b"bb", b"", b"cccc")), False),
+        (np.array((3, 100, 7, 4000), dtype="datetime64[D]"), False),
+        (np.arange(4), False),
+        (np.array((3, 7, 100, 4000)), True),
+    ):
+        a1.flags.writeable = False
+        shm = FrozenAutoMap(a1, sorted=sorted).share()
+        for fam in (FrozenAutoMap.attach(shm), FrozenAutoMap.attach(shm.name)):
+            assert fam.get_all(a1).tolist() == [0, 1, 2, 3]
+            assert list(fam.values()) == [0, 1, 2, 3]
+            assert hash(fam) == hash(FrozenAutoMap(a1))
+            # the segment cannot be closed while attached
+            with pytest.raises(BufferError):
+                shm.close()
+        del fam
+        shm.close()
+        shm.unlink()
+    with pytest.raises(TypeError):
+        FrozenAutoMap(["a", "b"]).share()
+
+
+def test_am_share_a():
+    pytest.importorskip("multiprocessing.shared_memory")
+    am1 = AutoMap(np.array(("a", "b", "c")))
+    am1.discard("b")
+    shm = am1.share()
+    am2 = AutoMap.attach(shm)
+    am2.add("b")
+    assert list(am2.items()) == [("a", 0), ("c", 2), ("b", 3)]
+    assert list(FrozenAutoMap.attach(shm).items()) == [("a", 0), ("c", 2)]
+    del am2
+    shm.close()
+    shm.unlink()
+
+
+def test_fam_share_b():
+    pytest.importorskip("multiprocessing.shared_memory")
+    a1 = np.arange(100)
+    a1.flags.writeable = False
+    shm = FrozenAutoMap(a1).share()
+    # attach more than once in another process, deleting each map before exit
+    code = "\n".join(
+        (
+            "import numpy as np",
+            "from arraymap import FrozenAutoMap",
+            f"fam1 = FrozenAutoMap.attach({shm.name!r})",
+            f"fam2 = FrozenAutoMap.attach({shm.name!r})",
+            "assert fam1[50] == 50",
+            "assert fam2.get_all(np.array([3, 99])).tolist() == [3, 99]",
+            "del fam1",
+            "del fam2",
+        )
+    )
+    post = subprocess.run([sys.executable, "-c", code], capture_output=True)
+    assert post.returncode == 0, post.stderr
+    # the exit of that process does not unlink the segment
+    fam = FrozenAutoMap.attach(shm.name)
+    assert fam[7] == 7
+    del fam
+    shm.close()
+    shm.unlink()
+
+
+def test_am_pickle_table_a():
+    am1 = AutoMap(np.array((5, 1, 9, 3)), incremental=True)
+    am1.update(np.arange(10, 40))
+    am1.discard(9)
+    am2 = pickle.loads(pickle.dumps(am1, protocol=5))
+    assert len(am2) == 33
+    assert 9 not in am2
+    assert am2.__getstate__()[1]["incremental"]
+    am2.add(9)
+    assert am2[9] == 34
+    with pytest.raises(NonUniqueError):
+        am2.add(30)
+    assert list(am1) == [5, 1, 3] + list(range(10, 40))
+
+
 # ------------------------------------------------------------------------------
 
 
@@ -998,3 +1622,681 @@ def test_fam_array_get_any_d():
 
     post = fam.get_any(np.array(["2022-01", "2023-01", "1988-01"], np.datetime64))
     assert post == []
+
+
+# -------------------------------------------------------------------------------
+
+
+def test_fam_array_get_all_threads_a():
+    a1 = np.arange(20_000, dtype=np.int64)
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = a1[::-1]
+    post = fam.get_all(a2, threads=4)
+    assert post.tolist() == fam.get_all(a2).tolist()
+    assert post.flags.writeable == False
+
+
+def test_fam_array_get_all_threads_b():
+    a1 = np.arange(20_000).astype(str)
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.concatenate((a1[:15_000], ["x"], a1[:5_000], ["y"]))
+    with pytest.raises(KeyError, match="x"):
+        fam.get_all(a2, threads=4)
+
+
+def test_fam_array_get_all_threads_c():
+    a1 = np.array((1, 100, 300, 4000))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    with pytest.raises(ValueError):
+        fam.get_all(a1, threads=0)
+    with pytest.raises(TypeError):
+        fam.get_all(a1, 2)
+
+
+def test_fam_array_get_any_threads_a():
+    a1 = np.arange(20_000, dtype=np.float64)
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.arange(-5_000, 15_000, dtype=np.float64)
+    post = fam.get_any(a2, threads=4)
+    assert post == list(range(15_000))
+
+
+def test_fam_array_get_all_blocks_a():
+    a1 = np.arange(1_000, dtype=np.int64) * 7
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    for size in (1, 15, 16, 17, 33, 1_000):
+        assert fam.get_all(a1[:size]).tolist() == list(range(size))
+    a2 = np.concatenate((a1[:17], [1], a1[17:40]))
+    with pytest.raises(KeyError):
+        fam.get_all(a2)
+    assert fam.get_any(a2) == list(range(40))
+
+
+# ------------------------------------------------------------------------------
+
+
+def test_fam_sizeof_a():
+    a1 = np.arange(10_000, dtype=np.int64) * 7 % 10_007
+    a1.flags.writeable = False
+    fam1 = FrozenAutoMap(a1)
+    fam2 = FrozenAutoMap(a1.tolist())
+    # integer tables store only 32-bit positions
+    table1 = fam1.__sizeof__() - a1.__sizeof__()
+    table2 = fam2.__sizeof__() - a1.tolist().__sizeof__()
+    assert table1 * 3 < table2
+    assert fam1.get_all(a1).tolist() == list(range(10_000))
+
+
+def test_fam_sizeof_b():
+    for dtype in (np.float64, np.uint32, "U4", "S4", "datetime64[D]"):
+        a1 = (np.arange(5_000) * 7 % 5_003).astype(dtype)
+        a1.flags.writeable = False
+        fam = FrozenAutoMap(a1)
+        assert fam.__sizeof__() - a1.__sizeof__() < 16 * len(fam)
+        assert fam.get_all(a1).tolist() == list(range(5_000))
+        assert fam[a1[4_999]] == 4_999
+        assert a1[-1] in fam
+
+
+def test_fam_sizeof_c():
+    a1 = np.arange(5_000).astype("U4")
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    am = AutoMap(fam)
+    assert am.__sizeof__() == fam.__sizeof__()
+    assert am["4999"] == 4_999
+    # an AutoMap shares an immutable array, growing its own copy only when keys are added
+    assert AutoMap(a1).__sizeof__() == fam.__sizeof__()
+    am.add("5000")
+    assert am.__sizeof__() > fam.__sizeof__()
+
+
+def test_fam_inline_a():
+    for dtype in (np.int64, np.int8, np.uint64, np.uint16, np.float32, "datetime64[s]"):
+        a1 = np.concatenate(([1, 0], np.arange(2, 100))).astype(dtype)
+        a1.flags.writeable = False
+        fam1 = FrozenAutoMap(a1)
+        fam2 = FrozenAutoMap(a1, inline=True)
+        assert fam2.__sizeof__() > fam1.__sizeof__()
+        assert fam2.get_all(a1).tolist() == list(range(100))
+        assert fam2[a1[99]] == 99
+        assert a1[0] in fam2
+        assert 1_000 not in fam2
+        assert hash(fam1) == hash(fam2)
+
+
+def test_fam_inline_b():
+    a1 = np.arange(20_000, dtype=np.float64) / 4
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1, inline=True, threads=4)
+    assert fam.get_all(a1, threads=2).tolist() == list(range(20_000))
+    assert fam.get(-0.25) is None
+
+    a2 = np.concatenate((a1, a1[:1]))
+    a2.flags.writeable = False
+    with pytest.raises(NonUniqueError):
+        FrozenAutoMap(a2, inline=True, threads=4)
+
+
+def test_fam_inline_c():
+    # inline keys are ignored for flexible dtypes and for lists
+    a1 = np.array(("a", "bb", "ccc"))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1, inline=True)
+    assert fam.__sizeof__() == FrozenAutoMap(a1).__sizeof__()
+    assert fam["ccc"] == 2
+    am = AutoMap((3, 4), inline=True)
+    am.add(5)
+    assert am[5] == 2
+
+
+# ------------------------------------------------------------------------------
+
+
+def test_fam_range_a():
+    a1 = np.arange(10, 1_000, 7)
+    a1.flags.writeable = False
+    fam1 = FrozenAutoMap(a1)
+    fam2 = FrozenAutoMap(a1.tolist())
+    # a range needs no table
+    assert fam1.__sizeof__() - a1.__sizeof__() < len(a1)
+    assert fam1.get_all(a1).tolist() == list(range(len(a1)))
+    for key in (3, 9, 10, 11, 17, 18, 997, 1_004, -4, 2**70, 17.0, 17.5, "17"):
+        assert fam1.get(key) == fam2.get(key)
+    assert hash(fam1) == hash(fam2)
+
+
+def test_fam_range_b():
+    a1 = np.arange(50, -50, -5, dtype=np.int8)
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    assert fam[50] == 0
+    assert fam[-45] == 19
+    assert fam.get(-50) is None
+    assert fam.get(51) is None
+    assert fam.get(47) is None
+    assert fam.get_any(np.array([55, 45, 0, -3, -45])) == [1, 10, 19]
+
+
+def test_fam_range_c():
+    info = np.iinfo(np.int64)
+    a1 = np.array([info.min, info.max])
+    a1.flags.writeable = False
+    # the difference does not fit in an int64, so a table is used
+    fam = FrozenAutoMap(a1)
+    assert fam.__sizeof__() > FrozenAutoMap(a1[:1]).__sizeof__()
+    assert fam[info.max] == 1
+    assert fam.get(0) is None
+
+    a2 = np.array([info.min, -1, info.max - 1])
+    a2.flags.writeable = False
+    fam = FrozenAutoMap(a2)
+    assert fam.get_all(a2).tolist() == [0, 1, 2]
+    assert fam.get(info.max) is None
+
+
+def test_fam_range_d():
+    a1 = np.arange("2020-01-01", "2021-01-01", dtype="datetime64[D]")
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    assert fam[np.datetime64("2020-03-01")] == 60
+    assert np.datetime64("2021-01-01") not in fam
+    assert np.datetime64("2020-03-01T00") not in fam
+    assert fam.get_all(a1[::-1]).tolist() == list(range(len(a1)))[::-1]
+    with pytest.raises(KeyError):
+        fam.get_all(np.array(["2019-12-31"], dtype="datetime64[D]"))
+
+    am = AutoMap(fam)
+    assert am[np.datetime64("2020-12-31")] == 365
+    assert pickle.loads(pickle.dumps(fam))[np.datetime64("2020-01-02")] == 1
+
+
+# ------------------------------------------------------------------------------
+
+
+def test_fam_sorted_a():
+    a1 = np.array((1, 3, 7, 20, 21))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1, sorted=True)
+    assert fam.__sizeof__() < FrozenAutoMap(a1).__sizeof__()
+    assert fam[7] == 2
+    assert fam.get(8) is None
+    assert 21 in fam
+    assert 0 not in fam
+    assert fam.get_all(np.array((21, 1))).tolist() == [4, 0]
+    assert fam.get_any(np.array((2, 3, 4, 20), dtype=np.int8)) == [1, 3]
+
+
+def test_fam_sorted_b():
+    for a1, exception in (
+        (np.array((3, 1)), ValueError),
+        (np.arange(5)[::-1], ValueError),
+        (np.array((1.0, np.nan)), ValueError),
+        (np.array((1, 2, 2)), NonUniqueError),
+        (np.array(("a", "b")), ValueError),
+    ):
+        a1.flags.writeable = False
+        with pytest.raises(exception):
+            FrozenAutoMap(a1, sorted=True)
+    with pytest.raises(ValueError):
+        FrozenAutoMap((1, 2), sorted=True)
+
+
+def test_fam_sorted_c():
+    a1 = np.array((0.5, 1.5, np.inf), dtype=np.float32)
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1, sorted=True)
+    assert fam[np.inf] == 2
+    assert fam[1.5] == 1
+    assert fam.get_slice(1, None) == slice(1, 3)
+    assert fam.get_slice(None, 0.5) == slice(0, 0)
+    with pytest.raises(ValueError):
+        fam.get_slice(np.nan, None)
+
+
+def test_fam_sorted_pickle_a():
+    a1 = np.array((1, 3, 7, 20, 21))
+    a1.flags.writeable = False
+    fam1 = FrozenAutoMap(a1, sorted=True)
+    fam2 = pickle.loads(pickle.dumps(fam1))
+    assert fam2.get_slice(3, 8) == slice(1, 3)
+    assert fam2.__sizeof__() == fam1.__sizeof__()
+
+
+def test_fam_get_slice_a():
+    a1 = np.array((1, 3, 7, 20, 21))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1, sorted=True)
+    assert fam.get_slice(3, 21) == slice(1, 4)
+    assert fam.get_slice(None, 7.5) == slice(0, 3)
+    assert fam.get_slice(2.5, None) == slice(1, 5)
+    assert fam.get_slice(2**80, None) == slice(5, 5)
+    assert fam.get_slice(-(2**80), 0) == slice(0, 0)
+    assert fam.get_slice(30, 1) == slice(5, 5)
+    assert a1[fam.get_slice(None, None)].tolist() == a1.tolist()
+    with pytest.raises(TypeError):
+        fam.get_slice("a", None)
+    with pytest.raises(TypeError):
+        fam.get_slice(3)
+
+
+def test_fam_get_slice_b():
+    a1 = np.array((0, 2**63, 2**64 - 1), dtype=np.uint64)
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1, sorted=True)
+    assert fam.get_slice(-1, 2**63) == slice(0, 1)
+    assert fam.get_slice(1, 2**64) == slice(1, 3)
+    assert fam.get_slice(2**63, 2**64 - 1) == slice(1, 2)
+
+
+def test_fam_get_slice_c():
+    a1 = np.array(
+        ("2020-01-01", "2020-01-04", "2020-01-10", "2020-02-10"), dtype="datetime64[D]"
+    )
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1, sorted=True)
+    assert fam.get_slice("2020-01-04", "2020-02") == slice(1, 3)
+    assert fam.get_slice(np.datetime64("2020-01-05"), None) == slice(2, 4)
+    with pytest.raises(ValueError):
+        fam.get_slice(np.datetime64("2020-01"), None)
+    with pytest.raises(ValueError):
+        fam.get_slice(np.datetime64("NaT"), None)
+
+
+def test_fam_get_slice_d():
+    a1 = np.arange(0, 100, 10)
+    a1.flags.writeable = False
+    assert FrozenAutoMap(a1).get_slice(15, 50) == slice(2, 5)
+    assert FrozenAutoMap(a1).get_slice(-5.5, 10.0) == slice(0, 1)
+    assert FrozenAutoMap(a1).get_slice(91, None) == slice(10, 10)
+
+    a2 = np.array((3, 1, 2))
+    a2.flags.writeable = False
+    with pytest.raises(ValueError):
+        FrozenAutoMap(a2).get_slice(1, 2)
+    with pytest.raises(ValueError):
+        FrozenAutoMap(a1[::-1]).get_slice(1, 2)
+    with pytest.raises(ValueError):
+        AutoMap((1, 2)).get_slice(1, 2)
+
+
+def test_fam_flexible_hash_a():
+    # keys that share long prefixes and differ in length, exercising partial words
+    keys = [f"TICKER{i:06d}"[: 1 + i % 20] + str(i) for i in range(2_000)]
+    for dtype in (str, bytes):
+        a1 = np.array(keys).astype(dtype)
+        a1.flags.writeable = False
+        fam = FrozenAutoMap(a1)
+        assert len(fam) == len(a1)
+        assert fam.get_all(a1).tolist() == list(range(len(a1)))
+        for i in (0, 7, 19, 1_999):
+            assert fam[a1[i]] == i
+        assert fam.get(a1[5][:-1]) is None
+        a2 = np.concatenate((a1, a1[3:4]))
+        a2.flags.writeable = False
+        with pytest.raises(NonUniqueError):
+            FrozenAutoMap(a2)
+
+
+def test_fam_float_hash_a():
+    a1 = np.array((0.0, 1.5, np.inf, -np.inf, 1e-300, 2.0**60, -7.25))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    assert fam.get_all(a1).tolist() == list(range(len(a1)))
+    assert fam[-0.0] == 0
+    assert fam[np.float32(1.5)] == 1
+    assert fam[-np.inf] == 3
+    assert fam[2**60] == 5
+    assert fam.get(np.nan) is None
+
+    a2 = np.array((-0.0, 0.5, 3.25), dtype=np.float32)
+    a2.flags.writeable = False
+    fam = FrozenAutoMap(a2)
+    assert fam[0.0] == 0
+    assert fam[np.float16(3.25)] == 2
+
+    a3 = np.array((1.0, 0.0, -0.0))
+    a3.flags.writeable = False
+    with pytest.raises(NonUniqueError):
+        FrozenAutoMap(a3)
+
+
+def test_fam_packed_a():
+    a1 = np.array(("", "a", "ab", "abc", "caf\xe9", "a\x00b", "zzzz"))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1, packed=True)
+    assert fam.get_all(a1).tolist() == list(range(len(a1)))
+    assert fam.get_all(list(a1)).tolist() == list(range(len(a1)))
+    assert fam["caf\xe9"] == 4
+    assert fam[np.str_("ab")] == 2
+    assert fam.get("caf\u0113") is None
+    assert fam.get("abcde") is None
+    assert fam.get(b"ab") is None
+
+    a2 = np.array(("ab", "caf\u0113", "zzzzzzzz", "abc"))
+    a2.flags.writeable = False
+    assert fam.get_any(a2) == [2, 3]
+    with pytest.raises(KeyError):
+        fam.get_all(a2)
+
+    a3 = np.array(("abc", "x", "abc"))
+    a3.flags.writeable = False
+    with pytest.raises(NonUniqueError):
+        FrozenAutoMap(a3, packed=True)
+
+
+def test_fam_packed_b():
+    # keys with non-latin-1 characters are not packed
+    a1 = np.array(("\u03b1", "\u03b2", "a", "caf\xe9"))
+    a1.flags.writeable = False
+    fam1 = FrozenAutoMap(a1, packed=True)
+    assert fam1.__sizeof__() == FrozenAutoMap(a1).__sizeof__()
+    assert fam1["\u03b2"] == 1
+    assert fam1["caf\xe9"] == 3
+    assert fam1.get_all(a1).tolist() == [0, 1, 2, 3]
+
+    a2 = np.array([f"key-{i}" for i in range(20_000)])
+    a2.flags.writeable = False
+    fam2 = FrozenAutoMap(a2, packed=True)
+    # the packed copy adds one byte per character
+    packed_size = a2.size * a2.itemsize // 4
+    assert fam2.__sizeof__() - FrozenAutoMap(a2).__sizeof__() == packed_size
+    for fam in (fam2, FrozenAutoMap(fam2), FrozenAutoMap(a2, threads=4, packed=True)):
+        assert fam.get_all(a2[::-1], threads=2).tolist() == list(range(19_999, -1, -1))
+        assert fam["key-19999"] == 19_999
+    assert hash(fam2) == hash(FrozenAutoMap(a2, threads=4))
+    fam3 = pickle.loads(pickle.dumps(fam2))
+    fam4 = pickle.loads(pickle.dumps(FrozenAutoMap(a2)))
+    assert fam3["key-7"] == 7
+    assert fam3.__sizeof__() - fam4.__sizeof__() == packed_size
+
+
+def test_fam_lengths_a():
+    keys = ["", "a", "ab", "a" * 299, "a\x00b", "αb"]
+    for dtype in ("U300", "U70000", "S300", "S70000"):
+        if dtype[0] == "S":
+            a1 = np.array([k.encode("utf-8") for k in keys], dtype=dtype)
+        else:
+            a1 = np.array(keys, dtype=dtype)
+        a1.flags.writeable = False
+        fam = FrozenAutoMap(a1)
+        assert fam.get_all(a1).tolist() == list(range(len(keys)))
+        assert fam.get_all(a1.astype(dtype[0] + "80000")).tolist() == list(
+            range(len(keys))
+        )
+        assert fam.get_any(a1[[3, 2, 1, 0]].astype(dtype[0] + "2")) == [2, 1, 0]
+        assert fam[a1[3]] == 3
+        assert fam.get(a1[3] * 2) is None
+        assert fam.get(a1[3][:-1]) is None
+
+
+def test_fam_get_all_missing_a():
+    a1 = np.array((20, 5, 100, 8))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.array((8, 7, 20, 1_000))
+    for key in (a2, a2.tolist(), a2.astype(np.int32), a2.astype(object)):
+        assert fam.get_all(key, missing=-1).tolist() == [3, -1, 0, -1]
+        assert fam.get_all(key, missing=len(fam)).tolist() == [3, 4, 0, 4]
+        post, found = fam.get_all(key, found=True)
+        assert post.tolist() == [3, -1, 0, -1]
+        assert found.tolist() == [True, False, True, False]
+        assert not post.flags.writeable and not found.flags.writeable
+        with pytest.raises(KeyError):
+            fam.get_all(key)
+
+    post, found = fam.get_all(np.array(()), missing=0, found=True)
+    assert post.tolist() == [] and found.tolist() == []
+    post, found = fam.get_all(a1, found=True)
+    assert found.all()
+    with pytest.raises(TypeError):
+        fam.get_all(a2, missing=1.5)
+
+
+def test_fam_get_all_missing_b():
+    a1 = np.array(("a", "bb", "ccc"))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    assert fam.get_all(np.array(("ccc", "d", "a")), missing=-9).tolist() == [2, -9, 0]
+
+    a2 = np.array(("2020-01", "2021-06"), dtype="datetime64[M]")
+    a2.flags.writeable = False
+    fam = FrozenAutoMap(a2)
+    post, found = fam.get_all(np.array(("2020-01",), dtype="datetime64[D]"), found=True)
+    assert post.tolist() == [-1]
+    assert found.tolist() == [False]
+
+
+def test_fam_get_all_dtype_a():
+    a1 = np.array(("a", "bb", "ccc", "dddd"))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.array(("dddd", "a", "e"))
+    for key in (a2, a2.tolist()):
+        post = fam.get_all(key, dtype=np.int32, missing=-3)
+        assert post.dtype == np.int32
+        assert post.tolist() == [3, 0, -3]
+        assert not post.flags.writeable
+        post = fam.get_all(key, dtype=np.intp, missing=-3)
+        assert post.dtype == np.intp
+        assert post.tolist() == [3, 0, -3]
+
+    post = fam.get_all(np.arange(4).astype(a1.dtype)[:0], dtype=np.int32)
+    assert post.dtype == np.int32 and post.tolist() == []
+    with pytest.raises(TypeError):
+        fam.get_all(a2, dtype=np.int16)
+    with pytest.raises(TypeError):
+        fam.get_all(a2, dtype=np.uint32)
+    with pytest.raises(ValueError):
+        fam.get_all(a2, dtype=np.int32, missing=2**40)
+
+
+def test_fam_get_all_out_a():
+    a1 = np.arange(100, 200)
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.array((150, 7, 100))
+    for dtype in (np.int32, np.int64):
+        out = np.full(3, 99, dtype=dtype)
+        for key in (a2, a2.tolist(), a2.astype(np.int32)):
+            post = fam.get_all(key, out=out, missing=-1)
+            assert post is out
+            assert out.flags.writeable
+            assert out.tolist() == [50, -1, 0]
+            out[:] = 99
+
+        post, found = fam.get_all(a2, out=out, found=True)
+        assert post is out
+        assert found.tolist() == [True, False, True]
+        with pytest.raises(KeyError):
+            fam.get_all(a2, out=out)
+
+    out = np.empty(3, dtype=np.int32)
+    fam.get_all(a2, out=out, dtype=np.int32, missing=0)
+    assert out.tolist() == [50, 0, 0]
+    with pytest.raises(TypeError):
+        fam.get_all(a2, out=out, dtype=np.int64)
+    with pytest.raises(TypeError):
+        fam.get_all(a2, out=np.empty(3, dtype=float), missing=0)
+    with pytest.raises(TypeError):
+        fam.get_all(a2, out=[0, 0, 0], missing=0)
+    with pytest.raises(ValueError):
+        fam.get_all(a2, out=np.empty(4, dtype=np.int64), missing=0)
+    with pytest.raises(ValueError):
+        fam.get_all(a2, out=np.empty(6, dtype=np.int64)[::2], missing=0)
+    out = np.empty(3, dtype=np.int64)
+    out.flags.writeable = False
+    with pytest.raises(ValueError):
+        fam.get_all(a2, out=out, missing=0)
+
+
+def test_fam_isin_a():
+    a1 = np.array((20, 5, 100, 8))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.array((8, 7, 20, 1_000, 100))
+    for key in (a2, a2.tolist(), a2.astype(np.int32), a2.astype(object)):
+        post = fam.isin(key)
+        assert post.dtype == bool
+        assert post.tolist() == [True, False, True, False, True]
+        assert not post.flags.writeable
+
+    assert fam.isin([]).tolist() == []
+    assert fam.isin(a1, threads=2).all()
+    assert not fam.isin(np.array(("a", "b"))).any()
+    with pytest.raises(TypeError):
+        fam.isin((8, 7))
+    with pytest.raises(ValueError):
+        fam.isin(a2, threads=0)
+
+
+def test_fam_isin_b():
+    a1 = np.array(("2020-01", "2021-06"), dtype="datetime64[M]")
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.array(("2021-06", "2022-01"), dtype="datetime64[M]")
+    assert fam.isin(a2).tolist() == [True, False]
+    a2 = np.array(("2021-06-01",), dtype="datetime64[D]")
+    assert fam.isin(a2).tolist() == [False]
+
+    am = AutoMap(("a", 3, None, (1, 2)))
+    post = am.isin(["a", "b", None, (1, 2), 3.0])
+    assert post.tolist() == [True, False, True, True, True]
+    am.add(False)
+    post = am.isin(np.array([False, "a", 4], dtype=object))
+    assert post.tolist() == [True, True, False]
+    with pytest.raises(TypeError):
+        am.isin([[1]])
+
+
+def test_fam_get_all_cross_kind_a():
+    # typed lookups of arrays of another kind or width must match scalar lookups
+    values = (0, 1, -1, 2, 3.5, 7, 100, 127, 255, 2**53, 2**63 - 1, 2**64 - 1, 1e300)
+    dtypes = (
+        np.int64,
+        np.int32,
+        np.int8,
+        np.uint64,
+        np.uint16,
+        np.float64,
+        np.float32,
+        np.float16,
+    )
+    for dtype_keys in dtypes:
+        for keys in (
+            (100, 0, 1, 7, 3, 2, 127),  # hashed
+            (0, 1, 2, 3, 7, 100, 127),  # sorted
+            range(0, 20, 2),  # range
+        ):
+            a1 = np.array(keys, dtype=dtype_keys)
+            a1.flags.writeable = False
+            fam = FrozenAutoMap(a1)
+            for dtype in dtypes + (np.uint8, np.int16, np.uint32):
+                with np.errstate(over="ignore", invalid="ignore"):
+                    a2 = np.array([np.array(v).astype(dtype) for v in values])
+                expected = [fam.get(k, -1) for k in a2]
+                assert fam.get_all(a2, missing=-1).tolist() == expected
+
+
+def test_fam_get_all_cross_kind_b():
+    a1 = np.array((3, 10, 20), dtype=np.int64)
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.array((20.0, 10.5, 3.0, np.nan, np.inf))[::-1]
+    assert fam.get_all(a2, missing=-1).tolist() == [-1, -1, 0, -1, 2]
+    assert fam.get_all(np.array((3, 20), dtype=np.uint8)).tolist() == [0, 2]
+    assert fam.get_all(np.array((20, 3), dtype=">i8")).tolist() == [2, 0]
+    a2 = np.array((2**64 - 1, 10), dtype=np.uint64)
+    assert fam.isin(a2).tolist() == [False, True]
+
+    a2 = np.array(("2020-01", "NaT", "2021-03"), dtype="datetime64[M]")
+    a2.flags.writeable = False
+    fam = FrozenAutoMap(a2)
+    a3 = np.array(("NaT", "2020-01-01", "2021-03"), dtype="datetime64[D]")
+    assert fam.get_all(a3, missing=-1).tolist() == [1, -1, -1]
+    assert fam.get_all(a3, missing=-1).tolist() == [fam.get(k, -1) for k in a3]
+    assert fam.get_any(a3) == [1]
+    with pytest.raises(KeyError):
+        fam.get_all(a3)
+
+
+def test_fam_get_all_cross_kind_c():
+    # uint64 keys of 2**63 or more equal no signed key, as scalars or in arrays
+    a2 = np.array((2**64 - 5, 1, 2**63, 2**63 - 1), dtype=np.uint64)
+    for dtype in (np.int64, np.int32, np.int8):
+        a1 = np.array((-5, 1, 2), dtype=dtype)
+        a1.flags.writeable = False
+        fam = FrozenAutoMap(a1)
+        post = [fam.get(k, -1) for k in a2]
+        assert post == [-1, 1, -1, -1]
+        assert fam.get_all(a2, missing=-1).tolist() == post
+        assert fam.get_any(a2) == [1]
+        assert fam.isin(a2).tolist() == [k != -1 for k in post]
+        assert (a2[0] in fam) is False
+
+
+def test_am_get_all_object_a():
+    am = AutoMap(("a", 3, None, (1, 2), b"x"))
+    a1 = np.empty(7, dtype=object)
+    a1[:] = ["a", None, (1, 2), 3.0, b"x", "z", (1, 2)]
+    assert am.get_all(a1, missing=-1).tolist() == [0, 2, 3, 1, 4, -1, 3]
+    assert am.get_all(a1[::-2], missing=-1).tolist() == [3, 4, 3, 0]
+    assert am.get_any(a1) == [0, 2, 3, 1, 4, 3]
+    assert am.isin(a1).tolist() == [True, True, True, True, True, False, True]
+    with pytest.raises(KeyError, match="z"):
+        am.get_all(a1)
+
+    a2 = np.array([[1], "a"], dtype=object)
+    with pytest.raises(TypeError):
+        am.get_all(a2, missing=-1)
+    with pytest.raises(TypeError):
+        am.isin(a2[::-1])
+
+
+def test_fam_get_all_object_a():
+    a1 = np.array((20, 5, 100))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.array((100, 20.0, "a", None, np.int8(5)), dtype=object)
+    assert fam.get_all(a2, missing=-1).tolist() == [2, 0, -1, -1, 1]
+    post, found = fam.get_all(a2, found=True, dtype=np.int32)
+    assert found.tolist() == [True, True, False, False, True]
+    assert fam.get_any(a2, as_array=True).tolist() == [2, 0, 1]
+
+    a3 = np.array(("b", "cc"))
+    a3.flags.writeable = False
+    fam = FrozenAutoMap(a3)
+    a4 = np.array(("cc", "b", 3), dtype=object)
+    assert fam.get_all(a4, missing=-1).tolist() == [1, 0, -1]
+
+
+def test_fam_get_any_as_array_a():
+    a1 = np.array((20, 5, 100, 8))
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.array((8, 7, 20, 1_000, 100))
+    for key in (a2, a2.tolist(), a2.astype(np.int32), a2.astype(object)):
+        post = fam.get_any(key, as_array=True)
+        assert post.dtype == np.int64
+        assert post.tolist() == [3, 0, 2]
+        assert post.tolist() == fam.get_any(key)
+        assert not post.flags.writeable
+
+    assert fam.get_any(np.array((1, 2)), as_array=True).tolist() == []
+    assert fam.get_any([], as_array=True).tolist() == []
+    assert fam.get_any(a1, as_array=True).tolist() == [0, 1, 2, 3]
+
+
+def test_fam_get_any_as_array_b():
+    a1 = np.array([f"k{i}" for i in range(10_000)])
+    a1.flags.writeable = False
+    fam = FrozenAutoMap(a1)
+    a2 = np.array([f"k{i}" for i in range(-5_000, 5_000, 3)])
+    post = fam.get_any(a2, as_array=True, threads=2)
+    assert post.tolist() == list(range(1, 5_000, 3))
+    assert fam.get_any(a2) == post.tolist()